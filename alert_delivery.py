@@ -0,0 +1,179 @@
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger('AlertDelivery')
+
+class AlertDelivery:
+    """Background e-mail delivery of alerts
+
+    Alerts are put on a bounded queue and sent by a dedicated thread, so a
+    slow or dead mail relay never holds up rule evaluation. The SMTP session
+    is kept open between messages and reopened when the relay drops it.
+    Alerts arriving within digest_window seconds of each other are sent as
+    one digest message. A failed send is retried max_retries times with
+    exponential backoff; when the queue is full new alerts are dropped.
+    """
+
+    def __init__(self, smtp_server: str = None, smtp_port: int = None,
+                 sender_email: str = None, sender_password: str = None,
+                 recipient_email: str = None, max_pending: int = 1000,
+                 timeout: float = 10.0, max_retries: int = 3, backoff: float = 1.0,
+                 digest_window: float = 2.0, max_digest: int = 50, idle_timeout: float = 60.0):
+        self.smtp_server = smtp_server or os.getenv("SMTP_SERVER", "localhost")
+        self.smtp_port = smtp_port or int(os.getenv("SMTP_PORT", "25"))
+        self.sender_email = sender_email or os.getenv("SMTP_EMAIL")
+        self.sender_password = sender_password or os.getenv("SMTP_PASSWORD")
+        self.recipient_email = recipient_email or os.getenv("ALERT_EMAIL")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.digest_window = digest_window
+        self.max_digest = max_digest
+        self.idle_timeout = idle_timeout
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.sender_email and self.recipient_email)
+
+    def enqueue(self, subject: str, message: str) -> bool:
+        """Queue an alert for delivery without blocking; False when it was dropped"""
+        self.start()
+        try:
+            self._queue.put_nowait((subject, message))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.error(f"Alert queue full, dropping alert: {subject}")
+            return False
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Deliver what is queued (within timeout) and close the SMTP session"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def run(self):
+        logger.info("Alert delivery started")
+        while not (self._stop_event.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._smtp and time.monotonic() - self._last_used > self.idle_timeout:
+                    self._close()
+                continue
+            alerts = [first] + self._collect_digest()
+            try:
+                self._deliver(alerts)
+            except Exception as e:
+                logger.error(f"Unexpected error delivering alerts: {str(e)}")
+            for _ in alerts:
+                self._queue.task_done()
+        self._close()
+        logger.info("Alert delivery stopped")
+
+    def _collect_digest(self) -> List[Tuple[str, str]]:
+        """Gather the alerts that arrive shortly after the first one"""
+        alerts = []
+        deadline = time.monotonic() + self.digest_window
+        while len(alerts) < self.max_digest - 1:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop_event.is_set():
+                remaining = 0
+            try:
+                alerts.append(self._queue.get(timeout=remaining) if remaining else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return alerts
+
+    def _build_message(self, alerts: List[Tuple[str, str]]) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg['From'] = self.sender_email
+        msg['To'] = self.recipient_email
+        if len(alerts) == 1:
+            subject, body = alerts[0]
+        else:
+            subject = f"{len(alerts)} alerts"
+            body = "\n\n".join(f"=== {subject}\n\n{message}" for subject, message in alerts)
+        msg['Subject'] = f"WireGuard Security Alert: {subject}"
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
+
+    def _deliver(self, alerts: List[Tuple[str, str]]):
+        if not self.configured:
+            logger.error("Email configuration missing. Please set SMTP_EMAIL and ALERT_EMAIL")
+            self.failed += len(alerts)
+            return
+
+        msg = self._build_message(alerts)
+        attempt = 0
+        while True:
+            reused = self._smtp is not None
+            try:
+                self._session().send_message(msg)
+                self._last_used = time.monotonic()
+                self.sent += len(alerts)
+                logger.info(f"Security alert sent: {msg['Subject']}")
+                return
+            except smtplib.SMTPServerDisconnected:
+                # The relay closed the idle session: reconnect right away
+                self._close()
+                if reused:
+                    continue
+                error = "server disconnected"
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                error = str(e)
+
+            if attempt >= self.max_retries or self._stop_event.is_set():
+                self.failed += len(alerts)
+                logger.error(f"Failed to send email alert after {attempt + 1} attempts: {error}")
+                return
+            delay = self.backoff * 2 ** attempt
+            attempt += 1
+            logger.warning(f"Failed to send email alert ({error}), retrying in {delay:.1f}s")
+            self._stop_event.wait(delay)
+
+    def _session(self) -> smtplib.SMTP:
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            if self.sender_password:
+                smtp.login(self.sender_email, self.sender_password)
+            self._smtp = smtp
+        return self._smtp
+
+    def _close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
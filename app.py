@@ -1,4 +1,4 @@
-from flask import Flask, render_template, jsonify, request, flash
+from flask import Flask, render_template, jsonify, request, flash, Response, stream_with_context
 from datetime import datetime, timedelta
 import pandas as pd
 from database import Database
@@ -6,12 +6,20 @@ from log_parser import WireGuardLogParser
 from utils import create_connection_timeline, create_traffic_graph
 from security_monitor import SecurityMonitor
 from models import AlertRule
+from rule_engine import parse_scope
+from live_stream import PeerStatsBroadcaster
+from cache import CachedQueries
+from http_cache import CachedResponses, VersionClock, compress_response
+from dataclasses import asdict
 import sqlite3
 import traceback
 import atexit
+import base64
+import json
 import logging
 import os
-from typing import List
+import time
+from typing import Dict, List, Optional
 import ipaddress
 import geoip2.database
 import requests
@@ -27,6 +35,15 @@ app.secret_key = os.urandom(24)
 db = Database()
 parser = WireGuardLogParser()
 security_monitor = SecurityMonitor(db)
+# One computation per tick shared by every open live stream
+broadcaster = PeerStatsBroadcaster(db)
+queries = CachedQueries(db)
+
+# Versions behind the API ETags, read at most once a second for all clients
+data_clock = VersionClock(db.get_generation)
+rule_clock = VersionClock(lambda: (db.get_rule_version(), db.get_rule_trigger_version()))
+responses = CachedResponses()
+app.after_request(compress_response)
 
 # Default alert rules
 DEFAULT_ALERT_RULES = [
@@ -94,9 +111,228 @@ def initialize_default_rules():
 
 # Rest of the existing app.py code remains the same...
 
+# Page size bounds of /api/connections
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EVENT_TYPES = ('connect', 'disconnect', 'transfer')
+
+def encode_cursor(timestamp: datetime, connection_id: int) -> str:
+    """Opaque cursor pointing just past an event"""
+    raw = json.dumps([timestamp.isoformat(), connection_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    timestamp, connection_id = json.loads(raw)
+    return datetime.fromisoformat(timestamp), int(connection_id)
+
+@app.route('/logs')
+def logs():
+    """Connection log page; rows are loaded page by page from /api/connections"""
+    return render_template('logs.html', logs=[])
+
+@app.route('/api/connections')
+def api_connections():
+    """Connection history, newest first, one keyset page at a time
+
+    Query parameters: limit, cursor (next_cursor of the previous page),
+    peer, ip (address prefix), event, start and end (ISO timestamps).
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        before = decode_cursor(cursor) if cursor else None
+        event_type = request.args.get('event') or None
+        if event_type and event_type not in EVENT_TYPES:
+            raise ValueError(f"unknown event type {event_type}")
+        start = request.args.get('start')
+        end = request.args.get('end')
+        filters = {
+            'peer_id': request.args.get('peer') or None,
+            'ip_prefix': request.args.get('ip') or None,
+            'event_type': event_type,
+            'start': datetime.fromisoformat(start) if start else None,
+            'end': datetime.fromisoformat(end) if end else None,
+        }
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f"Invalid parameter: {str(e)}"}), 400
+
+    try:
+        # Fetch the page before streaming so that errors still get a proper status
+        page = db.get_connections_page(limit, before, **filters)
+    except Exception as e:
+        logger.error(f"Error fetching connections page: {str(e)}")
+        return jsonify({'error': 'Error fetching connections'}), 500
+
+    next_cursor = None
+    if len(page) == limit:
+        next_cursor = encode_cursor(page[-1].timestamp, page[-1].id)
+
+    def generate():
+        yield '{"connections": ['
+        for i, conn in enumerate(page):
+            yield (',' if i else '') + json.dumps({
+                'id': conn.id,
+                'timestamp': conn.timestamp.isoformat(),
+                'peer_id': conn.peer_id,
+                'event': conn.event_type,
+                'ip_address': conn.ip_address,
+                'bytes_sent': conn.bytes_sent,
+                'bytes_received': conn.bytes_received,
+            })
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/api/bandwidth')
+def api_bandwidth():
+    """Per-peer transfer totals over `range` (hour, day, week, month or all)"""
+    time_range = request.args.get('range', 'day')
+    if time_range not in Database.TIME_RANGES:
+        return jsonify({'error': f"Invalid parameter: unknown range {time_range}"}), 400
+    # The range ends now: the totals also change every minute without new data
+    version = (data_clock.get(), int(time.time() // 60))
+    try:
+        return responses.respond('bandwidth', (time_range,), version,
+                                 lambda: {'stats': db.get_bandwidth_usage(time_range)})
+    except Exception as e:
+        logger.error(f"Error fetching bandwidth usage: {str(e)}")
+        return jsonify({'error': 'Error fetching bandwidth usage'}), 500
+
+@app.route('/api/traffic')
+def api_traffic():
+    """Plotly JSON of the traffic graph, as traffic.html's updateTraffic() expects it"""
+    try:
+        limit = min(max(int(request.args.get('limit', 1000)), 1), 100000)
+        width = min(max(int(request.args.get('width', 1200)), 10), 10000)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid parameter: {str(e)}"}), 400
+    try:
+        return responses.respond('traffic', (limit, width), data_clock.get(), lambda: {
+            'traffic_graph': queries.traffic_graph(limit, width).to_json()
+        })
+    except Exception as e:
+        logger.error(f"Error building traffic graph: {str(e)}")
+        return jsonify({'error': 'Error building traffic graph'}), 500
+
+ALERT_EVENT_TYPES = ('connection', 'traffic', 'bandwidth', 'time_based')
+ALERT_CONDITIONS = ('gt', 'lt', 'eq', 'contains', 'outside')
+ALERT_ACTIONS = ('email', 'log')
+
+def rule_to_json(rule: AlertRule) -> Dict:
+    data = asdict(rule)
+    data['last_triggered'] = rule.last_triggered.isoformat() if rule.last_triggered else None
+    return data
+
+def rule_from_json(data: Dict, existing: Optional[AlertRule] = None) -> AlertRule:
+    """AlertRule from a request body; fields left out keep their current value"""
+    def field(name, default=None):
+        value = data.get(name)
+        if value is None or value == '':
+            if existing is not None:
+                return getattr(existing, name)
+            if default is None:
+                raise ValueError(f"missing {name}")
+            return default
+        return value
+
+    rule = AlertRule(
+        id=existing.id if existing else None,
+        name=str(field('name')),
+        event_type=field('event_type'),
+        condition=field('condition'),
+        threshold=float(field('threshold', 0)),
+        time_window=int(field('time_window', 0)),
+        action=field('action', 'email'),
+        enabled=field('enabled', True) not in (False, 'false', '0', 0),
+        last_triggered=existing.last_triggered if existing else None,
+        description=str(field('description', '')),
+        scope=str(field('scope', 'global')),
+    )
+    if rule.event_type not in ALERT_EVENT_TYPES:
+        raise ValueError(f"unknown event type {rule.event_type}")
+    if rule.condition not in ALERT_CONDITIONS:
+        raise ValueError(f"unknown condition {rule.condition}")
+    if rule.action not in ALERT_ACTIONS:
+        raise ValueError(f"unknown action {rule.action}")
+    # CompiledRules would otherwise skip the rule with only a log line
+    parse_scope(rule.scope)
+    return rule
+
+@app.route('/api/alert-rules', methods=['GET'])
+def api_alert_rules():
+    return responses.respond('alert_rules', (), rule_clock.get(), lambda: {
+        'rules': [rule_to_json(rule) for rule in db.get_alert_rules()]
+    })
+
+@app.route('/api/alert-rules/<int:rule_id>', methods=['GET'])
+def api_alert_rule(rule_id: int):
+    def build():
+        rule = db.get_alert_rule(rule_id)
+        if rule is None:
+            raise LookupError(rule_id)
+        return rule_to_json(rule)
+
+    try:
+        return responses.respond('alert_rule', (rule_id,), rule_clock.get(), build)
+    except LookupError:
+        return jsonify({'error': 'Rule not found'}), 404
+
+@app.route('/api/alert-rules', methods=['POST'])
+def api_add_alert_rule():
+    try:
+        rule = rule_from_json(request.get_json(force=True) or {})
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f"Invalid rule: {str(e)}"}), 400
+    rule.id = db.add_alert_rule(rule)
+    rule_clock.invalidate()
+    return jsonify(rule_to_json(rule)), 201
+
+@app.route('/api/alert-rules/<int:rule_id>', methods=['PUT'])
+def api_update_alert_rule(rule_id: int):
+    existing = db.get_alert_rule(rule_id)
+    if existing is None:
+        return jsonify({'error': 'Rule not found'}), 404
+    try:
+        rule = rule_from_json(request.get_json(force=True) or {}, existing)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f"Invalid rule: {str(e)}"}), 400
+    db.update_alert_rule(rule)
+    rule_clock.invalidate()
+    return jsonify(rule_to_json(rule))
+
+@app.route('/api/alert-rules/<int:rule_id>/toggle', methods=['POST'])
+def api_toggle_alert_rule(rule_id: int):
+    rule = db.get_alert_rule(rule_id)
+    if rule is None:
+        return jsonify({'error': 'Rule not found'}), 404
+    enabled = (request.get_json(silent=True) or {}).get('enabled')
+    rule.enabled = (not rule.enabled) if enabled is None else bool(enabled)
+    db.update_alert_rule(rule)
+    rule_clock.invalidate()
+    return jsonify(rule_to_json(rule))
+
+@app.route('/api/alert-rules/<int:rule_id>', methods=['DELETE'])
+def api_delete_alert_rule(rule_id: int):
+    if not db.delete_alert_rule(rule_id):
+        return jsonify({'error': 'Rule not found'}), 404
+    rule_clock.invalidate()
+    return '', 204
+
+@app.route('/api/stream')
+def api_stream():
+    """Server-Sent Events: per-peer byte deltas and rates (`rates`) and session changes (`connection`)"""
+    subscription = broadcaster.subscribe()
+    return Response(broadcaster.stream(subscription), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
 def cleanup():
     """Stop the security monitoring thread when the application exits"""
     security_monitor.stop_monitoring_thread()
+    broadcaster.stop()
 
 if __name__ == '__main__':
     initialize_default_rules()
@@ -0,0 +1,266 @@
+"""Columnar Parquet archive of cold connection history
+
+Closed days of raw connection events are moved out of SQLite into one
+compressed Parquet file per day. Peer keys and other repetitive strings are
+dictionary-encoded and timestamps/ids delta-encoded, which brings the cost of
+an event down to a few bytes. Analytical queries read only the columns and the
+day files they need and push their filters down to the row groups.
+"""
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - the archive is optional
+    pa = None
+
+from models import WireGuardConnection
+
+logger = logging.getLogger('ConnectionArchive')
+
+class ConnectionArchive:
+    """Day-partitioned Parquet files holding archived connection events"""
+
+    FILE_PATTERN = re.compile(r'^connections_(\d{8})\.parquet$')
+    DICTIONARY_COLUMNS = ['peer_id', 'public_key', 'event_type', 'ip_address']
+    DELTA_COLUMNS = {'id': 'DELTA_BINARY_PACKED', 'timestamp': 'DELTA_BINARY_PACKED'}
+
+    def __init__(self, archive_dir: str, compression: str = 'zstd'):
+        if pa is None:
+            raise RuntimeError("The Parquet archive requires pyarrow (pip install pyarrow)")
+        self.archive_dir = archive_dir
+        self.compression = compression
+        os.makedirs(archive_dir, exist_ok=True)
+        self.schema = pa.schema([
+            ('id', pa.int64()),
+            ('peer_id', pa.string()),
+            ('public_key', pa.string()),
+            ('timestamp', pa.timestamp('us')),
+            ('event_type', pa.string()),
+            ('ip_address', pa.string()),
+            ('bytes_received', pa.int64()),
+            ('bytes_sent', pa.int64()),
+        ])
+
+    def _partition_path(self, day: datetime) -> str:
+        return os.path.join(self.archive_dir, f"connections_{day:%Y%m%d}.parquet")
+
+    def list_partitions(self, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
+        """Day files overlapping [start, end), oldest first"""
+        partitions = []
+        for name in os.listdir(self.archive_dir):
+            match = self.FILE_PATTERN.match(name)
+            if not match:
+                continue
+            day = datetime.strptime(match.group(1), '%Y%m%d')
+            if start is not None and day + timedelta(days=1) <= start:
+                continue
+            if end is not None and day >= end:
+                continue
+            partitions.append((day, os.path.join(self.archive_dir, name)))
+        return sorted(partitions)
+
+    def write_partition(self, day: datetime, connections: List[WireGuardConnection]) -> int:
+        """Write the events of one day, merging with an existing file for that day
+
+        Events whose id is already archived are skipped, so re-running an
+        interrupted archive pass does not duplicate rows. Returns the number
+        of events added.
+        """
+        path = self._partition_path(day)
+        table = pa.Table.from_pydict({
+            'id': [c.id for c in connections],
+            'peer_id': [c.peer_id for c in connections],
+            'public_key': [c.public_key for c in connections],
+            'timestamp': [c.timestamp for c in connections],
+            'event_type': [c.event_type for c in connections],
+            'ip_address': [c.ip_address or '' for c in connections],
+            'bytes_received': [c.bytes_received for c in connections],
+            'bytes_sent': [c.bytes_sent for c in connections],
+        }, schema=self.schema)
+
+        if os.path.exists(path):
+            existing = pq.read_table(path, schema=self.schema)
+            table = table.filter(pc.invert(pc.is_in(table['id'], value_set=existing['id'])))
+            added = table.num_rows
+            if not added:
+                return 0
+            table = pa.concat_tables([existing, table])
+        else:
+            added = table.num_rows
+
+        # Sorted timestamps give small deltas and tight row group statistics
+        table = table.sort_by([('timestamp', 'ascending'), ('id', 'ascending')])
+        tmp_path = f"{path}.tmp"
+        pq.write_table(
+            table, tmp_path,
+            compression=self.compression,
+            use_dictionary=self.DICTIONARY_COLUMNS,
+            column_encoding=self.DELTA_COLUMNS,
+            row_group_size=256 * 1024,
+        )
+        os.replace(tmp_path, path)
+        return added
+
+    def archive_before(self, db, before: datetime, pause: float = 0.05) -> int:
+        """Move every event older than `before` from the database to the archive
+
+        Events are archived up to `before` exactly, the same cutoff as
+        Database.compact(), so that compaction never drops an event that
+        was not archived. The day holding the cutoff is written in part and
+        completed by later passes; write_partition() skips the ids already
+        archived. Each day is written to Parquet before it is deleted from
+        SQLite. Returns the number of events archived.
+        """
+        oldest = db.get_oldest_connection_time()
+        if oldest is None:
+            return 0
+
+        archived = 0
+        day = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day < before:
+            end = min(day + timedelta(days=1), before)
+            connections = db.get_connections_between(day, end)
+            if connections:
+                archived += self.write_partition(day, connections)
+                db.delete_connections_between(day, end, pause=pause)
+                logger.info(f"Archived {len(connections)} events of {day:%Y-%m-%d} before {end:%H:%M:%S}")
+            day += timedelta(days=1)
+        return archived
+
+    def _dataset(self, start: Optional[datetime], end: Optional[datetime]):
+        paths = [path for _, path in self.list_partitions(start, end)]
+        if not paths:
+            return None
+        return ds.dataset(paths, schema=self.schema, format='parquet')
+
+    @staticmethod
+    def _time_filter(start: Optional[datetime], end: Optional[datetime]):
+        expression = None
+        for condition in (
+            pc.field('timestamp') >= pa.scalar(start, pa.timestamp('us')) if start else None,
+            pc.field('timestamp') < pa.scalar(end, pa.timestamp('us')) if end else None,
+        ):
+            if condition is not None:
+                expression = condition if expression is None else expression & condition
+        return expression
+
+    def bandwidth_usage(self, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None) -> List[Dict]:
+        """Per-peer transfer totals over archived events, shaped like Database.get_bandwidth_usage()"""
+        dataset = self._dataset(start, end)
+        if dataset is None:
+            return []
+
+        condition = pc.field('event_type') == 'transfer'
+        time_filter = self._time_filter(start, end)
+        if time_filter is not None:
+            condition = condition & time_filter
+        table = dataset.to_table(
+            columns=['peer_id', 'timestamp', 'bytes_sent', 'bytes_received'],
+            filter=condition,
+        )
+        if not table.num_rows:
+            return []
+
+        totals = table.group_by('peer_id').aggregate([
+            ('bytes_sent', 'sum'),
+            ('bytes_received', 'sum'),
+            ('timestamp', 'count'),
+            ('timestamp', 'min'),
+            ('timestamp', 'max'),
+        ])
+        usage = [{
+            'peer_id': row['peer_id'],
+            'total_bytes_sent': row['bytes_sent_sum'],
+            'total_bytes_received': row['bytes_received_sum'],
+            'connection_count': row['timestamp_count'],
+            'first_seen': row['timestamp_min'].isoformat(' '),
+            'last_seen': row['timestamp_max'].isoformat(' '),
+        } for row in totals.to_pylist()]
+        usage.sort(key=lambda row: row['total_bytes_sent'] + row['total_bytes_received'], reverse=True)
+        return usage
+
+    def monthly_usage(self, year: int, month: int) -> List[Dict]:
+        """Per-peer transfer totals of one calendar month"""
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        return self.bandwidth_usage(start, end)
+
+    def size(self) -> Tuple[int, int]:
+        """Number of archived events and bytes used on disk"""
+        events = 0
+        size = 0
+        for _, path in self.list_partitions():
+            events += pq.ParquetFile(path).metadata.num_rows
+            size += os.path.getsize(path)
+        return events, size
+
+def merge_usage(*sources: List[Dict]) -> List[Dict]:
+    """Combine per-peer bandwidth totals coming from several stores"""
+    merged: Dict[str, Dict] = {}
+    for usage in sources:
+        for row in usage:
+            total = merged.get(row['peer_id'])
+            if total is None:
+                merged[row['peer_id']] = dict(row)
+                continue
+            total['total_bytes_sent'] += row['total_bytes_sent']
+            total['total_bytes_received'] += row['total_bytes_received']
+            total['connection_count'] += row['connection_count']
+            total['first_seen'] = min(total['first_seen'], row['first_seen'])
+            total['last_seen'] = max(total['last_seen'], row['last_seen'])
+    return sorted(merged.values(),
+                  key=lambda row: row['total_bytes_sent'] + row['total_bytes_received'],
+                  reverse=True)
+
+def main():
+    import argparse
+    from database import Database
+    from models import RetentionPolicy
+
+    arg_parser = argparse.ArgumentParser(description="WireGuard Monitor Parquet archive")
+    arg_parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'wireguard_monitor.db'),
+                            help="Path to the SQLite database")
+    arg_parser.add_argument('--archive-dir', default=os.getenv('ARCHIVE_DIR', 'archive'),
+                            help="Directory of the Parquet files")
+    subcommands = arg_parser.add_subparsers(dest='command', required=True)
+    archive_command = subcommands.add_parser('archive', help="Move closed days out of SQLite")
+    archive_command.add_argument('--older-than', type=int, default=None,
+                                 help="Days of raw history kept in SQLite (default: RETENTION_RAW_DAYS)")
+    report_command = subcommands.add_parser('report', help="Monthly per-peer usage")
+    report_command.add_argument('month', help="Month as YYYY-MM")
+    subcommands.add_parser('stats', help="Archived events and size on disk")
+    args = arg_parser.parse_args()
+
+    archive = ConnectionArchive(args.archive_dir)
+    started = time.monotonic()
+    if args.command == 'archive':
+        days = args.older_than
+        if days is None:
+            days = RetentionPolicy.from_env().raw_days or 7
+        db = Database(args.db)
+        archived = archive.archive_before(db, datetime.now() - timedelta(days=days))
+        db.close()
+        print(f"Archived {archived} events in {time.monotonic() - started:.1f}s")
+    elif args.command == 'report':
+        month = datetime.strptime(args.month, '%Y-%m')
+        for row in archive.monthly_usage(month.year, month.month):
+            print(f"{row['peer_id']:<12} sent {row['total_bytes_sent']:>16,} B  "
+                  f"received {row['total_bytes_received']:>16,} B  "
+                  f"samples {row['connection_count']:>8,}")
+    else:
+        events, size = archive.size()
+        per_event = size / events if events else 0
+        print(f"{events:,} events in {size:,} bytes ({per_event:.1f} bytes/event)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Cache of dashboard query results and figures, keyed by data generation
+
+Every entry records the Database generation (Database.get_generation()) it
+was computed at and is only served while the generation is unchanged, so
+nothing is recomputed until new data is stored, and nothing stale is ever
+shown. Entries are evicted least recently used first once the cache holds
+more than max_entries entries or max_bytes estimated bytes. Concurrent
+requests for the same missing entry share a single computation. Cached
+values are shared between callers and must not be modified.
+"""
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from downsampling import DEFAULT_WIDTH
+from models import WireGuardConnection
+from utils import create_connection_timeline, create_traffic_graph
+
+logger = logging.getLogger('QueryCache')
+
+# Items measured when estimating the size of a long list
+SIZE_SAMPLE = 64
+
+def estimate_size(value: Any) -> int:
+    """Approximate memory footprint of a cached value, in bytes"""
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if hasattr(value, 'to_plotly_json'):
+        return estimate_size(value.to_plotly_json())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return sys.getsizeof(value)
+        sample = value[:SIZE_SAMPLE]
+        per_item = sum(estimate_size(item) for item in sample) / len(sample)
+        return sys.getsizeof(value) + int(per_item * len(value))
+    if hasattr(value, '__slots__'):
+        return sys.getsizeof(value) + sum(sys.getsizeof(getattr(value, name, None))
+                                          for name in value.__slots__)
+    return sys.getsizeof(value)
+
+class QueryCache:
+    """LRU cache of computed values that are valid for one data generation"""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (generation, value, size), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Any, int]]" = OrderedDict()
+        # key -> (generation, future) of the computations in progress
+        self._inflight: Dict[Hashable, Tuple[Any, Future]] = {}
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Requests that waited for another thread's computation
+        self.shared = 0
+
+    def get(self, key: Hashable, generation: Any, compute: Callable[[], Any]) -> Any:
+        """The value of key at generation, computing it with compute() when missing
+
+        Generations are increasing and comparable, usually Database.get_generation().
+
+        When another thread is already computing the same key at the same
+        generation, wait for its result instead. Errors are not cached and
+        are raised in every waiting thread.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            inflight = self._inflight.get(key)
+            if inflight is not None and inflight[0] == generation:
+                future = inflight[1]
+                owner = False
+                self.shared += 1
+            else:
+                future = Future()
+                self._inflight[key] = (generation, future)
+                owner = True
+                self.misses += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+            self._store(key, generation, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key, (None, None))[1] is future:
+                    del self._inflight[key]
+
+    def _store(self, key: Hashable, generation: Any, value: Any):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None:
+                if current[0] > generation:
+                    # A newer result landed meanwhile
+                    return
+                self.size -= current[2]
+            self._entries[key] = (generation, value, size)
+            self._entries.move_to_end(key)
+            self.size += size
+            while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses, 'shared': self.shared}
+
+# Shared by every dashboard session of the process
+default_cache = QueryCache()
+
+class ConnectionTail:
+    """The latest `limit` connections, refreshed with only the rows stored since the last call
+
+    Holds what Database.get_connections(limit) returns, newest first. New
+    rows are merged in only while the database's deletion counter is
+    unchanged: once rows were deleted, even alongside new ones, the whole
+    tail is reloaded, as it is after a burst of more than `limit` new rows
+    or a change that added nothing.
+    """
+
+    def __init__(self, db, limit: int = 1000):
+        self.db = db
+        self.limit = limit
+        self.rows: List[WireGuardConnection] = []
+        self.last_id = 0
+        self.deletions = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def refresh(self) -> List[WireGuardConnection]:
+        with self._lock:
+            new_rows = []
+            # Read first: a deletion racing with the queries below shows up next time
+            deletions = self.db.get_deletion_count()
+            if self._loaded and deletions == self.deletions:
+                while len(new_rows) <= self.limit:
+                    batch = self.db.get_connections_since(self.last_id, limit=self.limit)
+                    new_rows.extend(batch)
+                    if batch:
+                        self.last_id = batch[-1].id
+                    if len(batch) < self.limit:
+                        break
+
+            if new_rows and len(new_rows) <= self.limit:
+                merged = new_rows + self.rows
+                merged.sort(key=lambda c: (c.timestamp, c.id), reverse=True)
+                self.rows = merged[:self.limit]
+            else:
+                self.rows = self.db.get_connections(self.limit)
+                self.last_id = max((c.id for c in self.rows), default=0)
+                if new_rows:
+                    self.last_id = max(self.last_id, new_rows[-1].id)
+                self._loaded = True
+            self.deletions = deletions
+            # A new list each time: earlier results stay valid in the cache
+            return list(self.rows)
+
+class CachedQueries:
+    """The dashboard's database queries and figures, served from a QueryCache
+
+    Figures are built from the cached query results, so a new generation
+    costs one query and one figure build whatever the number of viewers.
+    """
+
+    def __init__(self, db, cache: Optional[QueryCache] = None):
+        self.db = db
+        self.cache = cache or default_cache
+        self._tails: Dict[int, ConnectionTail] = {}
+        self._tails_lock = threading.Lock()
+
+    def _get(self, name: str, params: tuple, compute: Callable[[], Any],
+             generation: Optional[Any] = None) -> Any:
+        if generation is None:
+            generation = self.db.get_generation()
+        return self.cache.get((self.db.db_path, name, params), generation, compute)
+
+    def _tail(self, limit: int) -> ConnectionTail:
+        with self._tails_lock:
+            tail = self._tails.get(limit)
+            if tail is None:
+                tail = self._tails[limit] = ConnectionTail(self.db, limit)
+            return tail
+
+    def get_connections(self, limit: int = 1000,
+                        generation: Optional[int] = None) -> List[WireGuardConnection]:
+        """The latest connections, fetching only the rows stored since the previous generation"""
+        return self._get('connections', (limit,), self._tail(limit).refresh, generation)
+
+    def get_active_connections(self) -> List[WireGuardConnection]:
+        return self._get('active_connections', (), self.db.get_active_connections)
+
+    def get_bandwidth_usage(self, time_range: str = 'day') -> List[Dict]:
+        # The range ends now: also refresh once a minute without new data
+        generation = (self.db.get_generation(), int(time.time() // 60))
+        return self._get('bandwidth_usage', (time_range,),
+                         lambda: self.db.get_bandwidth_usage(time_range), generation)
+
+    def connection_timeline(self, limit: int = 1000, width: int = DEFAULT_WIDTH):
+        generation = self.db.get_generation()
+        return self._get('connection_timeline', (limit, width), lambda: create_connection_timeline(
+            self.get_connections(limit, generation), width
+        ), generation)
+
+    def traffic_graph(self, limit: int = 1000, width: int = DEFAULT_WIDTH, method: str = 'lttb'):
+        generation = self.db.get_generation()
+        return self._get('traffic_graph', (limit, width, method), lambda: create_traffic_graph(
+            self.get_connections(limit, generation), width, method
+        ), generation)
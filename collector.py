@@ -0,0 +1,257 @@
+import argparse
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict, List, Optional, TextIO, Tuple
+from database import Database, ConnectionWriter, CompactionJob
+from log_parser import (WireGuardLogParser, JournalFollower, DUMP_BACKENDS,
+                        create_dump_backend, record_dump)
+from models import WireGuardConnection
+from security_monitor import SecurityMonitor
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('WireGuardCollector')
+
+class WireGuardCollector:
+    """Poll the peer counters on a fixed cadence and store per-interval byte deltas
+
+    The counters come from the parser's dump backend: `wg show all dump` by
+    default, netlink, or a replay of recorded dumps. With a record file
+    every poll is also appended to it, for ReplayDumpBackend.
+    """
+
+    def __init__(self, db: Database, parser: WireGuardLogParser = None,
+                 interval: float = 10.0, sudo: bool = False, record: Optional[TextIO] = None):
+        self.db = db
+        self.parser = parser or WireGuardLogParser()
+        self.interval = interval
+        self.sudo = sudo
+        self.record = record
+
+        # Last cumulative (rx, tx) counters seen per public key
+        self.last_seen: Dict[str, Tuple[int, int]] = {}
+
+        self.collector_thread = None
+        self.stop_event = threading.Event()
+
+        logger.info(f"Collector initialized with a {interval}s polling interval")
+
+    def compute_deltas(self, samples: List[WireGuardConnection]) -> List[WireGuardConnection]:
+        """Turn cumulative wg counters into byte deltas since the previous poll"""
+        deltas = []
+        for sample in samples:
+            previous = self.last_seen.get(sample.public_key)
+            self.last_seen[sample.public_key] = (sample.bytes_received, sample.bytes_sent)
+
+            # The first sighting of a peer only establishes its baseline
+            if previous is None:
+                continue
+
+            last_rx, last_tx = previous
+            if sample.bytes_received < last_rx or sample.bytes_sent < last_tx:
+                # Counters went backwards: the interface was restarted, so
+                # everything counted since then is new traffic
+                rx, tx = sample.bytes_received, sample.bytes_sent
+            else:
+                rx, tx = sample.bytes_received - last_rx, sample.bytes_sent - last_tx
+
+            if rx == 0 and tx == 0:
+                continue
+
+            deltas.append(WireGuardConnection(
+                id=0,
+                peer_id=sample.peer_id,
+                public_key=sample.public_key,
+                timestamp=sample.timestamp,
+                event_type='transfer',
+                ip_address=sample.ip_address,
+                bytes_received=rx,
+                bytes_sent=tx
+            ))
+
+        # Forget peers that were removed from the interface
+        if samples:
+            current_keys = {sample.public_key for sample in samples}
+            for public_key in list(self.last_seen):
+                if public_key not in current_keys:
+                    del self.last_seen[public_key]
+
+        return deltas
+
+    def poll(self) -> int:
+        """Take one sample and write its deltas as a single transaction"""
+        samples = self.parser.get_wg_dump(sudo=self.sudo)
+        if self.record:
+            record_dump(self.record, samples)
+        deltas = self.compute_deltas(samples)
+        if deltas:
+            self.db.add_connections(deltas)
+        logger.debug(f"Poll stored {len(deltas)} transfer deltas for {len(samples)} peers")
+        return len(deltas)
+
+    def run(self):
+        """Poll until stopped, keeping a fixed cadence regardless of poll duration"""
+        logger.info("Starting collector loop")
+        next_poll = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Error in collector poll: {str(e)}")
+
+            next_poll += self.interval
+            delay = next_poll - time.monotonic()
+            if delay < 0:
+                logger.warning(f"Collector fell {-delay:.1f}s behind schedule, skipping missed polls")
+                next_poll = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+        logger.info("Collector loop stopped")
+
+    def start(self):
+        """Run the collector in a background thread"""
+        if self.collector_thread is None or not self.collector_thread.is_alive():
+            self.stop_event.clear()
+            self.collector_thread = threading.Thread(target=self.run, daemon=True)
+            self.collector_thread.start()
+
+    def stop(self):
+        """Stop the collector loop"""
+        self.stop_event.set()
+        if self.collector_thread:
+            self.collector_thread.join(timeout=self.interval + 2.0)
+
+def ingest_journal(follower: JournalFollower, writer: ConnectionWriter, stop_event: threading.Event,
+                   min_delay: float = 1.0, max_delay: float = 60.0):
+    """Stream journald events into the database through the write-behind buffer
+
+    journalctl is restarted whenever it exits or ingestion fails, after a
+    delay doubling from min_delay up to max_delay; a follower that ran for
+    max_delay resets it. The follower resumes from its saved cursor.
+    """
+    delay = min_delay
+    while not stop_event.is_set() and not follower.stopping:
+        started = time.monotonic()
+        try:
+            for connection in follower.follow():
+                writer.add(connection)
+        except Exception as e:
+            logger.error(f"Journal ingestion failed: {str(e)}")
+        if stop_event.is_set() or follower.stopping:
+            break
+
+        if time.monotonic() - started >= max_delay:
+            delay = min_delay
+        logger.warning(f"Restarting journal ingestion in {delay:.1f}s")
+        stop_event.wait(delay)
+        delay = min(delay * 2, max_delay)
+    logger.info("Journal ingestion stopped")
+
+def ingest_log_files(parser: WireGuardLogParser, writer: ConnectionWriter, stop_event: threading.Event,
+                     interval: float):
+    """Store the connection events appended to the WireGuard log file, every interval seconds
+
+    Only the lines written since the previous read are parsed; the read
+    position is kept in the parser's checkpoints across restarts and
+    log rotations.
+    """
+    while not stop_event.is_set():
+        try:
+            lines, _ = parser.read_log_file(incremental=True)
+            connections = list(parser.parse_lines(lines))
+            if connections:
+                writer.add_many(connections)
+        except Exception as e:
+            logger.error(f"Log file ingestion failed: {str(e)}")
+        stop_event.wait(interval)
+    logger.info("Log file ingestion stopped")
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="WireGuard traffic collector")
+    arg_parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'wireguard_monitor.db'),
+                            help="Path to the SQLite database")
+    arg_parser.add_argument('--interval', type=float,
+                            default=float(os.getenv('COLLECTOR_INTERVAL', '10')),
+                            help="Polling interval in seconds")
+    arg_parser.add_argument('--sudo', action='store_true',
+                            help="Fall back to `sudo wg` when `wg` is not permitted")
+    arg_parser.add_argument('--backend', choices=DUMP_BACKENDS,
+                            default=os.getenv('WG_BACKEND', 'subprocess'),
+                            help="Source of the peer counters: the wg command, netlink or recorded dumps")
+    arg_parser.add_argument('--replay', default=os.getenv('WG_REPLAY_FILE'),
+                            help="File of recorded dumps read by the replay backend")
+    arg_parser.add_argument('--record',
+                            help="Append every poll to this file, for the replay backend")
+    # Both read the same events when journald forwards to syslog
+    events = arg_parser.add_mutually_exclusive_group()
+    events.add_argument('--journal', action='store_true',
+                        help="Also ingest connection events from journald")
+    events.add_argument('--logs', action='store_true',
+                        help="Also ingest connection events appended to the WireGuard log files")
+    arg_parser.add_argument('--compact-every', type=float,
+                            default=float(os.getenv('COMPACTION_INTERVAL_HOURS', '6')),
+                            help="Hours between two retention/compaction runs (0 disables)")
+    arg_parser.add_argument('--monitor', action='store_true',
+                            help="Evaluate alert rules in this process, on samples handed over as they are stored")
+    args = arg_parser.parse_args()
+
+    db = Database(args.db)
+    backend = create_dump_backend(args.backend, sudo=args.sudo, replay_path=args.replay)
+    record = open(args.record, 'a', buffering=1) if args.record else None
+    collector = WireGuardCollector(db, WireGuardLogParser(dump_backend=backend),
+                                   interval=args.interval, sudo=args.sudo, record=record)
+
+    compaction = None
+    if args.compact_every > 0:
+        compaction = CompactionJob(db, interval=args.compact_every * 3600)
+        compaction.start()
+
+    monitor = None
+    if args.monitor:
+        monitor = SecurityMonitor(db)
+        monitor.recent.attach(db)
+        monitor.start_monitoring()
+
+    follower = writer = log_thread = None
+    if args.journal or args.logs:
+        writer = ConnectionWriter(db)
+        writer.start()
+    if args.journal:
+        follower = JournalFollower(collector.parser)
+        threading.Thread(target=ingest_journal, args=(follower, writer, collector.stop_event),
+                         daemon=True).start()
+    if args.logs:
+        log_thread = threading.Thread(target=ingest_log_files,
+                                      args=(collector.parser, writer, collector.stop_event, args.interval),
+                                      daemon=True)
+        log_thread.start()
+
+    def handle_signal(signum, frame):
+        collector.stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    collector.run()
+
+    if monitor:
+        monitor.stop_monitoring_thread()
+    if compaction:
+        compaction.stop()
+    if follower:
+        follower.stop()
+    if log_thread:
+        log_thread.join(timeout=args.interval + 2.0)
+    if writer:
+        writer.stop()
+    backend.close()
+    if record:
+        record.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,335 @@
+import heapq
+import itertools
+import logging
+import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Optional
-from models import WireGuardConnection, AlertRule
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable, List, Dict, Optional, Iterator, Iterable, Tuple
+from models import WireGuardConnection, AlertRule, RetentionPolicy, CompactionReport
+
+# Configure logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('Database')
 
 class Database:
-    def __init__(self, db_path: str = "wireguard_monitor.db"):
+    # Applied to every connection when it is opened. WAL lets the dashboard
+    # read while the collector and monitor write.
+    PRAGMAS = {
+        # Only effective when the database file is created (or vacuumed)
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -20000,  # in KiB, ~20 MB per connection
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # in milliseconds
+    }
+
+    # Per-peer bandwidth rollups maintained at ingest time, finest first:
+    # granularity -> (table, SQLite strftime format of the bucket start)
+    ROLLUPS = {
+        'minute': ('bandwidth_minute', '%Y-%m-%d %H:%M:00'),
+        'hour': ('bandwidth_hour', '%Y-%m-%d %H:00:00'),
+        'day': ('bandwidth_day', '%Y-%m-%d 00:00:00'),
+    }
+
+    # get_bandwidth_usage() ranges: the coarsest rollup fitting the range and
+    # how far back the range reaches
+    TIME_RANGES = {
+        'hour': ('minute', timedelta(hours=1)),
+        'day': ('hour', timedelta(days=1)),
+        'week': ('hour', timedelta(days=7)),
+        'month': ('day', timedelta(days=30)),
+        'all': ('day', None),
+    }
+
+    # Time-partitioned storage of raw connections: period -> shard length
+    SHARD_PERIODS = {
+        'day': timedelta(days=1),
+        'week': timedelta(days=7),
+    }
+    SHARD_FILE_PATTERN = re.compile(r'^connections_(day|week)_(\d{8})\.db$')
+    # SQLite allows 10 attached databases per connection by default
+    MAX_ATTACHED_SHARDS = 8
+    # Past this many addresses under an IP prefix, a page is read from the
+    # time index instead of merging one idx_ip_timestamp range per address
+    MAX_PREFIX_ADDRESSES = 64
+
+    def __init__(self, db_path: str = "wireguard_monitor.db", shard_dir: Optional[str] = None,
+                 shard_period: Optional[str] = None, archive_dir: Optional[str] = None):
+        """Open the database
+
+        With a shard directory (argument or SHARD_DIR), raw connection events
+        are stored in one SQLite file per day or week (SHARD_PERIOD) that is
+        attached on demand; rollups, peer state and rules stay in db_path.
+        Rows already in db_path's connections table remain readable.
+
+        With an archive directory (argument or ARCHIVE_DIR), history moved to
+        Parquet is included in get_bandwidth_usage('all').
+        """
         self.db_path = db_path
+        self.shard_dir = shard_dir or os.getenv('SHARD_DIR') or None
+        self.shard_period = shard_period or os.getenv('SHARD_PERIOD', 'day')
+        if self.shard_period not in self.SHARD_PERIODS:
+            raise ValueError(f"Unknown shard period: {self.shard_period}")
+        if self.shard_dir:
+            os.makedirs(self.shard_dir, exist_ok=True)
+        # Bumped whenever a shard file is dropped, so that other threads
+        # detach their stale handles to it
+        self._shard_epoch = 0
+        self._has_legacy_rows = True
+
+        # Called with every committed batch, see add_listener()
+        self._listeners: List[Callable[[List[WireGuardConnection]], None]] = []
+        # Rule changes made through this instance; data_version() does not
+        # see commits of the connection it is read from
+        self.rule_changes = 0
+
+        self.archive = None
+        archive_dir = archive_dir or os.getenv('ARCHIVE_DIR') or None
+        if archive_dir:
+            from archive import ConnectionArchive
+            self.archive = ConnectionArchive(archive_dir)
+
+        self._local = threading.local()
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._connections_lock = threading.Lock()
         self.init_db()
 
+    def get_connection(self) -> sqlite3.Connection:
+        """Return the calling thread's long-lived connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        # Autocommit mode: transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        self._local.conn = conn
+        self._local.attached = OrderedDict()
+        self._local.shard_epoch = self._shard_epoch
+
+        with self._connections_lock:
+            # Close connections left behind by threads that have exited
+            for thread in [t for t in self._connections if not t.is_alive()]:
+                self._connections.pop(thread).close()
+            self._connections[threading.current_thread()] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run the enclosed statements in one write transaction
+
+        The write lock is taken up front (BEGIN IMMEDIATE) so concurrent
+        writers wait on busy_timeout instead of failing on lock upgrade.
+        Nested uses join the outermost transaction.
+        """
+        conn = self.get_connection()
+        if conn.in_transaction:
+            yield conn
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def close(self):
+        """Close every connection opened by this instance"""
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _shard_key(self, timestamp: datetime) -> str:
+        start = timestamp.date()
+        if self.shard_period == 'week':
+            start -= timedelta(days=start.weekday())
+        return f"{self.shard_period}_{start.strftime('%Y%m%d')}"
+
+    def _shard_path(self, key: str) -> str:
+        return os.path.join(self.shard_dir, f"connections_{key}.db")
+
+    def _list_shards(self, start: Optional[datetime] = None,
+                     end: Optional[datetime] = None) -> List[Tuple[datetime, datetime, str]]:
+        """(start, end, key) of the shard files overlapping [start, end), oldest first"""
+        shards = []
+        for name in os.listdir(self.shard_dir):
+            match = self.SHARD_FILE_PATTERN.match(name)
+            if not match:
+                continue
+            period, day = match.groups()
+            shard_start = datetime.strptime(day, '%Y%m%d')
+            shard_end = shard_start + self.SHARD_PERIODS[period]
+            if (start is None or shard_end > start) and (end is None or shard_start < end):
+                shards.append((shard_start, shard_end, f"{period}_{day}"))
+        return sorted(shards)
+
+    def _attach_shard(self, key: str, create: bool = False) -> Optional[str]:
+        """Attach a shard to this thread's connection and return its schema name
+
+        Returns None when the shard does not exist and create is False. The
+        least recently used shard is detached once MAX_ATTACHED_SHARDS are
+        attached. ATTACH is not allowed inside a transaction, so writers
+        attach their shards before opening one.
+        """
+        conn = self.get_connection()
+        attached = self._local.attached
+        if self._local.shard_epoch != self._shard_epoch:
+            for stale in list(attached.values()):
+                conn.execute(f"DETACH DATABASE {stale}")
+            attached.clear()
+            self._local.shard_epoch = self._shard_epoch
+
+        schema = f"shard_{key}"
+        if key in attached:
+            attached.move_to_end(key)
+            return schema
+        path = self._shard_path(key)
+        if not create and not os.path.exists(path):
+            return None
+
+        while len(attached) >= self.MAX_ATTACHED_SHARDS:
+            _, oldest = attached.popitem(last=False)
+            conn.execute(f"DETACH DATABASE {oldest}")
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+        conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+        conn.execute(f"PRAGMA {schema}.synchronous=NORMAL")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema}.connections (
+                id INTEGER PRIMARY KEY,
+                peer_id TEXT NOT NULL,
+                public_key TEXT NOT NULL,
+                timestamp DATETIME NOT NULL,
+                event_type TEXT NOT NULL,
+                ip_address TEXT NOT NULL,
+                bytes_received INTEGER DEFAULT 0,
+                bytes_sent INTEGER DEFAULT 0
+            )
+        """)
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {schema}.idx_connections_timestamp
+            ON connections(timestamp)
+        """)
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {schema}.idx_peer_timestamp
+            ON connections(peer_id, timestamp)
+        """)
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {schema}.idx_event_timestamp
+            ON connections(event_type, timestamp)
+        """)
+        conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {schema}.idx_ip_timestamp
+            ON connections(ip_address, timestamp, id)
+        """)
+        attached[key] = schema
+        return schema
+
+    def _drop_shard(self, key: str) -> Tuple[int, int]:
+        """Delete a shard file; returns the rows and bytes it held"""
+        path = self._shard_path(key)
+        reader = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = reader.execute("SELECT COUNT(*) FROM connections").fetchone()[0]
+        finally:
+            reader.close()
+
+        attached = getattr(self._local, 'attached', {})
+        if key in attached:
+            self.get_connection().execute(f"DETACH DATABASE {attached.pop(key)}")
+        self._shard_epoch += 1
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM shard_max_id WHERE key = ?", (key,))
+
+        size = 0
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                size += os.path.getsize(path + suffix)
+                os.unlink(path + suffix)
+            except FileNotFoundError:
+                pass
+        logger.info(f"Dropped shard {key} ({rows:,} rows, {size:,} bytes)")
+        return rows, size
+
+    def _backfill_shard_max_ids(self):
+        """Record the highest id of shard files written before shard_max_id existed"""
+        conn = self.get_connection()
+        known = {row[0] for row in conn.execute("SELECT key FROM shard_max_id")}
+        for _, _, key in self._list_shards():
+            if key in known:
+                continue
+            reader = sqlite3.connect(f"file:{self._shard_path(key)}?mode=ro", uri=True)
+            try:
+                max_id = reader.execute("SELECT MAX(id) FROM connections").fetchone()[0]
+            except sqlite3.OperationalError:
+                # Created but never written to
+                max_id = None
+            finally:
+                reader.close()
+            with self.transaction() as tx:
+                tx.execute("""
+                    INSERT INTO shard_max_id (key, max_id) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET max_id = MAX(max_id, excluded.max_id)
+                """, (key, max_id or 0))
+
+    def _iter_shard_history(self) -> Iterator[WireGuardConnection]:
+        """Every event stored in shards, in id order"""
+        readers = []
+        try:
+            streams = []
+            for _, _, key in self._list_shards():
+                reader = sqlite3.connect(f"file:{self._shard_path(key)}?mode=ro", uri=True)
+                reader.row_factory = sqlite3.Row
+                readers.append(reader)
+                rows = reader.execute("SELECT * FROM connections ORDER BY id")
+                streams.append(map(self._row_to_connection, rows))
+            yield from heapq.merge(*streams, key=lambda connection: connection.id)
+        finally:
+            for reader in readers:
+                reader.close()
+
+    @staticmethod
+    def _chunks(connections: Iterable[WireGuardConnection],
+                size: int = 10000) -> Iterator[List[WireGuardConnection]]:
+        iterator = iter(connections)
+        while True:
+            chunk = list(islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def _row_to_connection(row: sqlite3.Row) -> WireGuardConnection:
+        return WireGuardConnection(
+            id=row['id'],
+            peer_id=row['peer_id'],
+            public_key=row['public_key'],
+            timestamp=datetime.fromisoformat(row['timestamp']),
+            event_type=row['event_type'],
+            ip_address=row['ip_address'],
+            bytes_received=row['bytes_received'],
+            bytes_sent=row['bytes_sent']
+        )
+
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             # Existing connections table
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS connections (
@@ -36,7 +356,82 @@ class Database:
                     action TEXT NOT NULL,
                     enabled BOOLEAN NOT NULL DEFAULT 1,
                     last_triggered DATETIME,
-                    description TEXT
+                    description TEXT,
+                    scope TEXT NOT NULL DEFAULT 'global'
+                )
+            """)
+            rule_columns = {row['name'] for row in conn.execute("PRAGMA table_info(alert_rules)")}
+            if 'scope' not in rule_columns:
+                conn.execute("ALTER TABLE alert_rules ADD COLUMN scope TEXT NOT NULL DEFAULT 'global'")
+
+            # Bumped by every change to the rule definitions, so that rule
+            # caches can tell when to reload
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rule_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    version INTEGER NOT NULL
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO rule_version (id, version) VALUES (0, 0)")
+
+            # Bumped by every write to the connection data (ingest, deletion,
+            # rebuilds), so that cached query results can tell they are stale
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS data_generation (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    generation INTEGER NOT NULL
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO data_generation (id, generation) VALUES (0, 0)")
+
+            # Time before which raw events were deleted (compaction, archive);
+            # NULL while the raw history is complete. Rebuilds from raw rows
+            # must not reach back past it.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS raw_history (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    start DATETIME
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO raw_history (id, start) VALUES (0, NULL)")
+
+            # Bumped by every deletion of raw events, so that readers merging
+            # new rows into a cached copy can tell it also lost some
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS connection_deletions (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    deletions INTEGER NOT NULL
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO connection_deletions (id, deletions) VALUES (0, 0)")
+            
+            # Bandwidth rollups, one row per bucket and peer
+            for table, _ in self.ROLLUPS.values():
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        bucket DATETIME NOT NULL,
+                        peer_id TEXT NOT NULL,
+                        bytes_sent INTEGER NOT NULL DEFAULT 0,
+                        bytes_received INTEGER NOT NULL DEFAULT 0,
+                        sample_count INTEGER NOT NULL DEFAULT 0,
+                        first_seen DATETIME NOT NULL,
+                        last_seen DATETIME NOT NULL,
+                        PRIMARY KEY (bucket, peer_id)
+                    ) WITHOUT ROWID
+                """)
+            
+            # Current state of every peer, maintained at ingest time
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS peer_state (
+                    peer_id TEXT PRIMARY KEY,
+                    public_key TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'unknown',
+                    since DATETIME,
+                    connect_id INTEGER,
+                    last_endpoint TEXT,
+                    last_handshake DATETIME NOT NULL,
+                    total_bytes_received INTEGER NOT NULL DEFAULT 0,
+                    total_bytes_sent INTEGER NOT NULL DEFAULT 0
                 )
             """)
             
@@ -45,15 +440,300 @@ class Database:
                 CREATE INDEX IF NOT EXISTS idx_peer_timestamp 
                 ON connections(peer_id, timestamp)
             """)
-            conn.commit()
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_peer_state_status
+                ON peer_state(status)
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_connections_timestamp
+                ON connections(timestamp)
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_event_timestamp
+                ON connections(event_type, timestamp)
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_ip_timestamp
+                ON connections(ip_address, timestamp, id)
+            """)
 
-    def add_connection(self, connection: WireGuardConnection):
-        with sqlite3.connect(self.db_path) as conn:
+            # Id allocator of sharded connections, continuing after the ids
+            # of the connections table
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shard_sequence (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    last_id INTEGER NOT NULL
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO shard_sequence (id, last_id) VALUES (0, 0)")
+            conn.execute("""
+                UPDATE shard_sequence
+                SET last_id = MAX(last_id, (SELECT COALESCE(MAX(id), 0) FROM connections))
+            """)
+            # Highest id written to each shard, so that readers tailing new
+            # ids only attach the shards that received some
             conn.execute("""
+                CREATE TABLE IF NOT EXISTS shard_max_id (
+                    key TEXT PRIMARY KEY,
+                    max_id INTEGER NOT NULL
+                )
+            """)
+
+            self._has_legacy_rows = conn.execute("SELECT 1 FROM connections LIMIT 1").fetchone() is not None
+            rollups_empty = conn.execute("SELECT 1 FROM bandwidth_day LIMIT 1").fetchone() is None
+            peer_state_empty = conn.execute("SELECT 1 FROM peer_state LIMIT 1").fetchone() is None
+
+        if self.shard_dir:
+            self._backfill_shard_max_ids()
+
+        # Backfill the derived tables of a database created before they existed
+        if rollups_empty and self._has_legacy_rows:
+            self.rebuild_rollups()
+        if peer_state_empty and self._has_legacy_rows:
+            self.rebuild_peer_state()
+
+    def compact(self, policy: RetentionPolicy = None, batch_size: int = 5000,
+                pause: float = 0.05, now: Optional[datetime] = None) -> CompactionReport:
+        """Delete data past its retention and return the freed pages to the OS
+
+        Rows are deleted in small transactions with a short pause in between,
+        so the write lock is never held for long and the collector keeps
+        writing during compaction. Raw events are only dropped once they are
+        folded into the minute rollups, which happens at ingest time. With an
+        archive, expired raw events are moved to it up to the same cutoff
+        instead of being dropped.
+        """
+        policy = policy or RetentionPolicy.from_env()
+        now = now or datetime.now()
+        started = time.monotonic()
+        report = CompactionReport()
+        conn = self.get_connection()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+
+        if policy.raw_days is not None:
+            cutoff = now - timedelta(days=policy.raw_days)
+            if self.archive:
+                report.rows_deleted['connections_archived'] = self.archive.archive_before(self, cutoff, pause)
+            deleted, dropped_bytes = self.delete_connections_between(
+                datetime.min, cutoff, batch_size, pause
+            )
+            report.rows_deleted['connections'] = deleted
+            report.bytes_reclaimed += dropped_bytes
+
+        # rollup table -> days kept
+        tiers = {
+            'bandwidth_minute': policy.minute_days,
+            'bandwidth_hour': policy.hour_days,
+            'bandwidth_day': policy.day_days,
+        }
+        for table, days in tiers.items():
+            if days is None:
+                continue
+            cutoff = now - timedelta(days=days)
+            deleted = 0
+            while True:
+                with self.transaction() as tx:
+                    cursor = tx.execute(f"""
+                        DELETE FROM {table} WHERE (bucket, peer_id) IN (
+                            SELECT bucket, peer_id FROM {table} WHERE bucket < ? LIMIT ?
+                        )
+                    """, (cutoff, batch_size))
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    break
+                time.sleep(pause)
+            report.rows_deleted[table] = deleted
+            if deleted:
+                with self.transaction() as tx:
+                    self._bump_generation(tx)
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # Release free pages a chunk at a time for the same reason
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free_pages:
+                # execute() steps a result-less statement only once, which
+                # would release a single page; executescript() runs it through
+                conn.executescript(f"PRAGMA incremental_vacuum({batch_size})")
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+                time.sleep(pause)
+        elif conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            logger.info("Freed pages are kept for reuse; run `python database.py vacuum` "
+                        "once to enable incremental vacuum on this database")
+
+        pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        report.bytes_reclaimed += (pages_before - pages_after) * page_size
+        report.seconds = time.monotonic() - started
+        logger.info(f"Compaction {report.summary()}")
+        return report
+
+    def delete_connections_between(self, start: datetime, end: datetime, batch_size: int = 5000,
+                                   pause: float = 0.05) -> Tuple[int, int]:
+        """Delete raw events with start <= timestamp < end
+
+        Shards lying entirely inside the window are unlinked; other rows are
+        deleted in small transactions. Returns the number of rows deleted and
+        the bytes freed by unlinked shard files.
+        """
+        deleted = 0
+        dropped_bytes = 0
+        if self.shard_dir:
+            for shard_start, shard_end, key in self._list_shards(start, end):
+                if shard_start >= start and shard_end <= end:
+                    rows, size = self._drop_shard(key)
+                    deleted += rows
+                    dropped_bytes += size
+                else:
+                    schema = self._attach_shard(key)
+                    if schema:
+                        deleted += self._delete_in_batches(schema, start, end, batch_size, pause)
+
+        if not self.shard_dir or self._has_legacy_rows:
+            deleted += self._delete_in_batches('main', start, end, batch_size, pause)
+            self._has_legacy_rows = self.get_connection().execute(
+                "SELECT 1 FROM connections LIMIT 1").fetchone() is not None
+        if deleted or dropped_bytes:
+            with self.transaction() as conn:
+                conn.execute("UPDATE raw_history SET start = MAX(COALESCE(start, ?), ?)", (end, end))
+                conn.execute("UPDATE connection_deletions SET deletions = deletions + 1")
+                self._bump_generation(conn)
+        return deleted, dropped_bytes
+
+    def _delete_in_batches(self, schema: str, start: datetime, end: datetime,
+                           batch_size: int, pause: float) -> int:
+        deleted = 0
+        while True:
+            with self.transaction() as tx:
+                cursor = tx.execute(f"""
+                    DELETE FROM {schema}.connections WHERE id IN (
+                        SELECT id FROM {schema}.connections
+                        WHERE timestamp >= ? AND timestamp < ? LIMIT ?
+                    )
+                """, (start, end, batch_size))
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
+            time.sleep(pause)
+
+    def _bump_generation(self, conn: sqlite3.Connection):
+        conn.execute("UPDATE data_generation SET generation = generation + 1")
+
+    def get_generation(self) -> int:
+        """Counter of writes to the connection data, shared by every process using the database
+
+        Query results computed at one generation remain valid for as long
+        as the generation does not change.
+        """
+        row = self.get_connection().execute("SELECT generation FROM data_generation").fetchone()
+        return row['generation']
+
+    def get_deletion_count(self) -> int:
+        """Counter of deletions of raw events, shared by every process using the database"""
+        row = self.get_connection().execute("SELECT deletions FROM connection_deletions").fetchone()
+        return row['deletions']
+
+    def get_raw_history_start(self) -> Optional[datetime]:
+        """Time before which raw events were deleted, None while the raw history is complete
+
+        The rollups and peer_state still account for the deleted events, so
+        they cannot be recomputed from the raw rows before that time.
+        """
+        conn = self.get_connection()
+        recorded = conn.execute("SELECT start FROM raw_history").fetchone()[0]
+        if recorded:
+            return datetime.fromisoformat(recorded)
+        # Databases compacted before deletions were recorded: rollups older than any raw event
+        first_seen = conn.execute("SELECT MIN(first_seen) FROM bandwidth_day").fetchone()[0]
+        oldest = self.get_oldest_connection_time()
+        if first_seen and (oldest is None or datetime.fromisoformat(first_seen) < oldest):
+            return oldest or datetime.now()
+        return None
+
+    def get_oldest_connection_time(self) -> Optional[datetime]:
+        """Timestamp of the oldest raw event still stored"""
+        conn = self.get_connection()
+        candidates = []
+        if not self.shard_dir or self._has_legacy_rows:
+            candidates.append(conn.execute("SELECT MIN(timestamp) FROM connections").fetchone()[0])
+        if self.shard_dir:
+            for _, _, key in self._list_shards():
+                schema = self._attach_shard(key)
+                oldest = schema and conn.execute(
+                    f"SELECT MIN(timestamp) FROM {schema}.connections").fetchone()[0]
+                if oldest:
+                    candidates.append(oldest)
+                    break
+        candidates = [datetime.fromisoformat(value) for value in candidates if value]
+        return min(candidates) if candidates else None
+
+    def max_connection_id(self) -> int:
+        """Highest id given to an event so far, 0 before the first one
+
+        Ids follow the order events were stored in, not their timestamps:
+        this is where a reader of get_connections_since() starts from to
+        only see what is stored next.
+        """
+        conn = self.get_connection()
+        if self.shard_dir:
+            # Allocated past the ids of the connections table too
+            return conn.execute("SELECT last_id FROM shard_sequence").fetchone()[0]
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM connections").fetchone()[0]
+
+    def vacuum(self):
+        """Rewrite the whole file, switching it to incremental auto-vacuum
+
+        Takes an exclusive lock for the duration; meant to be run once by hand.
+        """
+        conn = self.get_connection()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+    def add_connection(self, connection: WireGuardConnection):
+        self.add_connections([connection])
+
+    def add_connections(self, connections: List[WireGuardConnection]):
+        """Insert a batch of connection events in a single transaction
+
+        The rollups and peer_state are updated in the same transaction, and
+        the id of each stored row is written back to its connection.
+        """
+        if not connections:
+            return
+        if self.shard_dir:
+            self._add_sharded_connections(connections)
+        else:
+            self._add_main_connections(connections)
+        self._notify_listeners(connections)
+
+    def add_listener(self, callback: Callable[[List[WireGuardConnection]], None]):
+        """Call callback with each batch once it is committed, ids included
+
+        Callbacks run on the writing thread and must be quick; errors are
+        logged and do not affect the write.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[List[WireGuardConnection]], None]):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify_listeners(self, connections: List[WireGuardConnection]):
+        for callback in list(self._listeners):
+            try:
+                callback(connections)
+            except Exception as e:
+                logger.error(f"Error in connection listener: {str(e)}")
+
+    def _add_main_connections(self, connections: List[WireGuardConnection]):
+        with self.transaction() as conn:
+            conn.executemany("""
                 INSERT INTO connections 
                 (peer_id, public_key, timestamp, event_type, ip_address, bytes_received, bytes_sent)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
+            """, [(
                 connection.peer_id,
                 connection.public_key,
                 connection.timestamp,
@@ -61,97 +741,534 @@ class Database:
                 connection.ip_address,
                 connection.bytes_received,
                 connection.bytes_sent
-            ))
-            conn.commit()
+            ) for connection in connections])
+
+            # Rows inserted by a single writer get consecutive ids
+            last_id = conn.execute("SELECT MAX(id) FROM connections").fetchone()[0]
+            for offset, connection in enumerate(connections, start=last_id - len(connections) + 1):
+                connection.id = offset
+
+            self._update_rollups(conn, connections)
+            self._update_peer_state(conn, connections)
+            self._bump_generation(conn)
+
+    def _add_sharded_connections(self, connections: List[WireGuardConnection]):
+        """Route a batch to the shards covering its timestamps"""
+        groups: Dict[str, List[WireGuardConnection]] = {}
+        for connection in connections:
+            groups.setdefault(self._shard_key(connection.timestamp), []).append(connection)
+
+        keys = list(groups)
+        if len(keys) > self.MAX_ATTACHED_SHARDS:
+            # A backfill spanning many periods: one transaction per group of shards
+            for i in range(0, len(keys), self.MAX_ATTACHED_SHARDS):
+                self._add_sharded_connections(
+                    [c for key in keys[i:i + self.MAX_ATTACHED_SHARDS] for c in groups[key]]
+                )
+            return
+
+        schemas = {key: self._attach_shard(key, create=True) for key in keys}
+        with self.transaction() as conn:
+            last_id = conn.execute(
+                "UPDATE shard_sequence SET last_id = last_id + ? RETURNING last_id",
+                (len(connections),)
+            ).fetchall()[0][0]
+            for offset, connection in enumerate(connections, start=last_id - len(connections) + 1):
+                connection.id = offset
+
+            for key, rows in groups.items():
+                conn.executemany(f"""
+                    INSERT INTO {schemas[key]}.connections
+                    (id, peer_id, public_key, timestamp, event_type, ip_address, bytes_received, bytes_sent)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(
+                    connection.id,
+                    connection.peer_id,
+                    connection.public_key,
+                    connection.timestamp,
+                    connection.event_type,
+                    connection.ip_address,
+                    connection.bytes_received,
+                    connection.bytes_sent
+                ) for connection in rows])
+                conn.execute("""
+                    INSERT INTO shard_max_id (key, max_id) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET max_id = MAX(max_id, excluded.max_id)
+                """, (key, max(connection.id for connection in rows)))
+
+            self._update_rollups(conn, connections)
+            self._update_peer_state(conn, connections)
+            self._bump_generation(conn)
+
+    def _update_peer_state(self, conn: sqlite3.Connection, connections: List[WireGuardConnection]):
+        """Fold a batch of events into peer_state
+
+        The latest connect or disconnect event decides the status (a connect
+        wins a tie, as in the original history query); the endpoint is the
+        last non-empty address received.
+        """
+        peers: Dict[str, Dict] = {}
+        for connection in connections:
+            state = peers.get(connection.peer_id)
+            if state is None:
+                state = peers[connection.peer_id] = {
+                    'status': None, 'since': None, 'connect_id': None, 'endpoint': None,
+                    'last_seen': connection.timestamp, 'received': 0, 'sent': 0
+                }
+            state['public_key'] = connection.public_key
+            state['received'] += connection.bytes_received
+            state['sent'] += connection.bytes_sent
+            state['last_seen'] = max(state['last_seen'], connection.timestamp)
+            if connection.ip_address:
+                state['endpoint'] = connection.ip_address
+
+            if connection.event_type not in ('connect', 'disconnect'):
+                continue
+            is_connect = connection.event_type == 'connect'
+            if (state['since'] is None or connection.timestamp > state['since'] or
+                    (connection.timestamp == state['since'] and is_connect)):
+                state['status'] = 'connected' if is_connect else 'disconnected'
+                state['since'] = connection.timestamp
+                state['connect_id'] = connection.id if is_connect else None
+
+        # SET expressions all see the pre-update row, so their order is irrelevant
+        status_changed = """excluded.since IS NOT NULL AND (since IS NULL OR excluded.since > since
+            OR (excluded.since = since AND excluded.status = 'connected'))"""
+        conn.executemany(f"""
+            INSERT INTO peer_state
+            (peer_id, public_key, status, since, connect_id, last_endpoint, last_handshake,
+             total_bytes_received, total_bytes_sent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(peer_id) DO UPDATE SET
+                public_key = excluded.public_key,
+                status = CASE WHEN {status_changed} THEN excluded.status ELSE status END,
+                since = CASE WHEN {status_changed} THEN excluded.since ELSE since END,
+                connect_id = CASE WHEN {status_changed} THEN excluded.connect_id ELSE connect_id END,
+                last_endpoint = COALESCE(excluded.last_endpoint, last_endpoint),
+                last_handshake = MAX(last_handshake, excluded.last_handshake),
+                total_bytes_received = total_bytes_received + excluded.total_bytes_received,
+                total_bytes_sent = total_bytes_sent + excluded.total_bytes_sent
+        """, [(
+            peer_id,
+            state['public_key'],
+            state['status'] or 'unknown',
+            state['since'],
+            state['connect_id'],
+            state['endpoint'],
+            state['last_seen'],
+            state['received'],
+            state['sent']
+        ) for peer_id, state in peers.items()])
+
+    def rebuild_peer_state(self, force: bool = False):
+        """Reconstruct peer_state from the full connection history
+
+        Once raw events have been compacted away, the running byte totals
+        can no longer be recomputed and a rebuild would reset them to what
+        the remaining rows hold: it is refused unless forced.
+        """
+        history_start = self.get_raw_history_start()
+        if history_start is not None and not force:
+            raise RuntimeError(
+                f"Raw events before {history_start:%Y-%m-%d %H:%M} were compacted; rebuilding "
+                "peer_state from the remaining rows would lose their byte totals (use --force)"
+            )
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM peer_state")
+            conn.execute("""
+                INSERT INTO peer_state
+                (peer_id, public_key, status, since, connect_id, last_endpoint, last_handshake,
+                 total_bytes_received, total_bytes_sent)
+                SELECT
+                    totals.peer_id,
+                    latest.public_key,
+                    CASE status.event_type
+                        WHEN 'connect' THEN 'connected'
+                        WHEN 'disconnect' THEN 'disconnected'
+                        ELSE 'unknown'
+                    END,
+                    status.timestamp,
+                    CASE WHEN status.event_type = 'connect' THEN status.id END,
+                    endpoint.ip_address,
+                    totals.last_seen,
+                    totals.received,
+                    totals.sent
+                FROM (
+                    SELECT peer_id, MAX(id) as last_id, MAX(timestamp) as last_seen,
+                           SUM(bytes_received) as received, SUM(bytes_sent) as sent
+                    FROM connections
+                    GROUP BY peer_id
+                ) totals
+                JOIN connections latest ON latest.id = totals.last_id
+                LEFT JOIN (
+                    SELECT peer_id, id, timestamp, event_type, ROW_NUMBER() OVER (
+                        PARTITION BY peer_id
+                        ORDER BY timestamp DESC, event_type = 'connect' DESC, id DESC
+                    ) as position
+                    FROM connections
+                    WHERE event_type IN ('connect', 'disconnect')
+                ) status ON status.peer_id = totals.peer_id AND status.position = 1
+                LEFT JOIN (
+                    SELECT peer_id, ip_address, ROW_NUMBER() OVER (
+                        PARTITION BY peer_id ORDER BY id DESC
+                    ) as position
+                    FROM connections
+                    WHERE ip_address != ''
+                ) endpoint ON endpoint.peer_id = totals.peer_id AND endpoint.position = 1
+            """)
+            if self.shard_dir:
+                for chunk in self._chunks(self._iter_shard_history()):
+                    self._update_peer_state(conn, chunk)
+            self._bump_generation(conn)
+
+    def _update_rollups(self, conn: sqlite3.Connection, connections: List[WireGuardConnection]):
+        """Fold the transfer events of a batch into the bandwidth rollups"""
+        # peer_id, minute -> [bytes_sent, bytes_received, samples, first_seen, last_seen]
+        minutes: Dict[tuple, list] = {}
+        for connection in connections:
+            if connection.event_type != 'transfer':
+                continue
+            key = (connection.peer_id, connection.timestamp.replace(second=0, microsecond=0))
+            totals = minutes.get(key)
+            if totals is None:
+                minutes[key] = [connection.bytes_sent, connection.bytes_received, 1,
+                                connection.timestamp, connection.timestamp]
+            else:
+                totals[0] += connection.bytes_sent
+                totals[1] += connection.bytes_received
+                totals[2] += 1
+                totals[3] = min(totals[3], connection.timestamp)
+                totals[4] = max(totals[4], connection.timestamp)
+        if not minutes:
+            return
+
+        truncate = {
+            'minute': lambda ts: ts,
+            'hour': lambda ts: ts.replace(minute=0),
+            'day': lambda ts: ts.replace(hour=0, minute=0),
+        }
+        for granularity, (table, _) in self.ROLLUPS.items():
+            buckets: Dict[tuple, list] = {}
+            for (peer_id, minute), totals in minutes.items():
+                key = (truncate[granularity](minute), peer_id)
+                merged = buckets.get(key)
+                if merged is None:
+                    buckets[key] = list(totals)
+                else:
+                    merged[0] += totals[0]
+                    merged[1] += totals[1]
+                    merged[2] += totals[2]
+                    merged[3] = min(merged[3], totals[3])
+                    merged[4] = max(merged[4], totals[4])
+
+            conn.executemany(f"""
+                INSERT INTO {table}
+                (bucket, peer_id, bytes_sent, bytes_received, sample_count, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(bucket, peer_id) DO UPDATE SET
+                    bytes_sent = bytes_sent + excluded.bytes_sent,
+                    bytes_received = bytes_received + excluded.bytes_received,
+                    sample_count = sample_count + excluded.sample_count,
+                    first_seen = MIN(first_seen, excluded.first_seen),
+                    last_seen = MAX(last_seen, excluded.last_seen)
+            """, [(bucket, peer_id, *totals) for (bucket, peer_id), totals in buckets.items()])
+
+    def rebuild_rollups(self):
+        """Recompute the bandwidth rollups from the raw connection history
+
+        Once raw events have been compacted away, only the whole days still
+        covered by raw rows are recomputed; older buckets are kept as they
+        are, since they account for events that no longer exist.
+        """
+        boundary = self.get_raw_history_start()
+        if boundary is not None:
+            # The day holding the cutoff also counts deleted events
+            start_of_day = boundary.replace(hour=0, minute=0, second=0, microsecond=0)
+            boundary = start_of_day if start_of_day == boundary else start_of_day + timedelta(days=1)
+            logger.info(f"Raw history is compacted: rebuilding rollups from {boundary:%Y-%m-%d} on")
+        since = boundary or datetime.min
+        with self.transaction() as conn:
+            for table, bucket_format in self.ROLLUPS.values():
+                conn.execute(f"DELETE FROM {table} WHERE bucket >= ?", (since,))
+                conn.execute(f"""
+                    INSERT INTO {table}
+                    (bucket, peer_id, bytes_sent, bytes_received, sample_count, first_seen, last_seen)
+                    SELECT
+                        strftime('{bucket_format}', timestamp),
+                        peer_id,
+                        SUM(bytes_sent),
+                        SUM(bytes_received),
+                        COUNT(*),
+                        MIN(timestamp),
+                        MAX(timestamp)
+                    FROM connections
+                    WHERE event_type = 'transfer' AND timestamp >= ?
+                    GROUP BY 1, 2
+                """, (since,))
+            if self.shard_dir:
+                for chunk in self._chunks(self._iter_shard_history()):
+                    self._update_rollups(conn, [c for c in chunk if c.timestamp >= since])
+            self._bump_generation(conn)
 
     def get_connections(self, limit: int = 1000) -> List[WireGuardConnection]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute("""
+        conn = self.get_connection()
+        rows = []
+        if self.shard_dir:
+            # Newest shards first, stopping as soon as the limit is reached
+            for _, _, key in reversed(self._list_shards()):
+                schema = self._attach_shard(key)
+                if schema is None:
+                    continue
+                rows.extend(conn.execute(f"""
+                    SELECT * FROM {schema}.connections 
+                    ORDER BY timestamp DESC 
+                    LIMIT ?
+                """, (limit - len(rows),)).fetchall())
+                if len(rows) >= limit:
+                    break
+
+        if len(rows) < limit and (not self.shard_dir or self._has_legacy_rows):
+            rows.extend(conn.execute("""
                 SELECT * FROM connections 
                 ORDER BY timestamp DESC 
                 LIMIT ?
-            """, (limit,))
-            
-            return [WireGuardConnection(
-                id=row['id'],
-                peer_id=row['peer_id'],
-                public_key=row['public_key'],
-                timestamp=datetime.fromisoformat(row['timestamp']),
-                event_type=row['event_type'],
-                ip_address=row['ip_address'],
-                bytes_received=row['bytes_received'],
-                bytes_sent=row['bytes_sent']
-            ) for row in cursor.fetchall()]
+            """, (limit - len(rows),)).fetchall())
+        
+        return [self._row_to_connection(row) for row in rows]
+
+    def get_connections_since(self, last_id: int, limit: int = 10000) -> List[WireGuardConnection]:
+        """Events stored after the event with id last_id, in id order
+
+        Lets another process tail the table cheaply through the primary key.
+        """
+        conn = self.get_connection()
+        rows = []
+        if self.shard_dir:
+            # Late events get new ids in the shard of their timestamp, however
+            # old: search every shard holding ids after last_id, and only those
+            keys = [row[0] for row in conn.execute(
+                "SELECT key FROM shard_max_id WHERE max_id > ?", (last_id,))]
+            for key in keys:
+                schema = self._attach_shard(key)
+                if not schema:
+                    continue
+                rows.extend(conn.execute(f"""
+                    SELECT * FROM {schema}.connections WHERE id > ? ORDER BY id LIMIT ?
+                """, (last_id, limit)).fetchall())
+        if not self.shard_dir or self._has_legacy_rows:
+            rows.extend(conn.execute("""
+                SELECT * FROM connections WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, limit)).fetchall())
+        connections = [self._row_to_connection(row) for row in rows]
+        connections.sort(key=lambda connection: connection.id)
+        return connections[:limit]
+
+    def get_connections_page(self, limit: int = 100, before: Optional[Tuple[datetime, int]] = None,
+                             peer_id: Optional[str] = None, ip_prefix: Optional[str] = None,
+                             event_type: Optional[str] = None, start: Optional[datetime] = None,
+                             end: Optional[datetime] = None) -> List[WireGuardConnection]:
+        """One page of events, newest first, optionally filtered
+
+        Pages are chained by keyset: pass the (timestamp, id) of the last
+        event of a page as `before` to get the next one. Each page is an
+        index range scan starting at the cursor (by peer, by event type or
+        by time), so it costs the same however deep it is. An IP prefix is
+        resolved to its addresses through idx_ip_timestamp, and the page is
+        merged from one ordered range per address; a prefix covering more
+        than MAX_PREFIX_ADDRESSES addresses is common enough to be filtered
+        during the time-ordered scan instead.
+        """
+        conditions = []
+        params: list = []
+        if before is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(before)
+        if peer_id:
+            conditions.append("peer_id = ?")
+            params.append(peer_id)
+        if event_type:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        if start:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end:
+            conditions.append("timestamp < ?")
+            params.append(end)
+        conn = self.get_connection()
+        def query(schema: str, extra: List[str], extra_params: list, count: int) -> sqlite3.Cursor:
+            where = ' AND '.join(conditions + extra)
+            return conn.execute(f"""
+                SELECT * FROM {schema}.connections {'WHERE ' + where if where else ''}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            """, (*params, *extra_params, count))
+
+        def fetch(schema: str, count: int) -> List[sqlite3.Row]:
+            if not ip_prefix:
+                return query(schema, [], [], count).fetchall()
+            addresses = self._prefix_addresses(schema, ip_prefix)
+            if addresses is None:
+                # A range rather than LIKE, which would also match case-insensitively.
+                # The unary + keeps the planner off idx_ip_timestamp, which would
+                # sort every matching event instead of stopping at a full page
+                return query(schema, ["+ip_address >= ? AND +ip_address < ?"],
+                             [ip_prefix, ip_prefix + '\uffff'], count).fetchall()
+            # Cursors are read lazily: only the rows that make the page are fetched
+            ranges = [query(schema, ["ip_address = ?"], [address], count) for address in addresses]
+            merged = heapq.merge(*ranges, key=lambda row: (row['timestamp'], row['id']), reverse=True)
+            page = list(itertools.islice(merged, count))
+            for cursor in ranges:
+                cursor.close()
+            return page
+
+        rows = []
+        if self.shard_dir:
+            # Shards cover disjoint periods: walk them newest first until the page is full
+            newest = min(end or datetime.max, before[0] + timedelta(microseconds=1) if before else datetime.max)
+            for _, _, key in reversed(self._list_shards(start, newest)):
+                schema = self._attach_shard(key)
+                if schema:
+                    rows.extend(fetch(schema, limit - len(rows)))
+                if len(rows) >= limit:
+                    break
+        if not self.shard_dir or self._has_legacy_rows:
+            rows.extend(fetch('main', limit))
+
+        connections = [self._row_to_connection(row) for row in rows]
+        if self.shard_dir and self._has_legacy_rows:
+            connections.sort(key=lambda connection: (connection.timestamp, connection.id), reverse=True)
+        return connections[:limit]
+
+    def _prefix_addresses(self, schema: str, ip_prefix: str) -> Optional[List[str]]:
+        """Distinct addresses of a schema starting with ip_prefix, None past MAX_PREFIX_ADDRESSES
+
+        Each address costs one idx_ip_timestamp lookup, whatever the number
+        of events stored for it.
+        """
+        conn = self.get_connection()
+        upper = ip_prefix + '\uffff'
+        addresses = []
+        address = conn.execute(f"""
+            SELECT MIN(ip_address) FROM {schema}.connections WHERE ip_address >= ? AND ip_address < ?
+        """, (ip_prefix, upper)).fetchone()[0]
+        while address is not None:
+            if len(addresses) == self.MAX_PREFIX_ADDRESSES:
+                return None
+            addresses.append(address)
+            address = conn.execute(f"""
+                SELECT MIN(ip_address) FROM {schema}.connections WHERE ip_address > ? AND ip_address < ?
+            """, (address, upper)).fetchone()[0]
+        return addresses
+
+    def get_connections_between(self, start: datetime,
+                                end: Optional[datetime] = None) -> List[WireGuardConnection]:
+        """Events with start <= timestamp < end, oldest first
+
+        Only the shards overlapping the window are attached and queried.
+        """
+        conn = self.get_connection()
+        end = end or datetime.max
+        schemas = []
+        if not self.shard_dir or self._has_legacy_rows:
+            schemas.append('main')
+        if self.shard_dir:
+            for _, _, key in self._list_shards(start, end):
+                schema = self._attach_shard(key)
+                if schema:
+                    schemas.append(schema)
+
+        rows = []
+        for schema in schemas:
+            rows.extend(conn.execute(f"""
+                SELECT * FROM {schema}.connections
+                WHERE timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp
+            """, (start, end)).fetchall())
+        connections = [self._row_to_connection(row) for row in rows]
+        if len(schemas) > 1:
+            connections.sort(key=lambda connection: connection.timestamp)
+        return connections
 
     def get_active_connections(self) -> List[WireGuardConnection]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute("""
-                SELECT * FROM connections 
-                WHERE event_type = 'connect' 
-                AND peer_id NOT IN (
-                    SELECT peer_id 
-                    FROM connections 
-                    WHERE event_type = 'disconnect' 
-                    AND timestamp > (
-                        SELECT MAX(timestamp) 
-                        FROM connections c2 
-                        WHERE c2.peer_id = connections.peer_id 
-                        AND c2.event_type = 'connect'
-                    )
-                )
-            """)
-            
-            return [WireGuardConnection(
-                id=row['id'],
-                peer_id=row['peer_id'],
-                public_key=row['public_key'],
-                timestamp=datetime.fromisoformat(row['timestamp']),
-                event_type=row['event_type'],
-                ip_address=row['ip_address'],
-                bytes_received=row['bytes_received'],
-                bytes_sent=row['bytes_sent']
-            ) for row in cursor.fetchall()]
+        """Connected peers, each as the connect event that opened its session"""
+        conn = self.get_connection()
+        cursor = conn.execute("""
+            SELECT * FROM peer_state 
+            WHERE status = 'connected'
+        """)
+        
+        return [WireGuardConnection(
+            id=row['connect_id'] or 0,
+            peer_id=row['peer_id'],
+            public_key=row['public_key'],
+            timestamp=datetime.fromisoformat(row['since']),
+            event_type='connect',
+            ip_address=row['last_endpoint'] or '',
+            bytes_received=0,
+            bytes_sent=0
+        ) for row in cursor.fetchall()]
 
     def get_bandwidth_usage(self, time_range: str = 'day') -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            time_filters = {
-                'hour': "AND timestamp >= datetime('now', '-1 hour')",
-                'day': "AND timestamp >= datetime('now', '-1 day')",
-                'week': "AND timestamp >= datetime('now', '-7 days')",
-                'month': "AND timestamp >= datetime('now', '-30 days')",
-                'all': ""
-            }
-            
-            time_filter = time_filters.get(time_range, time_filters['day'])
-            
-            query = f"""
-                SELECT 
-                    peer_id,
-                    SUM(bytes_sent) as total_bytes_sent,
-                    SUM(bytes_received) as total_bytes_received,
-                    COUNT(*) as connection_count,
-                    MIN(timestamp) as first_seen,
-                    MAX(timestamp) as last_seen
-                FROM connections 
-                WHERE event_type = 'transfer'
-                {time_filter}
-                GROUP BY peer_id
-                ORDER BY (total_bytes_sent + total_bytes_received) DESC
-            """
-            
-            cursor = conn.execute(query)
-            return [dict(row) for row in cursor.fetchall()]
+        """Per-peer transfer totals, answered from the bandwidth rollups
+
+        Whole buckets of the coarse rollup cover most of the range and minute
+        buckets cover the partial bucket at its start, so the cost depends on
+        peers x buckets rather than on the number of raw events.
+        """
+        conn = self.get_connection()
+        granularity, span = self.TIME_RANGES.get(time_range, self.TIME_RANGES['day'])
+        table, _ = self.ROLLUPS[granularity]
+
+        source = table
+        params = ()
+        if span is not None:
+            start = (datetime.now() - span).replace(second=0, microsecond=0)
+            aligned = start
+            if granularity == 'hour' and start.minute:
+                aligned = start.replace(minute=0) + timedelta(hours=1)
+            elif granularity == 'day' and (start.hour or start.minute):
+                aligned = start.replace(hour=0, minute=0) + timedelta(days=1)
+            source = f"""(
+                SELECT * FROM {table} WHERE bucket >= ?
+                UNION ALL
+                SELECT * FROM bandwidth_minute WHERE bucket >= ? AND bucket < ?
+            )"""
+            params = (aligned, start, aligned)
+        
+        query = f"""
+            SELECT 
+                peer_id,
+                SUM(bytes_sent) as total_bytes_sent,
+                SUM(bytes_received) as total_bytes_received,
+                SUM(sample_count) as connection_count,
+                MIN(first_seen) as first_seen,
+                MAX(last_seen) as last_seen
+            FROM {source} 
+            GROUP BY peer_id
+            ORDER BY (total_bytes_sent + total_bytes_received) DESC
+        """
+        
+        cursor = conn.execute(query, params)
+        usage = [dict(row) for row in cursor.fetchall()]
+
+        if span is None and self.archive:
+            # Archived events still covered by the day rollup are already counted
+            oldest_bucket = conn.execute("SELECT MIN(bucket) FROM bandwidth_day").fetchone()[0]
+            archived = self.archive.bandwidth_usage(
+                end=datetime.fromisoformat(oldest_bucket) if oldest_bucket else None
+            )
+            if archived:
+                from archive import merge_usage
+                usage = merge_usage(usage, archived)
+        return usage
 
     def add_alert_rule(self, rule: AlertRule) -> int:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.execute("""
                 INSERT INTO alert_rules 
-                (name, event_type, condition, threshold, time_window, action, enabled, description)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                (name, event_type, condition, threshold, time_window, action, enabled, description, scope)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (
                 rule.name,
                 rule.event_type,
@@ -160,17 +1277,18 @@ class Database:
                 rule.time_window,
                 rule.action,
                 rule.enabled,
-                rule.description
+                rule.description,
+                rule.scope
             ))
-            conn.commit()
+            self._bump_rule_version(conn)
             return cursor.lastrowid
 
     def update_alert_rule(self, rule: AlertRule) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.execute("""
                 UPDATE alert_rules 
                 SET name=?, event_type=?, condition=?, threshold=?, 
-                    time_window=?, action=?, enabled=?, description=?
+                    time_window=?, action=?, enabled=?, description=?, scope=?
                 WHERE id=?
             """, (
                 rule.name,
@@ -181,39 +1299,261 @@ class Database:
                 rule.action,
                 rule.enabled,
                 rule.description,
+                rule.scope,
                 rule.id
             ))
-            conn.commit()
+            if cursor.rowcount:
+                self._bump_rule_version(conn)
             return cursor.rowcount > 0
 
     def delete_alert_rule(self, rule_id: int) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.execute("DELETE FROM alert_rules WHERE id=?", (rule_id,))
-            conn.commit()
+            if cursor.rowcount:
+                self._bump_rule_version(conn)
             return cursor.rowcount > 0
 
+    def _bump_rule_version(self, conn: sqlite3.Connection):
+        conn.execute("UPDATE rule_version SET version = version + 1")
+        self.rule_changes += 1
+
+    def get_rule_version(self) -> int:
+        """Counter of changes to the alert rules, shared by every process using the database"""
+        row = self.get_connection().execute("SELECT version FROM rule_version").fetchone()
+        return row['version']
+
+    def data_version(self) -> int:
+        """SQLite data_version of this thread's connection
+
+        It changes whenever another connection, in this process or another
+        one, commits to the database, and costs no disk access.
+        """
+        return self.get_connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def get_rule_trigger_version(self) -> Optional[str]:
+        """Latest trigger time stored, as trigger times do not count in get_rule_version()"""
+        return self.get_connection().execute("SELECT MAX(last_triggered) FROM alert_rules").fetchone()[0]
+
+    @staticmethod
+    def _row_to_rule(row: sqlite3.Row) -> AlertRule:
+        return AlertRule(
+            id=row['id'],
+            name=row['name'],
+            event_type=row['event_type'],
+            condition=row['condition'],
+            threshold=row['threshold'],
+            time_window=row['time_window'],
+            action=row['action'],
+            enabled=bool(row['enabled']),
+            last_triggered=datetime.fromisoformat(row['last_triggered']) if row['last_triggered'] else None,
+            description=row['description'],
+            scope=row['scope']
+        )
+
     def get_alert_rules(self) -> List[AlertRule]:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute("SELECT * FROM alert_rules ORDER BY name")
-            
-            return [AlertRule(
-                id=row['id'],
-                name=row['name'],
-                event_type=row['event_type'],
-                condition=row['condition'],
-                threshold=row['threshold'],
-                time_window=row['time_window'],
-                action=row['action'],
-                enabled=bool(row['enabled']),
-                last_triggered=datetime.fromisoformat(row['last_triggered']) if row['last_triggered'] else None,
-                description=row['description']
-            ) for row in cursor.fetchall()]
+        conn = self.get_connection()
+        cursor = conn.execute("SELECT * FROM alert_rules ORDER BY name")
+        
+        return [self._row_to_rule(row) for row in cursor.fetchall()]
+
+    def get_alert_rule(self, rule_id: int) -> Optional[AlertRule]:
+        row = self.get_connection().execute("SELECT * FROM alert_rules WHERE id=?", (rule_id,)).fetchone()
+        return self._row_to_rule(row) if row else None
 
     def update_rule_trigger_time(self, rule_id: int):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
+        self.update_rule_trigger_times({rule_id: datetime.now()})
+
+    def update_rule_trigger_times(self, trigger_times: Dict[int, datetime]):
+        """Store the last trigger time of several rules in one transaction"""
+        with self.transaction() as conn:
+            conn.executemany(
                 "UPDATE alert_rules SET last_triggered=? WHERE id=?",
-                (datetime.now().isoformat(), rule_id)
+                [(triggered.isoformat(), rule_id) for rule_id, triggered in trigger_times.items()]
             )
-            conn.commit()
+
+class ConnectionWriter:
+    """Write-behind buffer that batches connection events into add_connections()
+
+    Events are buffered in memory and written by a background thread once
+    batch_size events are waiting or flush_interval seconds have passed since
+    the oldest one arrived. The buffer holds at most max_pending events: when
+    the disk falls behind, add() blocks for up to put_timeout seconds and then
+    raises queue.Full, pushing backpressure onto the producer instead of
+    growing memory.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 5000, flush_interval: float = 1.0,
+                 max_pending: int = 100000, put_timeout: float = 5.0, max_retries: int = 3):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+
+        self._buffer: List[WireGuardConnection] = []
+        self._oldest_pending = 0.0
+        self._in_flight = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._condition = threading.Condition()
+
+        self.writer_thread = None
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.writer_thread is None or not self.writer_thread.is_alive():
+            self._stopping = False
+            self.writer_thread = threading.Thread(target=self.run, daemon=True)
+            self.writer_thread.start()
+
+    def add(self, connection: WireGuardConnection):
+        """Buffer one event, blocking while the buffer is full"""
+        self.add_many([connection])
+
+    def add_many(self, connections: List[WireGuardConnection]):
+        """Buffer a batch of events, blocking while the buffer is full"""
+        if not connections:
+            return
+        with self._condition:
+            has_room = lambda: (not self._buffer or
+                                len(self._buffer) + len(connections) <= self.max_pending)
+            if not self._condition.wait_for(has_room, timeout=self.put_timeout):
+                raise queue.Full(f"{len(self._buffer)} connection events are waiting to be written")
+            was_empty = not self._buffer
+            if was_empty:
+                self._oldest_pending = time.monotonic()
+            self._buffer.extend(connections)
+            # The writer needs to arm its flush timer or write a full batch
+            if was_empty or len(self._buffer) >= self.batch_size:
+                self._condition.notify_all()
+
+    def flush(self):
+        """Block until every buffered event has been written"""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._buffer and not self._in_flight)
+            self._flush_requested = False
+
+    def stop(self):
+        """Write the remaining events and stop the writer thread"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self.writer_thread:
+            self.writer_thread.join()
+
+    def _batch_ready(self) -> bool:
+        if not self._buffer:
+            return self._stopping
+        return (self._stopping or self._flush_requested or
+                len(self._buffer) >= self.batch_size or
+                time.monotonic() - self._oldest_pending >= self.flush_interval)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._batch_ready():
+                    timeout = None
+                    if self._buffer:
+                        timeout = self._oldest_pending + self.flush_interval - time.monotonic()
+                    self._condition.wait(timeout)
+                if not self._buffer:
+                    return
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                self._oldest_pending = time.monotonic()
+                self._in_flight = len(batch)
+                # Wake producers waiting for room
+                self._condition.notify_all()
+
+            try:
+                self.write_batch(batch)
+            finally:
+                # Even if the thread dies, flush() and producers must not wait forever
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+
+    def write_batch(self, batch: List[WireGuardConnection]):
+        """Write one batch, retrying on a locked or busy database and dropping it on any other error"""
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.db.add_connections(batch)
+                self.written += len(batch)
+                return
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Batch write failed (attempt {attempt}/{self.max_retries}): {str(e)}")
+                time.sleep(0.1 * 2 ** attempt)
+            except Exception:
+                # Retrying bad data would fail the same way; keep the writer alive for the next batch
+                self.dropped += len(batch)
+                logger.exception(f"Dropped {len(batch)} connection events that cannot be written")
+                return
+        self.dropped += len(batch)
+        logger.error(f"Dropped {len(batch)} connection events after {self.max_retries} failed writes")
+
+class CompactionJob:
+    """Background thread running Database.compact() on a fixed interval"""
+
+    def __init__(self, db: Database, interval: float = 6 * 3600, policy: RetentionPolicy = None):
+        self.db = db
+        self.interval = interval
+        self.policy = policy or RetentionPolicy.from_env()
+        self.stop_event = threading.Event()
+        self.compaction_thread = None
+        self.last_report: Optional[CompactionReport] = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                # Archives expired raw events first when an archive is configured
+                self.last_report = self.db.compact(self.policy)
+            except Exception as e:
+                logger.error(f"Error during compaction: {str(e)}")
+
+    def start(self):
+        if self.compaction_thread is None or not self.compaction_thread.is_alive():
+            self.stop_event.clear()
+            self.compaction_thread = threading.Thread(target=self.run, daemon=True)
+            self.compaction_thread.start()
+
+    def stop(self, timeout: float = 60.0):
+        """Stop the job, waiting up to timeout seconds for a running compaction to finish"""
+        self.stop_event.set()
+        if self.compaction_thread:
+            self.compaction_thread.join(timeout=timeout)
+            if self.compaction_thread.is_alive():
+                logger.warning(f"Compaction still running after {timeout:g}s, leaving it behind")
+
+def main():
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="WireGuard Monitor database maintenance")
+    arg_parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'wireguard_monitor.db'),
+                            help="Path to the SQLite database")
+    arg_parser.add_argument('command', choices=['rebuild-peer-state', 'rebuild-rollups',
+                                                'compact', 'vacuum'])
+    arg_parser.add_argument('--force', action='store_true',
+                            help="Rebuild peer_state even though compacted raw events are missing from it")
+    args = arg_parser.parse_args()
+
+    db = Database(args.db)
+    started = time.monotonic()
+    if args.command == 'rebuild-peer-state':
+        try:
+            db.rebuild_peer_state(force=args.force)
+        except RuntimeError as e:
+            arg_parser.error(str(e))
+    elif args.command == 'rebuild-rollups':
+        db.rebuild_rollups()
+    elif args.command == 'compact':
+        db.compact()
+    elif args.command == 'vacuum':
+        db.vacuum()
+    logger.info(f"{args.command} finished in {time.monotonic() - started:.2f}s")
+
+if __name__ == '__main__':
+    main()
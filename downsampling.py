@@ -0,0 +1,132 @@
+"""Reduce chart series to what a chart of a given pixel width can show
+
+Traffic lines are reduced with Largest-Triangle-Three-Buckets (LTTB), which
+keeps the visual shape of a line with one point per pixel, or with a min/max
+envelope, which keeps every spike. Connection timelines are reduced to runs
+of the same state per peer, at most one per pixel. Either way the number of
+points handed to Plotly depends on the chart width, not on the data volume.
+"""
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_WIDTH = 1200
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the threshold points of (x, y) that LTTB keeps; x must be sorted"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Relative float coordinates: triangle areas of epoch nanoseconds overflow int64
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(np.intp) + 1
+    edges[-1] = n - 1
+
+    indices = np.empty(threshold, dtype=np.intp)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket, or the last point for the last bucket
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        ax, ay = x[selected], y[selected]
+        areas = np.abs((ax - avg_x) * (y[start:end] - ay) - (ax - x[start:end]) * (avg_y - ay))
+        selected = start + int(areas.argmax())
+        indices[i + 1] = selected
+    return indices
+
+def minmax_envelope(x: np.ndarray, y: np.ndarray, buckets: int) -> np.ndarray:
+    """Indices of the lowest and highest point of each of `buckets` equal time slices
+
+    Unlike LTTB every local extreme survives, so isolated spikes stay visible.
+    x must be sorted; the indices come back in time order.
+    """
+    n = len(x)
+    if n <= 2 * buckets or buckets < 1:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    span = x[-1] or 1.0
+    bucket = np.minimum((x * buckets / span).astype(np.intp), buckets - 1)
+    # Sorted by bucket then value: the first and last row of a bucket are its min and max
+    order = np.lexsort((y, bucket))
+    boundaries = np.flatnonzero(np.diff(bucket[order])) + 1
+    firsts = np.concatenate(([0], boundaries))
+    lasts = np.concatenate((boundaries - 1, [n - 1]))
+    return np.unique(np.concatenate((order[firsts], order[lasts], [0, n - 1])))
+
+def downsample_series(timestamps: pd.Series, values: pd.Series, width: int = DEFAULT_WIDTH,
+                      method: str = 'lttb') -> Tuple[pd.Series, pd.Series]:
+    """A time series reduced to about `width` points, sorted by time"""
+    order = np.argsort(timestamps.to_numpy(), kind='stable')
+    timestamps = timestamps.iloc[order].reset_index(drop=True)
+    values = values.iloc[order].reset_index(drop=True)
+    x = timestamps.to_numpy().astype('datetime64[ns]').astype(np.int64)
+    y = values.to_numpy()
+    if method == 'minmax':
+        indices = minmax_envelope(x, y, max(1, width // 2))
+    elif method == 'lttb':
+        indices = lttb(x, y, width)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    return timestamps.iloc[indices], values.iloc[indices]
+
+def timeline_segments(df: pd.DataFrame, width: int = DEFAULT_WIDTH) -> pd.DataFrame:
+    """Merge the events of a timeline into segments of one state per peer
+
+    df has one row per event with columns peer_id, start, event_type and
+    ip_address. Consecutive events of a peer with the same event type become
+    one segment lasting until the next state; when the time range holds more
+    events than `width`, each pixel-wide slice of a peer first takes its most
+    frequent event type, so that a peer never yields more than `width`
+    segments. The result has columns peer_id, start, end, event_type,
+    ip_address and events.
+    """
+    df = df.sort_values(['peer_id', 'start'], kind='stable').reset_index(drop=True)
+    start = df['start'].min()
+    span = df['start'].max() - start
+    slice_width = span / width if span > pd.Timedelta(0) else pd.Timedelta(seconds=1)
+
+    if len(df) <= width:
+        # Few enough events to keep every one of them in its own slice
+        df['slice'] = np.arange(len(df))
+    else:
+        df['slice'] = ((df['start'] - start) / slice_width).astype(np.int64).clip(upper=width - 1)
+
+    slices = df.groupby(['peer_id', 'slice'], sort=True).agg(
+        first=('start', 'min'),
+        last=('start', 'max'),
+        events=('start', 'size'),
+        ip_address=('ip_address', 'last'),
+    )
+    counts = df.groupby(['peer_id', 'slice', 'event_type'], sort=False).size()
+    dominant = counts.sort_values(kind='stable').groupby(level=['peer_id', 'slice']).tail(1)
+    slices['event_type'] = dominant.reset_index(level='event_type')['event_type']
+    slices = slices.reset_index()
+
+    # Run-length merge of consecutive slices in the same state
+    new_run = ((slices['peer_id'] != slices['peer_id'].shift())
+               | (slices['event_type'] != slices['event_type'].shift()))
+    segments = slices.groupby(new_run.cumsum()).agg(
+        peer_id=('peer_id', 'first'),
+        event_type=('event_type', 'first'),
+        start=('first', 'min'),
+        last=('last', 'max'),
+        events=('events', 'sum'),
+        ip_address=('ip_address', 'last'),
+    ).reset_index(drop=True)
+
+    # A state lasts until the next one of the same peer, or its last event
+    same_peer = segments['peer_id'] == segments['peer_id'].shift(-1)
+    segments['end'] = segments['start'].shift(-1).where(same_peer, segments['last'])
+    # Keep zero-length segments visible
+    segments['end'] = segments['end'].where(segments['end'] > segments['start'],
+                                            segments['start'] + slice_width)
+    return segments[['peer_id', 'start', 'end', 'event_type', 'ip_address', 'events']]
@@ -0,0 +1,143 @@
+"""Conditional GET and compression of the dashboard API responses
+
+Responses are tagged with an ETag derived from the version of the data
+they were built from (the ingest generation, the alert rule version), so a
+client polling unchanged data gets a 304 without any query being run. The
+version itself is read through a VersionClock, at most once a second
+whatever the number of clients. A body is encoded and compressed once per
+version and served to every client from a QueryCache.
+"""
+import gzip
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip is always available
+    brotli = None
+
+from cache import QueryCache
+
+# Below this size compression saves less than it costs
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/plain', 'text/css',
+                      'text/javascript', 'application/javascript'}
+GZIP_LEVEL = 6
+# Quality 11 is meant for static files and is far too slow per request
+BROTLI_QUALITY = 5
+
+class VersionClock:
+    """A database version shared by every request, read at most once every max_age seconds
+
+    Writes made by this process call invalidate() so that they are visible
+    on the next request; writes by other processes (the collector, the
+    monitor) show up within max_age.
+    """
+
+    def __init__(self, read: Callable[[], Hashable], max_age: float = 1.0):
+        self.read = read
+        self.max_age = max_age
+        self.reads = 0
+        self._value: Optional[Hashable] = None
+        self._expires = 0.0
+        # Bumped by invalidate() so that a read started before a write is not kept
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> Hashable:
+        now = time.monotonic()
+        with self._lock:
+            if self._value is not None and now < self._expires:
+                return self._value
+            epoch = self._epoch
+        value = self.read()
+        with self._lock:
+            self.reads += 1
+            if epoch == self._epoch:
+                self._value = value
+                self._expires = now + self.max_age
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._epoch += 1
+
+def make_etag(name: str, params: tuple, version: Hashable) -> str:
+    """ETag value of a response built from version, the same for every encoding"""
+    return hashlib.blake2b(repr((name, params, version)).encode(), digest_size=12).hexdigest()
+
+def negotiate_encoding() -> Optional[str]:
+    """The content coding preferred by the current request, brotli winning ties"""
+    accepted = request.accept_encodings
+    candidates = (['br'] if brotli else []) + ['gzip']
+    best = max(candidates, key=accepted.quality)
+    return best if accepted.quality(best) > 0 else None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+def compress_response(response: Response) -> Response:
+    """after_request hook compressing large pages and JSON built outside CachedResponses"""
+    if (response.direct_passthrough or response.is_streamed
+            or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = negotiate_encoding()
+    if encoding is None or len(body) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+class CachedResponses:
+    """JSON API responses answered with 304 when unchanged, built and compressed once per version"""
+
+    def __init__(self, cache: Optional[QueryCache] = None, min_size: int = MIN_COMPRESS_SIZE):
+        self.cache = cache or QueryCache(max_entries=128, max_bytes=64 * 1024 * 1024)
+        self.min_size = min_size
+        self.not_modified = 0
+
+    def respond(self, name: str, params: tuple, version: Hashable,
+                build: Callable[[], Any]) -> Response:
+        """Response of the current request for the payload build() returns at version
+
+        build() is only called when no client has asked for this version
+        yet; its result must be JSON serializable.
+        """
+        etag = make_etag(name, params, version)
+        if request.if_none_match.contains_weak(etag):
+            self.not_modified += 1
+            response = Response(status=304)
+        else:
+            body = self.cache.get((name, params, None), version,
+                                  lambda: json.dumps(build()).encode())
+            encoding = negotiate_encoding() if len(body) >= self.min_size else None
+            data = body
+            if encoding:
+                data = self.cache.get((name, params, encoding), version,
+                                      lambda: compress(body, encoding))
+            response = Response(data, mimetype='application/json')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        # Weak: the gzip, brotli and identity bodies carry the same data
+        response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        # Cache, but revalidate on every use
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def stats(self):
+        return dict(self.cache.stats(), not_modified=self.not_modified)
@@ -0,0 +1,187 @@
+"""Server-Sent Events stream of live per-peer statistics
+
+A single broadcaster thread tails the connections stored since its last
+tick, turns them into per-peer byte deltas and rates plus connect and
+disconnect events, encodes that once and hands the same message to every
+open stream. The cost per tick is one query and one encoding whatever the
+number of clients, and nothing runs while no client is connected.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from models import WireGuardConnection
+
+logger = logging.getLogger('LiveStream')
+
+class Subscription:
+    """The outbound queue of one stream"""
+
+    __slots__ = ('queue', 'closed')
+
+    def __init__(self, max_queue: int):
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+class PeerStatsBroadcaster:
+    """Fan-out of live peer statistics to SSE clients
+
+    Every `interval` seconds the rows stored since the previous tick are
+    read with Database.get_connections_since(). A client that falls
+    max_queue messages behind (a stalled or very slow connection) is
+    dropped rather than buffered without bound; browsers reconnect on
+    their own after `retry` milliseconds.
+    """
+
+    def __init__(self, db, interval: float = 1.0, max_queue: int = 64,
+                 heartbeat: float = 15.0, retry: int = 3000, batch_size: int = 10000):
+        self.db = db
+        self.interval = interval
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.batch_size = batch_size
+        self.last_id = 0
+        self._subscribers: Set[Subscription] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+        self.ticks = 0
+        self.dropped = 0
+
+    def subscribe(self) -> Subscription:
+        """Register a new stream, starting the broadcaster thread if it is idle"""
+        subscription = Subscription(self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+        # Wake the stream up so that it ends now, discarding what it did not send
+        while True:
+            try:
+                subscription.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    subscription.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def stop(self):
+        self._stop_event.set()
+        with self._lock:
+            thread = self._thread
+        if thread:
+            thread.join(timeout=self.interval + 2.0)
+
+    def stream(self, subscription: Subscription) -> Iterator[str]:
+        """SSE text of one client, until it disconnects or is dropped"""
+        try:
+            yield f"retry: {self.retry}\n\n"
+            while not subscription.closed:
+                try:
+                    message = subscription.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+    def publish(self, message: str):
+        """Queue an encoded message for every subscriber, dropping those that are full"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                self.dropped += 1
+                logger.warning("Dropping a live stream client that is not keeping up")
+                self.unsubscribe(subscription)
+
+    def run(self):
+        logger.info("Live stream broadcaster started")
+        # Only what is stored from now on is pushed
+        self.last_id = max(self.last_id, self.db.max_connection_id())
+        last_tick = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    break
+            try:
+                connections = self._new_connections()
+                now = time.monotonic()
+                message = self.encode(connections, now - last_tick)
+                last_tick = now
+                self.ticks += 1
+                if message:
+                    self.publish(message)
+            except Exception as e:
+                logger.error(f"Error in live stream broadcaster: {str(e)}")
+        else:
+            with self._lock:
+                self._thread = None
+        logger.info("Live stream broadcaster stopped")
+
+    def _new_connections(self) -> List[WireGuardConnection]:
+        connections = []
+        while True:
+            batch = self.db.get_connections_since(self.last_id, limit=self.batch_size)
+            connections.extend(batch)
+            if batch:
+                self.last_id = batch[-1].id
+            if len(batch) < self.batch_size:
+                return connections
+
+    def encode(self, connections: List[WireGuardConnection], elapsed: float) -> str:
+        """SSE messages of one tick: a `rates` event and one `connection` event per session change"""
+        if not connections:
+            return ''
+        elapsed = max(elapsed, 1e-3)
+        rates: Dict[str, Dict] = {}
+        messages = []
+        for connection in connections:
+            if connection.event_type == 'transfer':
+                peer = rates.get(connection.peer_id)
+                if peer is None:
+                    peer = rates[connection.peer_id] = {'bytes_sent': 0, 'bytes_received': 0, 'samples': 0}
+                peer['bytes_sent'] += connection.bytes_sent
+                peer['bytes_received'] += connection.bytes_received
+                peer['samples'] += 1
+            elif connection.event_type in ('connect', 'disconnect'):
+                messages.append(self._event('connection', {
+                    'peer_id': connection.peer_id,
+                    'event': connection.event_type,
+                    'ip_address': connection.ip_address,
+                    'timestamp': connection.timestamp.isoformat(),
+                }))
+        if rates:
+            for peer in rates.values():
+                peer['rate_sent'] = peer['bytes_sent'] / elapsed
+                peer['rate_received'] = peer['bytes_received'] / elapsed
+            messages.append(self._event('rates', {'interval': elapsed, 'peers': rates}))
+        return ''.join(messages)
+
+    def _event(self, name: str, data: Dict) -> str:
+        return f"event: {name}\nid: {self.last_id}\ndata: {json.dumps(data)}\n\n"
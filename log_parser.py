@@ -1,9 +1,17 @@
 import re
 import os
+import base64
+import errno
+import json
 import logging
+import socket
+import struct
 import subprocess
-from datetime import datetime
-from typing import Optional, List, Tuple, Dict
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple, Dict, Iterable, Iterator
 from models import WireGuardConnection
 
 # Configure logging
@@ -13,71 +21,530 @@ logging.basicConfig(
 )
 logger = logging.getLogger('WireGuardLogParser')
 
-class WireGuardLogParser:
+# Size of the buffered reads used when tailing log files
+READ_CHUNK_SIZE = 1024 * 1024
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+class LogTimestampParser:
+    """Extract event timestamps from syslog and journal lines
+
+    Supports the traditional syslog prefix ("Oct 17 00:19:39") and the ISO 8601
+    prefix written by rsyslog high-precision templates and journalctl
+    short-iso output. Consecutive lines mostly share the same second, so the
+    datetime of the last seen prefix is cached and reused as-is; only the
+    sub-second part is applied per line. Timestamps are returned as naive
+    local datetimes, like the rest of the application uses.
+    """
+
     def __init__(self):
+        self._last_prefix = None
+        self._last_value = None
+
+    def parse(self, line: str) -> Optional[datetime]:
+        if line[4:5] == '-' and line[10:11] in ('T', ' '):
+            return self._parse_iso(line)
+
+        prefix = line[:15]
+        if prefix == self._last_prefix:
+            return self._last_value
+        month = MONTHS.get(prefix[:3])
+        if month is None:
+            return None
+        try:
+            now = datetime.now()
+            value = datetime(now.year, month, int(prefix[4:6]),
+                             int(prefix[7:9]), int(prefix[10:12]), int(prefix[13:15]))
+        except ValueError:
+            return None
+        # Syslog omits the year: a date in the future belongs to last year
+        if value - now > timedelta(days=1):
+            value = value.replace(year=now.year - 1)
+        self._last_prefix = prefix
+        self._last_value = value
+        return value
+
+    def _parse_iso(self, line: str) -> Optional[datetime]:
+        end = 19
+        microsecond = 0
+        if line[19:20] in ('.', ','):
+            end = 20
+            while line[end:end + 1].isdigit():
+                end += 1
+            microsecond = int(line[20:end][:6].ljust(6, '0') or 0)
+        zone_end = line.find(' ', end)
+        if zone_end < 0:
+            zone_end = len(line)
+
+        prefix = line[:19] + line[end:zone_end]
+        if prefix != self._last_prefix:
+            try:
+                value = datetime.fromisoformat(prefix.replace(' ', 'T', 1))
+            except ValueError:
+                return None
+            if value.tzinfo is not None:
+                value = value.astimezone().replace(tzinfo=None)
+            self._last_prefix = prefix
+            self._last_value = value
+        return self._last_value.replace(microsecond=microsecond)
+
+class LogCheckpoints:
+    """Read positions of log sources, persisted as a small JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.positions: Dict[str, Dict] = {}
+        try:
+            with open(path, 'r') as f:
+                self.positions = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint file {path}: {str(e)}")
+
+    def get(self, source: str) -> Optional[Dict]:
+        return self.positions.get(source)
+
+    def set(self, source: str, position: Dict):
+        """Record a new position and persist it if it changed"""
+        if self.positions.get(source) == position:
+            return
+        self.positions[source] = position
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.positions, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error saving checkpoint file {self.path}: {str(e)}")
+
+# Peer lines of `wg show all dump` as the parser has always read them:
+#   <public key>\t<endpoint>\t<n>\t<rx bytes>\t<tx bytes>
+WG_DUMP_PATTERN = re.compile(r'^([\w+/=]+)\t([\d.]+:\d+)?\t\d+\t(\d+)\t(\d+)$')
+
+def endpoint_address(endpoint: Optional[str]) -> str:
+    """IP address of a `host:port` or `[v6 host]:port` endpoint, '' when there is none"""
+    if not endpoint or ':' not in endpoint:
+        return ''
+    return endpoint.rpartition(':')[0].strip('[]')
+
+def dump_sample(public_key: str, ip_address: str, rx_bytes: int, tx_bytes: int,
+                timestamp: datetime) -> WireGuardConnection:
+    """Cumulative counters of one peer, as every dump backend returns them"""
+    return WireGuardConnection(
+        id=0,
+        peer_id=public_key[:8],
+        public_key=public_key,
+        timestamp=timestamp,
+        event_type='transfer',
+        ip_address=ip_address,
+        bytes_received=rx_bytes,
+        bytes_sent=tx_bytes
+    )
+
+def parse_wg_dump(output: str, timestamp: datetime) -> List[WireGuardConnection]:
+    """Peers of `wg show all dump` output"""
+    samples = []
+    for line in output.splitlines():
+        match = WG_DUMP_PATTERN.match(line)
+        if match:
+            public_key, endpoint, rx_bytes, tx_bytes = match.groups()
+        else:
+            # interface, public key, preshared key, endpoint, allowed ips,
+            # latest handshake, rx bytes, tx bytes, persistent keepalive
+            fields = line.split('\t')
+            if len(fields) != 9 or not fields[6].isdigit() or not fields[7].isdigit():
+                continue
+            public_key, endpoint, rx_bytes, tx_bytes = fields[1], fields[3], fields[6], fields[7]
+        samples.append(dump_sample(public_key, endpoint_address(endpoint),
+                                   int(rx_bytes), int(tx_bytes), timestamp))
+    return samples
+
+def record_dump(f, samples: List[WireGuardConnection]):
+    """Append one poll to a file that ReplayDumpBackend can play back"""
+    if not samples:
+        return
+    f.write(json.dumps({
+        'timestamp': samples[0].timestamp.isoformat(),
+        'peers': [[s.public_key, s.ip_address, s.bytes_received, s.bytes_sent] for s in samples],
+    }) + '\n')
+
+class DumpBackend:
+    """Source of the cumulative transfer counters of every WireGuard peer
+
+    read() returns one WireGuardConnection per peer with the counters since
+    the interface came up, like `wg show all dump`; WireGuardCollector
+    turns them into deltas.
+    """
+
+    name = 'unknown'
+
+    def read(self) -> List[WireGuardConnection]:
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        """Data source name reported by WireGuardLogParser.get_data_source()"""
+        return self.name
+
+    def close(self):
+        pass
+
+class SubprocessDumpBackend(DumpBackend):
+    """`wg show all dump` run on every poll, with `sudo wg` as a fallback where allowed"""
+
+    name = 'subprocess'
+
+    def __init__(self, sudo: bool = False, command: Optional[List[str]] = None):
+        self.sudo = sudo
+        self.command = command or os.getenv('WG_COMMAND', 'wg').split()
+        self.used_sudo = False
+
+    def read(self) -> List[WireGuardConnection]:
+        commands = [self.command + ['show', 'all', 'dump']]
+        if self.sudo:
+            commands.append(['sudo'] + commands[0])
+
+        for cmd in commands:
+            try:
+                logger.debug(f"Attempting to get WireGuard status using: {' '.join(cmd)}")
+                result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+                samples = parse_wg_dump(result.stdout, datetime.now())
+                if samples:
+                    self.used_sudo = cmd[0] == 'sudo'
+                    return samples
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"Error running {cmd[0]}: {str(e)}")
+        return []
+
+    def describe(self) -> str:
+        return f"wg dump ({'sudo' if self.used_sudo else 'normal'})"
+
+NLA_HEADER = struct.Struct('=HH')
+U64 = struct.Struct('=Q')
+
+class NetlinkDumpBackend(DumpBackend):
+    """Counters read from the kernel WireGuard module over generic netlink, without forking
+
+    Sends the `wireguard` generic netlink family's WG_CMD_GET_DEVICE dump,
+    the request `wg show` itself makes, on one socket kept open across
+    polls. Like `wg show` it needs CAP_NET_ADMIN. Interfaces are the given
+    ones, or every WireGuard interface found in sysfs.
+    """
+
+    name = 'netlink'
+
+    NETLINK_GENERIC = 16
+    NLM_F_REQUEST = 0x1
+    NLM_F_MULTI = 0x2
+    NLM_F_DUMP = 0x300
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    # Strips NLA_F_NESTED and NLA_F_NET_BYTEORDER
+    NLA_TYPE_MASK = 0x3fff
+    NLA_F_NESTED = 0x8000
+
+    GENL_ID_CTRL = 0x10
+    CTRL_CMD_GETFAMILY = 3
+    CTRL_ATTR_FAMILY_ID = 1
+    CTRL_ATTR_FAMILY_NAME = 2
+
+    # include/uapi/linux/wireguard.h
+    WG_GENL_NAME = b'wireguard'
+    WG_GENL_VERSION = 1
+    WG_CMD_GET_DEVICE = 0
+    WGDEVICE_A_IFNAME = 2
+    WGDEVICE_A_PEERS = 8
+    WGPEER_A_PUBLIC_KEY = 1
+    WGPEER_A_ENDPOINT = 4
+    WGPEER_A_RX_BYTES = 7
+    WGPEER_A_TX_BYTES = 8
+    WGPEER_A_ALLOWEDIPS = 9
+
+    RECV_SIZE = 64 * 1024
+    RESCAN_INTERVAL = 30.0
+
+    def __init__(self, interfaces: Optional[List[str]] = None):
+        self.interfaces = interfaces
+        self.sock: Optional[socket.socket] = None
+        self.family_id: Optional[int] = None
+        self.seq = 0
+        self._found: List[str] = []
+        self._next_scan = 0.0
+
+    def read(self) -> List[WireGuardConnection]:
+        if self.sock is None:
+            self.open()
+        timestamp = datetime.now()
+        samples = []
+        try:
+            for ifname in self.interfaces or self.find_interfaces():
+                ifname_attr = self.attr(self.WGDEVICE_A_IFNAME, ifname.encode() + b'\0')
+                peers: Dict[str, List] = {}
+                for message in self.request(self.family_id, self.NLM_F_DUMP, self.WG_CMD_GET_DEVICE,
+                                            self.WG_GENL_VERSION, ifname_attr):
+                    self.parse_device(message, peers)
+                samples.extend(self.peer_samples(peers, timestamp))
+        except OSError:
+            # Unread replies would be taken for the next request's
+            self.close()
+            raise
+        return samples
+
+    def describe(self) -> str:
+        return 'netlink'
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        try:
+            self.family_id = self.resolve_family(self.WG_GENL_NAME)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def find_interfaces(self) -> List[str]:
+        """WireGuard interfaces of the host, rescanned every RESCAN_INTERVAL seconds"""
+        now = time.monotonic()
+        if now >= self._next_scan:
+            found = []
+            for name in sorted(os.listdir('/sys/class/net')):
+                try:
+                    with open(f'/sys/class/net/{name}/uevent') as f:
+                        if 'DEVTYPE=wireguard' in f.read():
+                            found.append(name)
+                except OSError:
+                    continue
+            self._found = found
+            self._next_scan = now + self.RESCAN_INTERVAL
+        return self._found
+
+    def resolve_family(self, name: bytes) -> int:
+        """Id the kernel assigned to a generic netlink family"""
+        try:
+            for message in self.request(self.GENL_ID_CTRL, 0, self.CTRL_CMD_GETFAMILY, 1,
+                                        self.attr(self.CTRL_ATTR_FAMILY_NAME, name + b'\0')):
+                for attr_type, value in self.attrs(message):
+                    if attr_type == self.CTRL_ATTR_FAMILY_ID:
+                        return struct.unpack('=H', value[:2])[0]
+        except FileNotFoundError:
+            pass
+        raise OSError(errno.ENOENT, f"No {name.decode()} generic netlink family: is the kernel module loaded?")
+
+    def request(self, msg_type: int, flags: int, cmd: int, version: int,
+                attrs: bytes) -> Iterator[bytes]:
+        """Send a generic netlink request and yield the attributes of each reply"""
+        self.seq += 1
+        payload = struct.pack('=BBH', cmd, version, 0) + attrs
+        self.sock.send(struct.pack('=IHHII', 16 + len(payload), msg_type,
+                                   self.NLM_F_REQUEST | flags, self.seq, 0) + payload)
+        while True:
+            data = self.sock.recv(self.RECV_SIZE)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, reply_type, reply_flags, seq, _ = struct.unpack_from('=IHHII', data, offset)
+                body = data[offset + 16:offset + length]
+                offset += (length + 3) & ~3
+                if seq != self.seq:
+                    continue
+                if reply_type in (self.NLMSG_ERROR, self.NLMSG_DONE):
+                    error = struct.unpack_from('=i', body)[0] if len(body) >= 4 else 0
+                    if error < 0:
+                        raise OSError(-error, os.strerror(-error))
+                    return
+                # Past the genlmsghdr
+                yield body[4:]
+                if not reply_flags & self.NLM_F_MULTI:
+                    return
+
+    @staticmethod
+    def attr(attr_type: int, value: bytes) -> bytes:
+        length = 4 + len(value)
+        return struct.pack('=HH', length, attr_type) + value + b'\0' * (-length % 4)
+
+    @classmethod
+    def attrs(cls, data: bytes) -> Iterator[Tuple[int, bytes]]:
+        offset = 0
+        while offset + 4 <= len(data):
+            length, attr_type = struct.unpack_from('=HH', data, offset)
+            if length < 4:
+                return
+            yield attr_type & cls.NLA_TYPE_MASK, data[offset + 4:offset + length]
+            offset += (length + 3) & ~3
+
+    def parse_device(self, message: bytes, peers: Dict[str, List]):
+        """Merge the peers of one WG_CMD_GET_DEVICE reply into peers: public key -> [ip, rx, tx]
+
+        A device too large for one reply spans several. A peer whose
+        allowed IPs overflow a reply is repeated at the start of the next
+        one with only its public key and the remaining allowed IPs, so the
+        attributes are merged by key, as `wg` does.
+        """
+        unpack_attr = NLA_HEADER.unpack_from
+        unpack_u64 = U64.unpack_from
+        for attr_type, value in self.attrs(message):
+            if attr_type != self.WGDEVICE_A_PEERS:
+                continue
+            # Walked inline: a generator per peer costs more than the decoding itself
+            peer_offset = 0
+            while peer_offset + 4 <= len(value):
+                peer_length, _ = unpack_attr(value, peer_offset)
+                if peer_length < 4:
+                    break
+                offset, end = peer_offset + 4, peer_offset + peer_length
+                peer_offset += (peer_length + 3) & ~3
+
+                public_key, ip_address, rx_bytes, tx_bytes = None, None, None, None
+                while offset + 4 <= end:
+                    length, peer_attr = unpack_attr(value, offset)
+                    if length < 4:
+                        break
+                    peer_attr &= self.NLA_TYPE_MASK
+                    if peer_attr == self.WGPEER_A_PUBLIC_KEY:
+                        public_key = base64.b64encode(value[offset + 4:offset + length]).decode()
+                    elif peer_attr == self.WGPEER_A_ENDPOINT:
+                        ip_address = self.endpoint_address(value[offset + 4:offset + length])
+                    elif peer_attr == self.WGPEER_A_RX_BYTES:
+                        rx_bytes = unpack_u64(value, offset + 4)[0]
+                    elif peer_attr == self.WGPEER_A_TX_BYTES:
+                        tx_bytes = unpack_u64(value, offset + 4)[0]
+                    offset += (length + 3) & ~3
+                if not public_key:
+                    continue
+                entry = peers.get(public_key)
+                if entry is None:
+                    peers[public_key] = [ip_address, rx_bytes, tx_bytes]
+                    continue
+                for i, field in enumerate((ip_address, rx_bytes, tx_bytes)):
+                    if field is not None:
+                        entry[i] = field
+
+    @staticmethod
+    def peer_samples(peers: Dict[str, List], timestamp: datetime) -> List[WireGuardConnection]:
+        """Samples of the merged peers that carried their transfer counters"""
+        return [dump_sample(public_key, ip_address or '', rx_bytes, tx_bytes, timestamp)
+                for public_key, (ip_address, rx_bytes, tx_bytes) in peers.items()
+                if rx_bytes is not None and tx_bytes is not None]
+
+    @staticmethod
+    def endpoint_address(sockaddr: bytes) -> str:
+        family = struct.unpack_from('=H', sockaddr)[0]
+        if family == socket.AF_INET:
+            return socket.inet_ntop(socket.AF_INET, sockaddr[4:8])
+        if family == socket.AF_INET6:
+            return socket.inet_ntop(socket.AF_INET6, sockaddr[8:24])
+        return ''
+
+class ReplayDumpBackend(DumpBackend):
+    """Polls played back from a file of recorded dumps, for tests and benchmarks
+
+    One JSON object per line, either {"timestamp": ..., "peers": [[public
+    key, ip address, rx bytes, tx bytes], ...]} as record_dump() writes
+    it, or {"timestamp": ..., "dump": <`wg show all dump` output>}. Each
+    read() returns the next line's peers with its recorded timestamp, or
+    the current time with realtime. Past the end reads return nothing,
+    unless loop starts the file over (the counters then go back, which the
+    collector counts as an interface restart).
+    """
+
+    name = 'replay'
+
+    def __init__(self, path: str, loop: bool = False, realtime: bool = False):
+        self.path = path
+        self.loop = loop
+        self.realtime = realtime
+        self.file = open(path)
+
+    def read(self) -> List[WireGuardConnection]:
+        line = self.file.readline()
+        if not line and self.loop:
+            self.file.seek(0)
+            line = self.file.readline()
+        if not line.strip():
+            return []
+
+        record = json.loads(line)
+        timestamp = datetime.now() if self.realtime else datetime.fromisoformat(record['timestamp'])
+        if 'dump' in record:
+            return parse_wg_dump(record['dump'], timestamp)
+        return [dump_sample(public_key, ip_address, int(rx_bytes), int(tx_bytes), timestamp)
+                for public_key, ip_address, rx_bytes, tx_bytes in record['peers']]
+
+    def describe(self) -> str:
+        return f"replay ({self.path})"
+
+    def close(self):
+        self.file.close()
+
+DUMP_BACKENDS = ('subprocess', 'netlink', 'replay')
+
+def create_dump_backend(name: Optional[str] = None, sudo: bool = False,
+                        replay_path: Optional[str] = None) -> DumpBackend:
+    """Dump backend selected by name or by WG_BACKEND (subprocess, netlink or replay)
+
+    netlink reads the interfaces listed in WG_INTERFACES (comma separated)
+    or all of them; replay reads replay_path or WG_REPLAY_FILE, from the
+    start again when WG_REPLAY_LOOP is 1.
+    """
+    name = name or os.getenv('WG_BACKEND', 'subprocess')
+    if name == 'subprocess':
+        return SubprocessDumpBackend(sudo=sudo)
+    if name == 'netlink':
+        interfaces = os.getenv('WG_INTERFACES')
+        return NetlinkDumpBackend([i.strip() for i in interfaces.split(',')] if interfaces else None)
+    if name == 'replay':
+        replay_path = replay_path or os.getenv('WG_REPLAY_FILE')
+        if not replay_path:
+            raise ValueError("The replay backend needs a file of recorded dumps (WG_REPLAY_FILE)")
+        return ReplayDumpBackend(replay_path, loop=os.getenv('WG_REPLAY_LOOP') == '1')
+    raise ValueError(f"Unknown WireGuard backend: {name}")
+
+class WireGuardLogParser:
+    def __init__(self, checkpoint_path: Optional[str] = None,
+                 dump_backend: Optional[DumpBackend] = None):
         self.log_locations = [
             '/var/log/wireguard/wg0.log',
             '/var/log/syslog',
             '/var/log/messages'
         ]
-        self.connection_pattern = re.compile(
-            r'peer ([\w+/=]+) \(([\d.]+)\): (connection established|disconnected)'
-        )
-        self.transfer_pattern = re.compile(
-            r'peer ([\w+/=]+): tx: (\d+) B, rx: (\d+) B'
-        )
-        self.wg_dump_pattern = re.compile(
-            r'^([\w+/=]+)\t([\d.]+:\d+)?\t\d+\t(\d+)\t(\d+)$'
+        # Connection events and transfer statistics in a single pass:
+        #   peer <key> (<ip>): connection established|disconnected
+        #   peer <key>: tx: <n> B, rx: <n> B
+        self.event_pattern = re.compile(
+            r'peer (?P<key>[\w+/=]+)'
+            r'(?: \((?P<ip>[\d.]+)\): (?P<event>connection established|disconnected)'
+            r'|: tx: (?P<tx>\d+) B, rx: (?P<rx>\d+) B)'
         )
+        self.wg_dump_pattern = WG_DUMP_PATTERN
+        # None runs `wg` on each poll, with `sudo wg` where get_wg_dump() allows it
+        if dump_backend is None and os.getenv('WG_BACKEND', 'subprocess') != 'subprocess':
+            dump_backend = create_dump_backend()
+        self.dump_backend = dump_backend
         self.current_source = None
+        self.timestamp_parser = LogTimestampParser()
+        self.checkpoints = LogCheckpoints(
+            checkpoint_path or os.getenv('LOG_CHECKPOINT_PATH', 'log_checkpoints.json')
+        )
         logger.info("Initialized WireGuard log parser")
 
     def get_wg_dump(self, sudo: bool = False) -> List[WireGuardConnection]:
-        """Get current connections using WireGuard commands"""
-        connections = []
-        commands = [
-            ['wg', 'show', 'all', 'dump'],
-            ['sudo', 'wg', 'show', 'all', 'dump'] if sudo else None
-        ]
-
-        for cmd in commands:
-            if not cmd:
-                continue
-
-            try:
-                logger.debug(f"Attempting to get WireGuard status using: {' '.join(cmd)}")
-                result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-                timestamp = datetime.now()
-
-                for line in result.stdout.splitlines():
-                    match = self.wg_dump_pattern.match(line)
-                    if match:
-                        public_key, endpoint, rx_bytes, tx_bytes = match.groups()
-                        ip_address = endpoint.split(':')[0] if endpoint else ''
-                        
-                        conn = WireGuardConnection(
-                            id=0,
-                            peer_id=public_key[:8],
-                            public_key=public_key,
-                            timestamp=timestamp,
-                            event_type='transfer',
-                            ip_address=ip_address,
-                            bytes_received=int(rx_bytes),
-                            bytes_sent=int(tx_bytes)
-                        )
-                        connections.append(conn)
-                        logger.debug(f"Parsed connection from wg dump: peer_id={conn.peer_id}")
-
-                if connections:
-                    self.current_source = f"wg dump ({'sudo' if sudo else 'normal'})"
-                    return connections
-
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"Error running {cmd[0]}: {str(e)}")
-            except Exception as e:
-                logger.error(f"Error parsing wg dump output from {cmd[0]}: {str(e)}")
-
-        return []
+        """Cumulative counters of every peer from the dump backend, `wg` by default"""
+        backend = self.dump_backend or SubprocessDumpBackend(sudo=sudo)
+        try:
+            connections = backend.read()
+        except Exception as e:
+            logger.error(f"Error reading WireGuard status from the {backend.name} backend: {str(e)}")
+            return []
+        if connections:
+            self.current_source = backend.describe()
+        return connections
 
     def get_journalctl_logs(self) -> List[str]:
         """Get WireGuard logs from journalctl"""
@@ -94,16 +561,23 @@ class WireGuardLogParser:
             logger.error(f"Error processing journalctl output: {str(e)}")
         return []
 
-    def read_log_file(self) -> Tuple[List[str], str]:
-        """Try reading from multiple log file locations"""
+    def read_log_file(self, incremental: bool = False) -> Tuple[List[str], str]:
+        """Try reading from multiple log file locations
+
+        With incremental=True only the lines appended since the previous call
+        are returned, resuming from the checkpoint saved for the file.
+        """
         for log_file in self.log_locations:
             try:
                 if os.path.exists(log_file):
-                    logger.debug(f"Attempting to read log file: {log_file}")
-                    with open(log_file, 'r') as f:
-                        lines = f.readlines()
+                    if incremental:
+                        lines = self.tail_log_file(log_file)
+                    else:
+                        logger.debug(f"Attempting to read log file: {log_file}")
+                        with open(log_file, 'r') as f:
+                            lines = f.readlines()
+                        logger.info(f"Successfully read {len(lines)} lines from {log_file}")
                     self.current_source = f"log file ({log_file})"
-                    logger.info(f"Successfully read {len(lines)} lines from {log_file}")
                     return lines, self.current_source
             except PermissionError:
                 logger.warning(f"Permission denied accessing log file: {log_file}")
@@ -113,36 +587,99 @@ class WireGuardLogParser:
         logger.warning("No readable log files found")
         return [], "none"
 
-    def parse_line(self, line: str) -> Optional[WireGuardConnection]:
-        """Parse a single line from the WireGuard log"""
-        try:
-            timestamp = datetime.now()
-            
-            # Try to match connection events
-            conn_match = self.connection_pattern.search(line)
-            if conn_match:
-                public_key, ip_address, event = conn_match.groups()
-                event_type = 'connect' if event == 'connection established' else 'disconnect'
-                
-                logger.debug(f"Parsed connection event: {event_type} from {ip_address}")
-                return WireGuardConnection(
+    def tail_log_file(self, log_file: str) -> List[str]:
+        """Return the complete lines appended to a log file since its last checkpoint"""
+        stat = os.stat(log_file)
+        checkpoint = self.checkpoints.get(log_file)
+        lines = []
+        offset = 0
+
+        if checkpoint:
+            if checkpoint['inode'] == stat.st_ino:
+                offset = checkpoint['offset']
+                if stat.st_size == offset:
+                    return []
+                if stat.st_size < offset:
+                    logger.info(f"{log_file} was truncated, reading from the start")
+                    offset = 0
+            else:
+                # logrotate moved the file away: finish the rotated copy first
+                rotated_file = self._find_rotated_file(log_file, checkpoint['inode'])
+                if rotated_file:
+                    logger.info(f"{log_file} was rotated, finishing {rotated_file}")
+                    lines, _ = self._read_appended_lines(rotated_file, checkpoint['offset'])
+                else:
+                    logger.warning(f"{log_file} was rotated and the previous file is gone")
+
+        new_lines, offset = self._read_appended_lines(log_file, offset)
+        lines.extend(new_lines)
+        self.checkpoints.set(log_file, {'inode': stat.st_ino, 'offset': offset})
+        logger.debug(f"Read {len(lines)} new lines from {log_file}")
+        return lines
+
+    def _find_rotated_file(self, log_file: str, inode: int) -> Optional[str]:
+        for candidate in (f"{log_file}.1", f"{log_file}.0", f"{log_file}-old"):
+            try:
+                if os.stat(candidate).st_ino == inode:
+                    return candidate
+            except OSError:
+                continue
+        return None
+
+    def _read_appended_lines(self, log_file: str, offset: int) -> Tuple[List[str], int]:
+        """Read complete lines from offset onwards in large chunks
+
+        A trailing partial line is left unread so that it is picked up whole
+        once the writer finishes it. Returns the lines and the new offset.
+        """
+        lines = []
+        remainder = b''
+        with open(log_file, 'rb') as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = remainder + chunk
+                end = data.rfind(b'\n')
+                if end < 0:
+                    remainder = data
+                    continue
+                lines.extend(data[:end].decode('utf-8', errors='replace').split('\n'))
+                offset += end + 1
+                remainder = data[end + 1:]
+        return lines, offset
+
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[WireGuardConnection]:
+        """Parse many log lines, yielding an event for each WireGuard line
+
+        Lines without "peer " are rejected by a substring check before any
+        regex runs, which skips the bulk of a shared syslog cheaply.
+        """
+        search = self.event_pattern.search
+        parse_timestamp = self.timestamp_parser.parse
+        for line in lines:
+            if 'peer ' not in line:
+                continue
+            match = search(line)
+            if match is None:
+                continue
+
+            public_key, ip_address, event, sent, received = match.groups()
+            timestamp = parse_timestamp(line) or datetime.now()
+            if event:
+                yield WireGuardConnection(
                     id=0,
                     peer_id=public_key[:8],
                     public_key=public_key,
                     timestamp=timestamp,
-                    event_type=event_type,
+                    event_type='connect' if event == 'connection established' else 'disconnect',
                     ip_address=ip_address,
                     bytes_received=0,
                     bytes_sent=0
                 )
-
-            # Try to match transfer statistics
-            transfer_match = self.transfer_pattern.search(line)
-            if transfer_match:
-                public_key, sent, received = transfer_match.groups()
-                
-                logger.debug(f"Parsed transfer stats for peer {public_key[:8]}")
-                return WireGuardConnection(
+            else:
+                yield WireGuardConnection(
                     id=0,
                     peer_id=public_key[:8],
                     public_key=public_key,
@@ -153,18 +690,32 @@ class WireGuardLogParser:
                     bytes_sent=int(sent)
                 )
 
+    def parse_line(self, line: str, timestamp: Optional[datetime] = None) -> Optional[WireGuardConnection]:
+        """Parse a single line from the WireGuard log
+
+        The event time is read from the line's syslog prefix unless a timestamp
+        is given (e.g. from journal metadata); lines without one fall back to now.
+        """
+        try:
+            for conn in self.parse_lines((line,)):
+                if timestamp:
+                    conn.timestamp = timestamp
+                return conn
         except Exception as e:
             logger.error(f"Error parsing log line: {str(e)}\nLine: {line}")
-            return None
-
         return None
 
     def get_data_source(self) -> str:
         """Return the current data source being used"""
         return self.current_source or "unknown"
 
-    def parse_logs(self) -> List[WireGuardConnection]:
-        """Parse WireGuard data from all available sources"""
+    def parse_logs(self, incremental: bool = False) -> List[WireGuardConnection]:
+        """Parse WireGuard data from all available sources
+
+        With incremental=True a readable log file only yields the events
+        appended since the previous call, and journalctl is only read when
+        there is no log file at all.
+        """
         connections = []
         self.current_source = None
 
@@ -173,31 +724,143 @@ class WireGuardLogParser:
         if connections:
             return connections
 
-        # Try sudo wg dump
-        connections = self.get_wg_dump(sudo=True)
-        if connections:
-            return connections
+        # Try sudo wg dump, unless another dump backend is configured
+        if self.dump_backend is None:
+            connections = self.get_wg_dump(sudo=True)
+            if connections:
+                return connections
 
         # Try reading from log files
-        lines, source = self.read_log_file()
+        lines, source = self.read_log_file(incremental=incremental)
+        if incremental and source != "none":
+            # Tailing a log file: no new line means no new event, and the
+            # journal fallback would return its last entries all over again
+            return list(self.parse_lines(lines))
         if lines:
-            for line in lines:
-                conn = self.parse_line(line)
-                if conn:
-                    connections.append(conn)
+            connections = list(self.parse_lines(lines))
             if connections:
                 return connections
 
         # Try journalctl as last resort
         journal_lines = self.get_journalctl_logs()
         if journal_lines:
-            for line in journal_lines:
-                conn = self.parse_line(line)
-                if conn:
-                    connections.append(conn)
+            connections = list(self.parse_lines(journal_lines))
 
         if not connections:
             logger.warning("No WireGuard data could be obtained from any source")
             self.current_source = "none"
 
         return connections
+
+class JournalFollower:
+    """Stream WireGuard entries from a single long-running `journalctl --follow`
+
+    The journal cursor of the last processed entry is stored in the parser's
+    checkpoint file, so a restarted follower resumes exactly where the
+    previous one stopped. Delivery is at-least-once: an entry handed to the
+    consumer is only checkpointed once the consumer asks for the next one.
+    When journalctl exits on its own, its exit code and the end of its
+    stderr are logged and kept in returncode and stderr_tail.
+    """
+
+    # Lines of journalctl's stderr kept for the exit report
+    STDERR_LINES = 20
+
+    def __init__(self, parser: WireGuardLogParser, unit: str = 'wg-quick@wg0',
+                 command: Optional[List[str]] = None, save_every: int = 100,
+                 save_interval: float = 5.0):
+        self.parser = parser
+        self.unit = unit
+        self.command = command or os.getenv('JOURNALCTL_COMMAND', 'journalctl').split()
+        self.checkpoint_key = f"journal:{unit}"
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.process = None
+        self.cursor = None
+        self.returncode = None
+        self.stderr_tail = deque(maxlen=self.STDERR_LINES)
+        self.stopping = False
+
+    def build_command(self) -> List[str]:
+        cmd = self.command + ['-u', self.unit, '--no-pager', '--output=json', '--follow']
+        checkpoint = self.parser.checkpoints.get(self.checkpoint_key)
+        if checkpoint and checkpoint.get('cursor'):
+            cmd.append(f"--after-cursor={checkpoint['cursor']}")
+        else:
+            cmd += ['-n', '1000']
+        return cmd
+
+    def follow(self) -> Iterator[WireGuardConnection]:
+        """Yield parsed connection events as journald produces them"""
+        cmd = self.build_command()
+        logger.info(f"Following journal with: {' '.join(cmd)}")
+        self.returncode = None
+        self.stderr_tail.clear()
+        self.process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        # Drained concurrently so that a chatty stderr cannot fill its pipe and block journalctl
+        stderr_reader = threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True)
+        stderr_reader.start()
+        self.parser.current_source = "journalctl (follow)"
+        unsaved = 0
+        last_save = time.monotonic()
+        try:
+            for raw_entry in self.process.stdout:
+                try:
+                    entry = json.loads(raw_entry)
+                except ValueError:
+                    logger.warning(f"Skipping malformed journal entry: {raw_entry[:200]}")
+                    continue
+
+                message = entry.get('MESSAGE')
+                if isinstance(message, list):
+                    # journald encodes non UTF-8 messages as byte arrays
+                    message = bytes(message).decode('utf-8', errors='replace')
+                if message:
+                    timestamp = None
+                    if entry.get('__REALTIME_TIMESTAMP'):
+                        timestamp = datetime.fromtimestamp(int(entry['__REALTIME_TIMESTAMP']) / 1e6)
+                    conn = self.parser.parse_line(message, timestamp)
+                    if conn:
+                        yield conn
+
+                self.cursor = entry.get('__CURSOR', self.cursor)
+                unsaved += 1
+                if (unsaved >= self.save_every or
+                        time.monotonic() - last_save >= self.save_interval):
+                    self.save_cursor()
+                    unsaved = 0
+                    last_save = time.monotonic()
+
+            self.returncode = self.process.wait()
+            stderr_reader.join(timeout=1.0)
+            if not self.stopping:
+                details = ' | '.join(self.stderr_tail) or 'no output on stderr'
+                logger.error(f"journalctl exited with code {self.returncode}: {details}")
+        finally:
+            self.save_cursor()
+            self._terminate()
+
+    def _read_stderr(self, process: subprocess.Popen):
+        for line in process.stderr:
+            line = line.strip()
+            if line:
+                self.stderr_tail.append(line)
+
+    def save_cursor(self):
+        if self.cursor:
+            self.parser.checkpoints.set(self.checkpoint_key, {'cursor': self.cursor})
+
+    def stop(self):
+        """Terminate the journalctl process for good"""
+        self.stopping = True
+        self._terminate()
+
+    def _terminate(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=2.0)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
@@ -1,16 +1,16 @@
+import os
 import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
 from database import Database
 from log_parser import WireGuardLogParser
-from utils import create_connection_timeline, create_traffic_graph
+from cache import CachedQueries
 from security_monitor import SecurityMonitor
 from models import AlertRule
+from rule_engine import parse_scope
 
-# Initialize database, parser and security monitor
-db = Database()
-parser = WireGuardLogParser()
-security_monitor = SecurityMonitor(db)
+# Seconds a page's tables stay cached; they are also refreshed as soon as new data is stored
+QUERY_TTL = int(os.getenv('DASHBOARD_CACHE_TTL', '300'))
 
 # Page configuration
 st.set_page_config(
@@ -19,6 +19,56 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource(show_spinner=False)
+def get_services():
+    """Database, parser and security monitor shared by every session and rerun
+
+    The script runs again on every interaction, so these are created and the
+    monitoring thread started only once per process.
+    """
+    db = Database()
+    parser = WireGuardLogParser()
+    security_monitor = SecurityMonitor(db)
+    security_monitor.start_monitoring()
+    # Query results and figures shared until new data is stored
+    queries = CachedQueries(db)
+    return db, parser, security_monitor, queries
+
+db, parser, security_monitor, queries = get_services()
+# Every cached query below is keyed by it, so a rerun without new data queries nothing else
+generation = db.get_generation()
+
+@st.cache_data(ttl=QUERY_TTL, max_entries=8, show_spinner=False)
+def load_active_connections(generation: int) -> pd.DataFrame:
+    return pd.DataFrame([
+        {
+            'Peer ID': conn.peer_id,
+            'IP Address': conn.ip_address,
+            'Connected Since': conn.timestamp,
+        }
+        for conn in queries.get_active_connections()
+    ])
+
+@st.cache_data(ttl=QUERY_TTL, max_entries=8, show_spinner=False)
+def load_connection_logs(generation: int) -> pd.DataFrame:
+    return pd.DataFrame([
+        {
+            'Timestamp': conn.timestamp,
+            'Peer ID': conn.peer_id,
+            'Event': conn.event_type.capitalize(),
+            'IP Address': conn.ip_address,
+        }
+        for conn in queries.get_connections(generation=generation)
+    ])
+
+# Ranges end now, so usage also changes without new data
+@st.cache_data(ttl=min(QUERY_TTL, 60), max_entries=32, show_spinner=False)
+def load_bandwidth_usage(time_range: str, generation: int) -> pd.DataFrame:
+    usage_df = pd.DataFrame(queries.get_bandwidth_usage(time_range))
+    if not usage_df.empty:
+        usage_df['Total Traffic'] = usage_df['total_bytes_sent'] + usage_df['total_bytes_received']
+    return usage_df
+
 # Title and description
 st.title("🔒 WireGuard Monitor")
 st.markdown("""
@@ -59,11 +109,25 @@ if page == "Alert Rules":
             )
             threshold = st.number_input("Threshold", min_value=0.0)
             time_window = st.number_input("Time Window (minutes)", min_value=1, value=5)
+            scope = st.selectbox(
+                "Scope",
+                ["global", "peer", "peer:", "subnet:"],
+                format_func=lambda x: {
+                    'global': 'All Peers',
+                    'peer': 'Each Peer',
+                    'peer:': 'One Peer',
+                    'subnet:': 'Subnet'
+                }[x]
+            )
+            scope_target = st.text_input("Peer ID or subnet (CIDR)", help="Only for the One Peer and Subnet scopes")
             action = st.selectbox("Action", ["email", "log"])
             description = st.text_area("Description")
             
             if st.form_submit_button("Add Rule"):
                 try:
+                    if scope.endswith(':'):
+                        scope += scope_target.strip()
+                        parse_scope(scope)
                     rule = AlertRule(
                         id=None,
                         name=name,
@@ -74,7 +138,8 @@ if page == "Alert Rules":
                         action=action,
                         enabled=True,
                         last_triggered=None,
-                        description=description
+                        description=description,
+                        scope=scope
                     )
                     db.add_alert_rule(rule)
                     st.success("Rule added successfully!")
@@ -91,6 +156,7 @@ if page == "Alert Rules":
                     st.write("**Event Type:**", rule.get_event_type_display())
                     st.write("**Condition:**", rule.get_condition_display())
                     st.write("**Threshold:**", rule.get_threshold_display())
+                    st.write("**Scope:**", rule.get_scope_display())
                 with col2:
                     st.write("**Time Window:**", f"{rule.time_window} minutes")
                     st.write("**Action:**", rule.action.capitalize())
@@ -117,16 +183,10 @@ if page == "Alert Rules":
 elif page == "Dashboard":
     # Active connections
     st.header("Active Connections")
-    active_connections = db.get_active_connections()
-    if active_connections:
-        active_df = pd.DataFrame([
-            {
-                'Peer ID': conn.peer_id,
-                'IP Address': conn.ip_address,
-                'Connected Since': conn.timestamp,
-                'Duration': str(datetime.now() - conn.timestamp).split('.')[0]
-            }
-            for conn in active_connections
+    active_df = load_active_connections(generation)
+    if not active_df.empty:
+        active_df = active_df.assign(Duration=[
+            str(datetime.now() - since).split('.')[0] for since in active_df['Connected Since']
         ])
         st.dataframe(active_df)
     else:
@@ -134,9 +194,9 @@ elif page == "Dashboard":
 
     # Connection history
     st.header("Connection History")
-    connections = db.get_connections()
+    connections = queries.get_connections(generation=generation)
     if connections:
-        timeline = create_connection_timeline(connections)
+        timeline = queries.connection_timeline()
         st.plotly_chart(timeline, use_container_width=True)
     else:
         st.info("No connection history available")
@@ -144,30 +204,21 @@ elif page == "Dashboard":
     # Traffic statistics
     st.header("Network Traffic")
     if connections:
-        traffic_graph = create_traffic_graph(connections)
+        traffic_graph = queries.traffic_graph()
         st.plotly_chart(traffic_graph, use_container_width=True)
     else:
         st.info("No traffic data available")
 
 elif page == "Connections":
     st.header("Connection History")
-    connections = db.get_connections()
+    connections = queries.get_connections(generation=generation)
     if connections:
-        timeline = create_connection_timeline(connections)
+        timeline = queries.connection_timeline()
         st.plotly_chart(timeline, use_container_width=True)
         
         # Detailed logs
         st.subheader("Detailed Connection Logs")
-        logs_df = pd.DataFrame([
-            {
-                'Timestamp': conn.timestamp,
-                'Peer ID': conn.peer_id,
-                'Event': conn.event_type.capitalize(),
-                'IP Address': conn.ip_address,
-            }
-            for conn in connections
-        ])
-        st.dataframe(logs_df)
+        st.dataframe(load_connection_logs(generation))
     else:
         st.info("No connection history available")
 
@@ -185,13 +236,8 @@ elif page == "Bandwidth":
         }[x]
     )
     
-    usage = db.get_bandwidth_usage(time_range)
-    if usage:
-        usage_df = pd.DataFrame(usage)
-        usage_df['Total Traffic'] = usage_df['total_bytes_sent'] + usage_df['total_bytes_received']
+    usage_df = load_bandwidth_usage(time_range, generation)
+    if not usage_df.empty:
         st.dataframe(usage_df)
     else:
         st.info("No bandwidth usage data available")
-
-# Initialize default alert rules if none exist
-security_monitor.start_monitoring()
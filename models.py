@@ -1,8 +1,9 @@
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional, Dict, Any
 
-@dataclass
+@dataclass(slots=True)
 class WireGuardConnection:
     id: int
     peer_id: str
@@ -25,6 +26,7 @@ class AlertRule:
     enabled: bool
     last_triggered: Optional[datetime]
     description: str
+    scope: str = 'global'  # 'global', 'peer' (each peer), 'peer:<peer id>' or 'subnet:<cidr>'
 
     def get_condition_display(self) -> str:
         """Get human-readable condition text"""
@@ -47,6 +49,17 @@ class AlertRule:
         }
         return event_types.get(self.event_type, self.event_type)
 
+    def get_scope_display(self) -> str:
+        """Get human-readable scope text"""
+        scopes = {
+            'global': 'All Peers',
+            'peer': 'Each Peer'
+        }
+        kind, _, target = self.scope.partition(':')
+        if target:
+            return f"{kind.capitalize()} {target}"
+        return scopes.get(self.scope, self.scope)
+
     def get_threshold_display(self) -> str:
         """Get formatted threshold value with units"""
         if self.event_type == 'traffic':
@@ -56,3 +69,38 @@ class AlertRule:
         elif self.event_type == 'connection':
             return f"{self.threshold:,.0f} connections"
         return str(self.threshold)
+
+@dataclass
+class RetentionPolicy:
+    """Days of history kept per storage tier; None keeps a tier forever"""
+    raw_days: Optional[int] = 7
+    minute_days: Optional[int] = 90
+    hour_days: Optional[int] = None
+    day_days: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> 'RetentionPolicy':
+        """Read RETENTION_*_DAYS variables; 0 or an empty value means forever"""
+        def days(name: str, default: Optional[int]) -> Optional[int]:
+            value = os.getenv(name)
+            if value is None:
+                return default
+            return int(value) if value.strip() and int(value) > 0 else None
+
+        return cls(
+            raw_days=days('RETENTION_RAW_DAYS', cls.raw_days),
+            minute_days=days('RETENTION_MINUTE_DAYS', cls.minute_days),
+            hour_days=days('RETENTION_HOUR_DAYS', cls.hour_days),
+            day_days=days('RETENTION_DAY_DAYS', cls.day_days)
+        )
+
+@dataclass
+class CompactionReport:
+    rows_deleted: Dict[str, int] = field(default_factory=dict)
+    bytes_reclaimed: int = 0
+    seconds: float = 0.0
+
+    def summary(self) -> str:
+        deleted = ', '.join(f"{table}: {count:,}" for table, count in self.rows_deleted.items())
+        return (f"deleted {sum(self.rows_deleted.values()):,} rows ({deleted or 'none'}), "
+                f"reclaimed {self.bytes_reclaimed:,} bytes in {self.seconds:.2f}s")
@@ -0,0 +1,225 @@
+"""In-memory window of the most recent samples of every peer
+
+Each peer owns a fixed-size ring of NumPy arrays (timestamp, rx, tx, event
+code), so memory is capacity x 25 bytes per peer whatever the event rate, and
+window queries are vectorized scans that never touch SQLite.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from models import WireGuardConnection
+
+logger = logging.getLogger('RecentWindow')
+
+EVENT_CODES = {'connect': 0, 'disconnect': 1, 'transfer': 2}
+EVENT_TYPES = {code: event_type for event_type, code in EVENT_CODES.items()}
+UNKNOWN_EVENT = -1
+
+class PeerRing:
+    """Fixed-capacity ring of one peer's samples, oldest overwritten first"""
+
+    __slots__ = ('capacity', 'timestamps', 'rx', 'tx', 'events', 'head', 'count',
+                 'public_key', 'ip_address')
+
+    def __init__(self, capacity: int, public_key: str = ''):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.rx = np.zeros(capacity, dtype=np.int64)
+        self.tx = np.zeros(capacity, dtype=np.int64)
+        self.events = np.zeros(capacity, dtype=np.int8)
+        self.head = 0  # next slot to write
+        self.count = 0
+        self.public_key = public_key
+        self.ip_address = ''
+
+    def extend(self, timestamps: np.ndarray, rx: np.ndarray, tx: np.ndarray, events: np.ndarray):
+        n = len(timestamps)
+        if n > self.capacity:
+            timestamps, rx, tx, events = (a[-self.capacity:] for a in (timestamps, rx, tx, events))
+            n = self.capacity
+        slots = (self.head + np.arange(n)) % self.capacity
+        self.timestamps[slots] = timestamps
+        self.rx[slots] = rx
+        self.tx[slots] = tx
+        self.events[slots] = events
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def _ordered(self, array: np.ndarray) -> np.ndarray:
+        if self.count < self.capacity:
+            return array[:self.count]
+        return np.roll(array, -self.head)
+
+    def window(self, since: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Samples with timestamp >= since, oldest first"""
+        timestamps = self._ordered(self.timestamps)
+        mask = timestamps >= since
+        return (timestamps[mask], self._ordered(self.rx)[mask],
+                self._ordered(self.tx)[mask], self._ordered(self.events)[mask])
+
+    @property
+    def oldest(self) -> Optional[float]:
+        if not self.count:
+            return None
+        return float(self.timestamps[self.head if self.count == self.capacity else 0])
+
+    def nbytes(self) -> int:
+        return self.timestamps.nbytes + self.rx.nbytes + self.tx.nbytes + self.events.nbytes
+
+class RecentWindow:
+    """Per-peer ring buffers of recent samples shared by the monitor's rules
+
+    Feed it either in-process with Database.add_listener(window.add_connections)
+    (attach()), or from another process by tailing new rows with catch_up().
+    """
+
+    def __init__(self, capacity: int = None, horizon: timedelta = timedelta(hours=1)):
+        self.capacity = capacity or int(os.getenv('RECENT_WINDOW_CAPACITY', '4096'))
+        # How far back catch_up() loads history the first time
+        self.horizon = horizon
+        self.peers: Dict[str, PeerRing] = {}
+        self.last_id = 0
+        self.attached = False
+        self._consumers: List[Callable[[List[WireGuardConnection]], None]] = []
+        # Reentrant so that consumers may query the window they are fed from
+        self._lock = threading.RLock()
+
+    def attach(self, db):
+        """Receive every batch committed through db, starting with the recent history"""
+        self.catch_up(db)
+        db.add_listener(self.add_connections)
+        self.attached = True
+
+    def catch_up(self, db, batch_size: int = 10000) -> int:
+        """Load the rows stored since the last call; a no-op once attached"""
+        if self.attached:
+            return 0
+        if not self.last_id:
+            # Read first: rows stored meanwhile are either loaded below or have higher ids
+            last_id = db.max_connection_id()
+            connections = db.get_connections_between(datetime.now() - self.horizon)
+            self.add_connections(connections)
+            self.last_id = max(self.last_id, last_id)
+            return len(connections)
+
+        loaded = 0
+        while True:
+            connections = db.get_connections_since(self.last_id, limit=batch_size)
+            self.add_connections(connections)
+            loaded += len(connections)
+            if len(connections) < batch_size:
+                return loaded
+
+    def subscribe(self, consumer: Callable[[List[WireGuardConnection]], None]):
+        """Hand every batch to consumer right after it is stored, under the window lock
+
+        Consumers thereby see each event exactly once, including events that
+        arrive while replay() is running.
+        """
+        self._consumers.append(consumer)
+
+    def replay(self, since: datetime, consumer: Callable[[List[WireGuardConnection]], None]):
+        """Feed consumer the samples held since `since`, oldest first, with no batch interleaved"""
+        with self._lock:
+            consumer(self.recent(since, limit=None))
+
+    def add_connections(self, connections: Iterable[WireGuardConnection]):
+        """Append a batch of events, grouped per peer"""
+        connections = list(connections)
+        groups: Dict[str, List[WireGuardConnection]] = {}
+        for connection in connections:
+            groups.setdefault(connection.peer_id, []).append(connection)
+        if not groups:
+            return
+
+        with self._lock:
+            for peer_id, events in groups.items():
+                ring = self.peers.get(peer_id)
+                if ring is None:
+                    ring = self.peers[peer_id] = PeerRing(self.capacity, events[0].public_key)
+                ring.extend(
+                    np.fromiter((c.timestamp.timestamp() for c in events), np.float64, len(events)),
+                    np.fromiter((c.bytes_received for c in events), np.int64, len(events)),
+                    np.fromiter((c.bytes_sent for c in events), np.int64, len(events)),
+                    np.fromiter((EVENT_CODES.get(c.event_type, UNKNOWN_EVENT) for c in events),
+                                np.int8, len(events)),
+                )
+                for connection in reversed(events):
+                    if connection.ip_address:
+                        ring.ip_address = connection.ip_address
+                        break
+                self.last_id = max(self.last_id, max(c.id for c in events))
+            for consumer in self._consumers:
+                consumer(connections)
+
+    def _windows(self, since: datetime, peer_id: Optional[str] = None):
+        cutoff = since.timestamp()
+        with self._lock:
+            rings = self.peers.items() if peer_id is None else (
+                [(peer_id, self.peers[peer_id])] if peer_id in self.peers else [])
+            return [(pid, ring.window(cutoff)) for pid, ring in rings]
+
+    def traffic(self, since: datetime, peer_id: Optional[str] = None) -> Tuple[int, Optional[float], Optional[float]]:
+        """Total bytes of the samples since `since`, with their first and last epoch timestamps"""
+        total = 0
+        first = last = None
+        for _, (timestamps, rx, tx, _) in self._windows(since, peer_id):
+            if not len(timestamps):
+                continue
+            total += int(rx.sum() + tx.sum())
+            low, high = float(timestamps.min()), float(timestamps.max())
+            first = low if first is None else min(first, low)
+            last = high if last is None else max(last, high)
+        return total, first, last
+
+    def event_count(self, since: datetime, event_type: str = 'connect',
+                    peer_id: Optional[str] = None) -> int:
+        code = EVENT_CODES[event_type]
+        return sum(int(np.count_nonzero(events == code))
+                   for _, (_, _, _, events) in self._windows(since, peer_id))
+
+    def recent(self, since: datetime, limit: Optional[int] = 5, event_type: Optional[str] = None,
+               peer_id: Optional[str] = None) -> List[WireGuardConnection]:
+        """The latest `limit` samples since `since` (all with None), oldest first"""
+        samples = []
+        code = EVENT_CODES.get(event_type) if event_type else None
+        for peer_id, (timestamps, rx, tx, events) in self._windows(since, peer_id):
+            ring = self.peers[peer_id]
+            indices = np.arange(len(timestamps))
+            if code is not None:
+                indices = indices[events == code]
+            if limit is not None:
+                indices = indices[-limit:]
+            for i in indices:
+                samples.append(WireGuardConnection(
+                    id=0,
+                    peer_id=peer_id,
+                    public_key=ring.public_key,
+                    timestamp=datetime.fromtimestamp(timestamps[i]),
+                    event_type=EVENT_TYPES.get(int(events[i]), 'unknown'),
+                    ip_address=ring.ip_address,
+                    bytes_received=int(rx[i]),
+                    bytes_sent=int(tx[i]),
+                ))
+        samples.sort(key=lambda sample: sample.timestamp)
+        return samples if limit is None else samples[-limit:]
+
+    def peer_addresses(self) -> Dict[str, str]:
+        """Last endpoint seen for every peer"""
+        with self._lock:
+            return {peer_id: ring.ip_address for peer_id, ring in self.peers.items()}
+
+    def coverage(self, peer_id: str) -> Optional[datetime]:
+        """Oldest sample still held for a peer, i.e. how far back its windows are exact"""
+        ring = self.peers.get(peer_id)
+        oldest = ring.oldest if ring else None
+        return datetime.fromtimestamp(oldest) if oldest is not None else None
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(ring.nbytes() for ring in self.peers.values())
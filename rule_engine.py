@@ -0,0 +1,481 @@
+"""Incremental evaluation of the sliding-window alert rules
+
+Instead of rescanning the recent connections for every rule on every cycle,
+each distinct (event type, window) keeps running per-peer aggregates that
+are updated once per incoming event and once per expiring second, so
+evaluating a rule costs O(1) amortized per event whatever the number of
+cycles.
+
+Events are expected in timestamp order, as the collector and the journal
+produce them. They are aggregated per peer into one-second buckets, which
+are expired whole: a window reaches back to the start of the second holding
+its cutoff, and memory is bounded by the window length, not the event rate.
+The value of a rule on all peers is combined from the per-peer buckets.
+
+CompiledRules evaluates many rules at once: their parameters are compiled
+into arrays and compared with the per-peer aggregates of every window in a
+single vectorized pass.
+"""
+import ipaddress
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from models import AlertRule, WireGuardConnection
+
+logger = logging.getLogger('RuleEngine')
+
+# Rule types whose value is a function of the events in a sliding window
+WINDOWED_EVENT_TYPES = ('traffic', 'connection')
+
+# Timestamps are compared as integer microseconds, which keeps rates
+# bit-identical to the timedelta arithmetic of the list evaluators
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+SECOND = timedelta(seconds=1)
+
+def bucket_of(timestamp: datetime) -> int:
+    """Whole second holding timestamp: events are aggregated and expired per second"""
+    return (timestamp - EPOCH) // SECOND
+
+class TrafficAggregate:
+    """Bytes and first/last timestamps of the events in one window
+
+    Events are folded into one [second, bytes, samples] bucket per second,
+    so memory depends on the window length, not on the event rate. A
+    window reaches back to the start of the second holding its cutoff.
+    """
+
+    __slots__ = ('buckets', 'total_bytes', 'samples', 'minimum', 'maximum', 'last_second')
+
+    def __init__(self):
+        self.buckets = deque()  # [second, bytes, samples] in arrival order
+        self.total_bytes = 0
+        self.samples = 0
+        # Second of the latest event: the group is dropped once it leaves the window
+        self.last_second = None
+        # Monotonic queues of (second, timestamp) candidates for min and max,
+        # at most one per second
+        self.minimum = deque()
+        self.maximum = deque()
+
+    def add(self, timestamp: datetime, size: int):
+        second = bucket_of(timestamp)
+        self.last_second = second
+        buckets = self.buckets
+        if buckets and buckets[-1][0] == second:
+            buckets[-1][1] += size
+            buckets[-1][2] += 1
+        else:
+            buckets.append([second, size, 1])
+        self.total_bytes += size
+        self.samples += 1
+
+        minimum = self.minimum
+        if not (minimum and minimum[-1][0] == second and minimum[-1][1] <= timestamp):
+            while minimum and minimum[-1][1] > timestamp:
+                minimum.pop()
+            minimum.append((second, timestamp))
+        maximum = self.maximum
+        if not (maximum and maximum[-1][0] == second and maximum[-1][1] >= timestamp):
+            while maximum and maximum[-1][1] < timestamp:
+                maximum.pop()
+            maximum.append((second, timestamp))
+
+    def expire(self, cutoff: datetime):
+        cutoff_second = bucket_of(cutoff)
+        buckets = self.buckets
+        while buckets and buckets[0][0] < cutoff_second:
+            _, size, samples = buckets.popleft()
+            self.total_bytes -= size
+            self.samples -= samples
+        while self.minimum and self.minimum[0][0] < cutoff_second:
+            self.minimum.popleft()
+        while self.maximum and self.maximum[0][0] < cutoff_second:
+            self.maximum.popleft()
+
+    def value(self) -> Optional[float]:
+        """Average bytes per second over the window, None when undefined"""
+        if not self.samples:
+            return None
+        time_span = (self.maximum[0][1] - self.minimum[0][1]).total_seconds()
+        if time_span <= 0:
+            return None
+        return self.total_bytes / time_span
+
+class ConnectionAggregate:
+    """Number of connect events in one window, in one [second, count] bucket per second"""
+
+    __slots__ = ('buckets', 'count', 'last_second')
+
+    def __init__(self):
+        self.buckets = deque()
+        self.count = 0
+        # Second of the latest event of any type, connect or not
+        self.last_second = None
+
+    def touch(self, timestamp: datetime):
+        """Record an event that is not a connect: the peer stays known, with its count"""
+        self.last_second = bucket_of(timestamp)
+
+    def add(self, timestamp: datetime, size: int):
+        second = bucket_of(timestamp)
+        self.last_second = second
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([second, 1])
+        self.count += 1
+
+    def expire(self, cutoff: datetime):
+        cutoff_second = bucket_of(cutoff)
+        buckets = self.buckets
+        while buckets and buckets[0][0] < cutoff_second:
+            self.count -= buckets.popleft()[1]
+
+    def value(self) -> Optional[float]:
+        return self.count
+
+class WindowState:
+    """Per-peer aggregates of one (event type, window)
+
+    A peer is known while it has an event of any type in the window; its
+    aggregate is dropped once its latest event leaves it.
+    """
+
+    def __init__(self, event_type: str, time_window: int):
+        self.event_type = event_type
+        self.window = timedelta(minutes=time_window)
+        self.aggregate = TrafficAggregate if event_type == 'traffic' else ConnectionAggregate
+        self.groups: Dict[str, object] = {}
+
+    def add(self, connections: Iterable[WireGuardConnection]):
+        traffic = self.event_type == 'traffic'
+        for connection in connections:
+            group = self.groups.get(connection.peer_id)
+            if group is None:
+                # Any event makes a peer known, so that 'lt' rules see its zero count
+                group = self.groups[connection.peer_id] = self.aggregate()
+            if not traffic and connection.event_type != 'connect':
+                group.touch(connection.timestamp)
+                continue
+            group.add(connection.timestamp, connection.bytes_sent + connection.bytes_received)
+
+    def expire(self, now: datetime):
+        cutoff = now - self.window
+        cutoff_second = bucket_of(cutoff)
+        idle = []
+        for peer_id, group in self.groups.items():
+            group.expire(cutoff)
+            if group.last_second < cutoff_second:
+                idle.append(peer_id)
+        for peer_id in idle:
+            del self.groups[peer_id]
+
+    def values(self, now: datetime) -> Dict[str, Optional[float]]:
+        self.expire(now)
+        return {peer_id: group.value() for peer_id, group in self.groups.items()}
+
+    def global_value(self, now: datetime) -> Optional[float]:
+        """Value over the events of every peer"""
+        self.expire(now)
+        groups = list(self.groups.values())
+        if self.event_type != 'traffic':
+            return sum(group.count for group in groups)
+        groups = [group for group in groups if group.samples]
+        if not groups:
+            return None
+        time_span = (max(group.maximum[0][1] for group in groups)
+                     - min(group.minimum[0][1] for group in groups)).total_seconds()
+        if time_span <= 0:
+            return None
+        return sum(group.total_bytes for group in groups) / time_span
+
+class SlidingWindowEngine:
+    """Running window aggregates for the traffic and connection rules
+
+    Fed with every new batch of events (see RecentWindow.subscribe()); a
+    state created for a new rule is seeded from the recent window.
+    """
+
+    def __init__(self, recent=None):
+        self.recent = recent
+        self.states: Dict[Tuple[str, int], WindowState] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def handles(rule: AlertRule) -> bool:
+        return rule.event_type in WINDOWED_EVENT_TYPES
+
+    @staticmethod
+    def _key(rule: AlertRule) -> Tuple[str, int]:
+        return rule.event_type, rule.time_window
+
+    def sync_rules(self, rules: Iterable[AlertRule]):
+        """Keep per-peer states for the windows of the enabled rules, drop the others
+
+        These are the states CompiledRules reads from; the value of a rule
+        on all peers is derived from them too.
+        """
+        windows = {rule.time_window for rule in rules if rule.enabled and self.handles(rule)}
+        wanted = {(event_type, window) for window in windows for event_type in WINDOWED_EVENT_TYPES}
+        with self._lock:
+            for key in set(self.states) - wanted:
+                del self.states[key]
+        for key in wanted:
+            self._ensure_state(key)
+
+    def _ensure_state(self, key: Tuple[str, int]):
+        if key in self.states:
+            return
+        state = WindowState(*key)
+
+        def seed(history: List[WireGuardConnection]):
+            with self._lock:
+                if key not in self.states:
+                    state.add(history)
+                    self.states[key] = state
+
+        if self.recent is None:
+            seed([])
+        else:
+            # Holds the recent window's lock, so no batch is missed or counted twice
+            self.recent.replay(datetime.now() - state.window, seed)
+
+    def add_connections(self, connections: List[WireGuardConnection]):
+        with self._lock:
+            for state in self.states.values():
+                state.add(connections)
+
+    def values(self, rule: AlertRule, now: Optional[datetime] = None) -> Dict[Optional[str], Optional[float]]:
+        """Current value of a global or per-peer rule: one None key, or one key per peer"""
+        now = now or datetime.now()
+        self._ensure_state(self._key(rule))
+        with self._lock:
+            state = self.states.get(self._key(rule))
+            if state is None:
+                return {}
+            if rule.scope == 'global':
+                return {None: state.global_value(now)}
+            return state.values(now)
+
+    def peer_aggregates(self, windows: List[int], now: Optional[datetime] = None) -> 'PeerAggregates':
+        """Per-peer window aggregates as [peers x windows] arrays"""
+        now = now or datetime.now()
+        for window in windows:
+            for event_type in WINDOWED_EVENT_TYPES:
+                self._ensure_state((event_type, window))
+
+        with self._lock:
+            traffic = [self.states[('traffic', window)] for window in windows]
+            connection = [self.states[('connection', window)] for window in windows]
+            for state in traffic + connection:
+                state.expire(now)
+            peers = sorted(set().union(*(state.groups for state in traffic + connection)))
+            index = {peer_id: i for i, peer_id in enumerate(peers)}
+            aggregates = PeerAggregates(peers, len(windows))
+            for j, (traffic_state, connection_state) in enumerate(zip(traffic, connection)):
+                for peer_id, group in traffic_state.groups.items():
+                    if not group.samples:
+                        continue
+                    i = index[peer_id]
+                    aggregates.samples[i, j] = group.samples
+                    aggregates.total_bytes[i, j] = group.total_bytes
+                    aggregates.first[i, j] = (group.minimum[0][1] - EPOCH) // MICROSECOND
+                    aggregates.last[i, j] = (group.maximum[0][1] - EPOCH) // MICROSECOND
+                for peer_id, group in connection_state.groups.items():
+                    aggregates.known[index[peer_id], j] = True
+                    aggregates.connects[index[peer_id], j] = group.count
+        return aggregates
+
+class PeerAggregates:
+    """Window aggregates of every peer: row i is peers[i], column j is the j-th window"""
+
+    def __init__(self, peers: List[str], windows: int):
+        self.peers = peers
+        shape = (len(peers), windows)
+        self.samples = np.zeros(shape, dtype=np.int64)
+        self.total_bytes = np.zeros(shape, dtype=np.int64)
+        self.first = np.full(shape, np.iinfo(np.int64).max, dtype=np.int64)
+        self.last = np.full(shape, np.iinfo(np.int64).min, dtype=np.int64)
+        self.connects = np.zeros(shape, dtype=np.int64)
+        # Whether the peer had any event in the window, as WindowState.groups
+        self.known = np.zeros(shape, dtype=bool)
+
+    def combine(self, members: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """Aggregates of groups of peers, from a [groups x peers] membership mask"""
+        selected = members[:, :, None]
+        return (
+            (self.samples[None] * selected).sum(axis=1),
+            (self.total_bytes[None] * selected).sum(axis=1),
+            np.where(selected, self.first[None], np.iinfo(np.int64).max).min(axis=1, initial=np.iinfo(np.int64).max),
+            np.where(selected, self.last[None], np.iinfo(np.int64).min).max(axis=1, initial=np.iinfo(np.int64).min),
+            (self.connects[None] * selected).sum(axis=1),
+        )
+
+CONDITION_CODES = {'gt': 0, 'lt': 1, 'eq': 2}
+TRAFFIC, CONNECTION = 0, 1
+SCOPE_GLOBAL, SCOPE_EACH_PEER, SCOPE_PEER, SCOPE_SUBNET = range(4)
+
+def parse_scope(scope: str) -> Tuple[int, Optional[str]]:
+    """'global', 'peer' (each peer), 'peer:<peer id>' or 'subnet:<cidr>'"""
+    if scope == 'global':
+        return SCOPE_GLOBAL, None
+    if scope == 'peer':
+        return SCOPE_EACH_PEER, None
+    kind, _, target = scope.partition(':')
+    if kind == 'peer' and target:
+        return SCOPE_PEER, target
+    if kind == 'subnet' and target:
+        return SCOPE_SUBNET, str(ipaddress.ip_network(target, strict=False))
+    raise ValueError(f"Unknown rule scope: {scope}")
+
+class CompiledRules:
+    """Traffic and connection rules compiled into parameter arrays
+
+    evaluate() computes the value of every rule from PeerAggregates with a
+    handful of array operations, whatever the number of rules.
+    """
+
+    # Largest [peers x rules] block evaluated at once for the per-peer rules
+    MAX_BLOCK = 1 << 20
+
+    def __init__(self, rules: Iterable[AlertRule]):
+        self.rules = []
+        scopes = []
+        for rule in rules:
+            if not rule.enabled or rule.event_type not in WINDOWED_EVENT_TYPES:
+                continue
+            try:
+                scopes.append(parse_scope(rule.scope))
+            except ValueError as e:
+                logger.error(f"Skipping rule '{rule.name}': {str(e)}")
+                continue
+            self.rules.append(rule)
+        self.windows = sorted({rule.time_window for rule in self.rules})
+        window_index = {window: j for j, window in enumerate(self.windows)}
+
+        self.subnets = sorted({target for kind, target in scopes if kind == SCOPE_SUBNET})
+        self.networks = [ipaddress.ip_network(subnet) for subnet in self.subnets]
+        subnet_index = {subnet: g for g, subnet in enumerate(self.subnets)}
+
+        self.threshold = np.array([rule.threshold for rule in self.rules], dtype=np.float64)
+        self.window = np.array([window_index[rule.time_window] for rule in self.rules], dtype=np.intp)
+        # 'contains' compares strings and is evaluated one rule at a time
+        self.condition = np.array([CONDITION_CODES.get(rule.condition, -1) for rule in self.rules],
+                                  dtype=np.int8)
+        self.kind = np.array([TRAFFIC if rule.event_type == 'traffic' else CONNECTION
+                              for rule in self.rules], dtype=np.int8)
+        self.scope = np.array([kind for kind, _ in scopes], dtype=np.int8)
+        self.subnet = np.array([subnet_index.get(target, -1) if kind == SCOPE_SUBNET else -1
+                                for kind, target in scopes], dtype=np.intp)
+        self.peer_targets = [target if kind == SCOPE_PEER else None for kind, target in scopes]
+        self.targeted = [(r, target) for r, target in enumerate(self.peer_targets) if target is not None]
+        self.contains = self.condition < 0
+        self._addresses: Dict[str, Optional[ipaddress._BaseAddress]] = {}
+
+    def _address(self, address: str):
+        if address not in self._addresses:
+            try:
+                self._addresses[address] = ipaddress.ip_address(address)
+            except ValueError:
+                self._addresses[address] = None
+        return self._addresses[address]
+
+    def _subnet_members(self, peers: List[str], addresses: Dict[str, str]) -> np.ndarray:
+        """[all peers + subnets] x peers membership mask"""
+        members = np.ones((1 + len(self.networks), len(peers)), dtype=bool)
+        if not self.networks:
+            return members
+        parsed = [self._address(addresses.get(peer_id, '')) for peer_id in peers]
+        ipv4 = np.array([int(address) if address is not None and address.version == 4 else -1
+                         for address in parsed], dtype=np.int64)
+        for g, network in enumerate(self.networks, start=1):
+            if network.version == 4:
+                members[g] = (ipv4 >= 0) & ((ipv4 & int(network.netmask)) == int(network.network_address))
+            else:
+                members[g] = [address is not None and address in network for address in parsed]
+        return members
+
+    @staticmethod
+    def _compare(values: np.ndarray, threshold: np.ndarray, condition: np.ndarray) -> np.ndarray:
+        # NaN (no data) compares false everywhere, like an undefined rate
+        with np.errstate(invalid='ignore'):
+            return (((condition == 0) & (values > threshold))
+                    | ((condition == 1) & (values < threshold))
+                    | ((condition == 2) & (np.abs(values - threshold) < 0.0001)))
+
+    def evaluate(self, engine: SlidingWindowEngine, addresses: Dict[str, str] = None,
+                 now: Optional[datetime] = None) -> List[Tuple[AlertRule, List[Optional[str]]]]:
+        """Triggered rules with their groups: the offending peers, or [None] for a group of peers
+
+        Cooldowns are left to the caller.
+        """
+        if not self.rules:
+            return []
+        addresses = addresses or {}
+        aggregates = engine.peer_aggregates(self.windows, now)
+        peers = aggregates.peers
+        count = len(peers)
+
+        # Rows: one per peer, then all peers, then each subnet, then an empty row
+        # for peers that have not been seen
+        group_totals = aggregates.combine(self._subnet_members(peers, addresses))
+        samples, total_bytes, first, last, connects = (
+            np.concatenate([own, grouped, np.zeros((1, len(self.windows)), dtype=np.int64)])
+            for own, grouped in zip(
+                (aggregates.samples, aggregates.total_bytes, aggregates.first,
+                 aggregates.last, aggregates.connects),
+                group_totals)
+        )
+        defined = samples > 0
+        span = (np.where(defined, last, 0) - np.where(defined, first, 0)).astype(np.float64) / 1e6
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(defined & (span > 0), total_bytes / span, np.nan)
+        tables = np.stack([rate, connects.astype(np.float64)])  # [kind, row, window]
+
+        peer_index = {peer_id: i for i, peer_id in enumerate(peers)}
+        empty_row = count + 1 + len(self.subnets)
+        rows = np.where(self.scope == SCOPE_GLOBAL, count, empty_row)
+        rows = np.where(self.scope == SCOPE_SUBNET, count + 1 + self.subnet, rows)
+        for r, target in self.targeted:
+            rows[r] = peer_index.get(target, empty_row)
+
+        results = []
+        single = np.flatnonzero(self.scope != SCOPE_EACH_PEER)
+        values = tables[self.kind[single], rows[single], self.window[single]]
+        hits = self._compare(values, self.threshold[single], self.condition[single])
+        for position in np.flatnonzero(self.contains[single]):
+            hits[position] = self._contains(self.rules[single[position]], values[position])
+        for position in np.flatnonzero(hits):
+            r = single[position]
+            results.append((self.rules[r], [self.peer_targets[r]]))
+
+        each_peer = np.flatnonzero(self.scope == SCOPE_EACH_PEER)
+        # Bounded [peers x rules] blocks of the per-peer rules
+        chunk = max(1, self.MAX_BLOCK // max(count, 1))
+        for start in range(0, len(each_peer) if count else 0, chunk):
+            each = each_peer[start:start + chunk]
+            matrix = tables[self.kind[each][None, :], np.arange(count)[:, None], self.window[each][None, :]]
+            hits = self._compare(matrix, self.threshold[each][None, :], self.condition[each][None, :])
+            for position in np.flatnonzero(self.contains[each]):
+                rule = self.rules[each[position]]
+                hits[:, position] = [self._contains(rule, value) for value in matrix[:, position]]
+            # A peer silent for a whole window is not checked against it, not even for 'lt'
+            hits &= aggregates.known[:, self.window[each]]
+            for position in np.flatnonzero(hits.any(axis=0)):
+                offending = [peers[i] for i in np.flatnonzero(hits[:, position])]
+                results.append((self.rules[each[position]], offending))
+        return results
+
+    @staticmethod
+    def _contains(rule: AlertRule, value: float) -> bool:
+        if np.isnan(value):
+            return False
+        if rule.event_type == 'connection':
+            value = int(value)
+        return str(rule.threshold) in str(value)
@@ -0,0 +1,86 @@
+"""Alert rules cached in memory and reloaded only when they change
+
+The rules table is versioned (Database.get_rule_version()): the registry
+reloads when the version moved. The version itself is only read when
+SQLite's data_version shows that some other connection committed, so a
+cycle without rule changes costs a single pragma. Trigger times are kept in
+memory and written back in one batch every flush_interval seconds.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from models import AlertRule
+
+logger = logging.getLogger('RuleRegistry')
+
+class RuleRegistry:
+    """The alert rules of a database, for the monitor"""
+
+    def __init__(self, db, flush_interval: float = 60.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.rules: List[AlertRule] = []
+        # Rule version of self.rules, None before the first load
+        self.version: Optional[int] = None
+        self.reloads = 0
+        # (thread, data_version, local rule changes) at the last check;
+        # data_version is per connection and connections are per thread
+        self._seen: Optional[Tuple[int, int, int]] = None
+        # Trigger times not written back yet, by rule id
+        self._triggered: Dict[int, datetime] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def changed(self) -> bool:
+        """Whether the stored rules may differ from the cached ones"""
+        seen = (threading.get_ident(), self.db.data_version(), self.db.rule_changes)
+        if self.version is not None and seen == self._seen:
+            return False
+        self._seen = seen
+        return self.db.get_rule_version() != self.version
+
+    def refresh(self) -> bool:
+        """Reload the rules if they changed; True when they were reloaded"""
+        if not self.changed():
+            return False
+        # Read the version first: a change landing in between is seen again next time
+        version = self.db.get_rule_version()
+        rules = self.db.get_alert_rules()
+        with self._lock:
+            for rule in rules:
+                triggered = self._triggered.get(rule.id)
+                if triggered and (rule.last_triggered is None or triggered > rule.last_triggered):
+                    rule.last_triggered = triggered
+        self.rules = rules
+        self.version = version
+        self.reloads += 1
+        logger.info(f"Loaded {len(rules)} alert rules (version {version})")
+        return True
+
+    def record_trigger(self, rule: AlertRule, when: Optional[datetime] = None):
+        """Start the cooldown of a rule now; stored at the next flush()"""
+        rule.last_triggered = when or datetime.now()
+        with self._lock:
+            self._triggered[rule.id] = rule.last_triggered
+
+    def flush(self, force: bool = False) -> int:
+        """Write back the pending trigger times, at most every flush_interval unless forced"""
+        if not force and time.monotonic() - self._last_flush < self.flush_interval:
+            return 0
+        with self._lock:
+            pending, self._triggered = self._triggered, {}
+        self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            self.db.update_rule_trigger_times(pending)
+        except Exception:
+            # Keep them for the next attempt, unless newer ones were recorded meanwhile
+            with self._lock:
+                for rule_id, triggered in pending.items():
+                    self._triggered.setdefault(rule_id, triggered)
+            raise
+        return len(pending)
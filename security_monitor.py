@@ -1,14 +1,15 @@
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 import os
 import logging
-from typing import List, Dict
-from collections import defaultdict
+from typing import List, Dict, Optional
+from collections import defaultdict, deque
 import threading
 import time
 from models import WireGuardConnection, AlertRule
+from alert_delivery import AlertDelivery
+from recent_window import RecentWindow
+from rule_engine import SlidingWindowEngine, CompiledRules
+from rule_registry import RuleRegistry
 
 # Configure logging
 logging.basicConfig(
@@ -18,13 +19,45 @@ logging.basicConfig(
 logger = logging.getLogger('SecurityMonitor')
 
 class SecurityMonitor:
-    def __init__(self, db):
+    def __init__(self, db, recent: RecentWindow = None, rule_interval: float = 60.0,
+                 poll_interval: float = 1.0):
         self.db = db
+        # Recent samples per peer; the traffic and connection rules read
+        # their windows from here instead of reloading rows every cycle
+        self.recent = recent or RecentWindow()
+        # Running aggregates of the traffic and connection rules, updated
+        # with each batch the recent window receives
+        self.engine = SlidingWindowEngine(self.recent)
+        self.recent.subscribe(self.engine.add_connections)
+        # Cooldowns of per-peer rules, by (rule id, peer id)
+        self.peer_last_triggered: Dict[tuple, datetime] = {}
+
+        # Window rules are evaluated as soon as new events arrive; the full
+        # pass (bandwidth and time-based rules) runs every rule_interval
+        # seconds, and window expiry is checked every poll_interval seconds,
+        # when the database is also tailed for events written by other
+        # processes and checked for rule changes
+        self.rule_interval = rule_interval
+        self.poll_interval = poll_interval
+        # Rules are reloaded only when they change; trigger times are written back lazily
+        self.registry = RuleRegistry(db)
+        self.rules: List[AlertRule] = []
+        # The window rules of self.rules, evaluated together in one vectorized pass
+        self.compiled = CompiledRules([])
+        self._events_pending = threading.Event()
+        self._pending_lock = threading.Lock()
+        self._pending_since: Optional[float] = None
+        # Seconds between events reaching the monitor and the end of their evaluation
+        self.detection_latencies = deque(maxlen=10000)
+        self.recent.subscribe(self._on_events)
         self.smtp_server = os.getenv("SMTP_SERVER", "localhost")
         self.smtp_port = int(os.getenv("SMTP_PORT", "25"))
         self.sender_email = os.getenv("SMTP_EMAIL")
         self.sender_password = os.getenv("SMTP_PASSWORD")
         self.recipient_email = os.getenv("ALERT_EMAIL")
+        # E-mails are sent by a background worker, never from the monitoring thread
+        self.delivery = AlertDelivery(self.smtp_server, self.smtp_port, self.sender_email,
+                                      self.sender_password, self.recipient_email)
         
         # Business hours (9 AM - 5 PM)
         self.business_hours_start = 9
@@ -47,11 +80,16 @@ class SecurityMonitor:
             return not self.is_business_hours()
         return False
 
-    def check_traffic_rules(self, rule: AlertRule, connections: List[WireGuardConnection]) -> bool:
+    def check_traffic_rules(self, rule: AlertRule,
+                            connections: Optional[List[WireGuardConnection]] = None,
+                            now: Optional[datetime] = None) -> bool:
         """Evaluate traffic-based alert rules"""
-        now = datetime.now()
+        now = now or datetime.now()
         window_start = now - timedelta(minutes=rule.time_window)
-        
+
+        if connections is None:
+            return bool(self.triggered_groups(rule))
+
         # Calculate traffic rate in the time window
         window_connections = [c for c in connections if c.timestamp >= window_start]
         if not window_connections:
@@ -67,17 +105,41 @@ class SecurityMonitor:
         bytes_per_second = total_bytes / time_span
         return self.evaluate_threshold(bytes_per_second, rule.threshold, rule.condition)
 
-    def check_connection_rules(self, rule: AlertRule, connections: List[WireGuardConnection]) -> bool:
+    def check_connection_rules(self, rule: AlertRule,
+                               connections: Optional[List[WireGuardConnection]] = None,
+                               now: Optional[datetime] = None) -> bool:
         """Evaluate connection-based alert rules"""
-        now = datetime.now()
+        now = now or datetime.now()
         window_start = now - timedelta(minutes=rule.time_window)
         
+        if connections is None:
+            return bool(self.triggered_groups(rule))
+
         # Count connections in the time window
         connection_count = sum(1 for c in connections 
                              if c.timestamp >= window_start and c.event_type == 'connect')
                              
         return self.evaluate_threshold(connection_count, rule.threshold, rule.condition)
 
+    def triggered_groups(self, rule: AlertRule) -> List[Optional[str]]:
+        """Groups whose running window value crosses the rule threshold
+
+        None stands for all peers together; per-peer rules yield the ids of
+        the peers over the threshold and not in their cooldown.
+        """
+        now = datetime.now()
+        results = CompiledRules([rule]).evaluate(self.engine, self.recent.peer_addresses(), now)
+        return self._not_cooling_down(rule, results[0][1], now) if results else []
+
+    def _not_cooling_down(self, rule: AlertRule, groups: List[Optional[str]],
+                          now: datetime) -> List[Optional[str]]:
+        if rule.scope != 'peer':
+            return groups
+        cooldown = rule.time_window * 60
+        return [peer_id for peer_id in groups
+                if not (self.peer_last_triggered.get((rule.id, peer_id))
+                        and (now - self.peer_last_triggered[(rule.id, peer_id)]).total_seconds() < cooldown)]
+
     def check_bandwidth_rules(self, rule: AlertRule) -> bool:
         """Evaluate bandwidth-based alert rules"""
         usage = self.db.get_bandwidth_usage('hour')
@@ -106,37 +168,27 @@ class SecurityMonitor:
             logger.warning(f"Alert Rule '{rule.name}' triggered: {message}")
             return
             
-        if not all([self.sender_email, self.recipient_email]):
+        if not self.delivery.configured:
             logger.error("Email configuration missing. Please set SMTP_EMAIL and ALERT_EMAIL")
             return
             
-        msg = MIMEMultipart()
-        msg['From'] = self.sender_email
-        msg['To'] = self.recipient_email
-        msg['Subject'] = f"WireGuard Security Alert: {subject}"
-        
         if rule:
             message = f"Alert Rule '{rule.name}' triggered:\n\n{message}"
         
-        msg.attach(MIMEText(message, 'plain'))
-        
-        try:
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            if self.sender_password:
-                server.login(self.sender_email, self.sender_password)
-            server.send_message(msg)
-            server.quit()
-            logger.info(f"Security alert sent: {subject}")
-        except Exception as e:
-            logger.error(f"Failed to send email alert: {str(e)}")
+        self.delivery.enqueue(subject, message)
 
-    def check_rule(self, rule: AlertRule, connections: List[WireGuardConnection]) -> bool:
-        """Check if a specific rule is triggered"""
+    def check_rule(self, rule: AlertRule,
+                   connections: Optional[List[WireGuardConnection]] = None) -> bool:
+        """Check if a specific rule is triggered
+
+        Windows are read from the recent window unless a list of connections is given.
+        """
         if not rule.enabled:
             return False
             
         now = datetime.now()
-        if (rule.last_triggered and 
+        # Per-peer rules keep one cooldown per peer, see triggered_groups()
+        if (rule.scope != 'peer' and rule.last_triggered and 
             (now - rule.last_triggered).total_seconds() < rule.time_window * 60):
             return False
             
@@ -155,39 +207,114 @@ class SecurityMonitor:
     def monitor(self):
         """Run all security checks"""
         try:
-            connections = self.db.get_connections(limit=1000)
-            rules = self.db.get_alert_rules()
+            self.recent.catch_up(self.db)
+            self.reload_rules()
+            self._prune_cooldowns(datetime.now())
             
-            for rule in rules:
-                if self.check_rule(rule, connections):
-                    message = self.generate_alert_message(rule, connections)
-                    self.send_alert(f"Rule Triggered: {rule.name}", message, rule)
-                    self.db.update_rule_trigger_time(rule.id)
-                    logger.info(f"Alert rule '{rule.name}' triggered")
+            for rule in self.rules:
+                if self.check_rule(rule):
+                    self.fire(rule)
+            self.registry.flush()
                     
         except Exception as e:
             logger.error(f"Error in monitoring routine: {str(e)}")
 
-    def generate_alert_message(self, rule: AlertRule, connections: List[WireGuardConnection]) -> str:
+    def reload_rules(self) -> bool:
+        """Pick up added, changed or deleted rules; a single pragma when there are none"""
+        if not self.registry.refresh():
+            return False
+        self.rules = self.registry.rules
+        self.compiled = CompiledRules(self.rules)
+        self.engine.sync_rules(self.rules)
+        return True
+
+    def _prune_cooldowns(self, now: datetime):
+        """Forget per-peer cooldowns that are over, and those of deleted rules"""
+        windows = {rule.id: rule.time_window * 60 for rule in self.rules}
+        expired = [key for key, triggered in self.peer_last_triggered.items()
+                   if key[0] not in windows or (now - triggered).total_seconds() >= windows[key[0]]]
+        for key in expired:
+            del self.peer_last_triggered[key]
+
+    def evaluate_window_rules(self):
+        """Check all traffic and connection rules against the running windows at once"""
+        now = datetime.now()
+        for rule, groups in self.compiled.evaluate(self.engine, self.recent.peer_addresses(), now):
+            if (rule.scope != 'peer' and rule.last_triggered and
+                (now - rule.last_triggered).total_seconds() < rule.time_window * 60):
+                continue
+            groups = self._not_cooling_down(rule, groups, now)
+            if groups:
+                self.fire(rule, groups)
+
+    def fire(self, rule: AlertRule, groups: Optional[List[Optional[str]]] = None):
+        """Send the alerts of a triggered rule and start its cooldown"""
+        if groups is None and self.engine.handles(rule):
+            groups = self.triggered_groups(rule)
+        if rule.scope == 'peer' and self.engine.handles(rule):
+            for peer_id in groups:
+                message = self.generate_alert_message(rule, peer_id=peer_id)
+                self.send_alert(f"Rule Triggered: {rule.name} (peer {peer_id})", message, rule)
+                self.peer_last_triggered[(rule.id, peer_id)] = datetime.now()
+        else:
+            peer_id = groups[0] if groups else None
+            message = self.generate_alert_message(rule, peer_id=peer_id)
+            self.send_alert(f"Rule Triggered: {rule.name}", message, rule)
+        self.registry.record_trigger(rule)
+        logger.info(f"Alert rule '{rule.name}' triggered")
+
+    def _on_events(self, connections: List[WireGuardConnection]):
+        """Wake the monitoring thread for a batch that was just stored"""
+        with self._pending_lock:
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+        self._events_pending.set()
+
+    def latency_stats(self) -> Dict[str, float]:
+        """Percentiles of the detection latency in milliseconds"""
+        latencies = sorted(self.detection_latencies)
+        if not latencies:
+            return {'count': 0}
+        def percentile(fraction: float) -> float:
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+        return {
+            'count': len(latencies),
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'max_ms': latencies[-1] * 1000,
+        }
+
+    def generate_alert_message(self, rule: AlertRule,
+                               connections: Optional[List[WireGuardConnection]] = None,
+                               peer_id: Optional[str] = None) -> str:
         """Generate detailed alert message based on rule type"""
         now = datetime.now()
         window_start = now - timedelta(minutes=rule.time_window)
-        window_connections = [c for c in connections if c.timestamp >= window_start]
+        if connections is None:
+            event_type = 'connect' if rule.event_type == 'connection' else None
+            window_connections = self.recent.recent(window_start, limit=5, event_type=event_type,
+                                                    peer_id=peer_id)
+            total_bytes = self.recent.traffic(window_start, peer_id)[0]
+            connect_count = self.recent.event_count(window_start, 'connect', peer_id)
+        else:
+            window_connections = [c for c in connections if c.timestamp >= window_start]
+            total_bytes = sum(c.bytes_sent + c.bytes_received for c in window_connections)
+            connect_count = sum(1 for c in window_connections if c.event_type == 'connect')
         
         message = f"Rule Type: {rule.event_type}\n"
+        if peer_id is not None:
+            message += f"Peer: {peer_id}\n"
         message += f"Condition: {rule.condition}\n"
         message += f"Threshold: {rule.threshold}\n"
         message += f"Time Window: {rule.time_window} minutes\n\n"
         
         if rule.event_type == 'traffic':
-            total_bytes = sum(c.bytes_sent + c.bytes_received for c in window_connections)
             message += f"Total Traffic: {total_bytes:,} bytes\n"
             message += "Recent Connections:\n"
             for conn in window_connections[-5:]:
                 message += f"- Peer {conn.peer_id}: {conn.bytes_sent + conn.bytes_received:,} bytes\n"
                 
         elif rule.event_type == 'connection':
-            connect_count = sum(1 for c in window_connections if c.event_type == 'connect')
             message += f"Connection Count: {connect_count}\n"
             message += "Recent Connections:\n"
             for conn in window_connections[-5:]:
@@ -210,14 +337,32 @@ class SecurityMonitor:
         return message
 
     def run_monitoring_thread(self):
-        """Background thread function to run periodic monitoring"""
+        """Background thread function: evaluate on new events, full pass every rule_interval"""
         logger.info("Starting monitoring thread")
+        next_full_pass = time.monotonic()
         while not self.stop_monitoring:
             try:
-                self.monitor()
+                if time.monotonic() >= next_full_pass:
+                    self.monitor()
+                    next_full_pass = time.monotonic() + self.rule_interval
+
+                self._events_pending.wait(self.poll_interval)
+                self._events_pending.clear()
+                if self.stop_monitoring:
+                    break
+                # Events written by another process only show up in the database
+                self.recent.catch_up(self.db)
+                self.reload_rules()
+
+                with self._pending_lock:
+                    pending_since, self._pending_since = self._pending_since, None
+                # Also runs without new events, so that windows expire on time
+                self.evaluate_window_rules()
+                if pending_since is not None:
+                    self.detection_latencies.append(time.monotonic() - pending_since)
             except Exception as e:
                 logger.error(f"Error in monitoring thread: {str(e)}")
-            time.sleep(60)  # Check every minute
+                time.sleep(self.poll_interval)
     
     def start_monitoring(self):
         """Start the background monitoring thread"""
@@ -231,9 +376,15 @@ class SecurityMonitor:
     def stop_monitoring_thread(self):
         """Stop the background monitoring thread"""
         self.stop_monitoring = True
+        self._events_pending.set()
         if self.monitoring_thread:
             try:
                 self.monitoring_thread.join(timeout=2.0)
             except Exception as e:
                 logger.error(f"Error stopping monitoring thread: {e}")
             logger.info("Security monitoring stopped")
+        try:
+            self.registry.flush(force=True)
+        except Exception as e:
+            logger.error(f"Error storing rule trigger times: {e}")
+        self.delivery.stop()
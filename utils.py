@@ -4,6 +4,7 @@ import pandas as pd
 import logging
 from typing import List
 from models import WireGuardConnection
+from downsampling import DEFAULT_WIDTH, downsample_series, timeline_segments
 
 # Configure logging
 logging.basicConfig(
@@ -12,8 +13,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger('Utils')
 
-def create_connection_timeline(connections: List[WireGuardConnection]):
-    """Create a timeline visualization of connections"""
+def create_connection_timeline(connections: List[WireGuardConnection], width: int = DEFAULT_WIDTH):
+    """Create a timeline visualization of connections
+
+    Events are merged into per-peer state segments, at most one per pixel
+    of a chart `width` pixels wide.
+    """
     logger.debug("Creating connection timeline visualization")
     
     if not connections:
@@ -51,12 +56,16 @@ def create_connection_timeline(connections: List[WireGuardConnection]):
             fig.update_layout(title='Connection Timeline - No Data')
             return fig
             
+        segments = timeline_segments(df, width)
+        logger.debug(f"Merged {len(df)} events into {len(segments)} timeline segments")
+        
         fig = px.timeline(
-            df,
+            segments,
             x_start='start',
+            x_end='end',
             y='peer_id',
             color='event_type',
-            hover_data=['ip_address'],
+            hover_data=['ip_address', 'events'],
             title='Connection Timeline'
         )
         
@@ -85,8 +94,13 @@ def create_connection_timeline(connections: List[WireGuardConnection]):
         )
         return fig
 
-def create_traffic_graph(connections: List[WireGuardConnection]):
-    """Create a traffic visualization graph"""
+def create_traffic_graph(connections: List[WireGuardConnection], width: int = DEFAULT_WIDTH,
+                         method: str = 'lttb'):
+    """Create a traffic visualization graph
+
+    Each series is reduced to about `width` points, with LTTB or, with
+    method='minmax', a min/max envelope that keeps every spike.
+    """
     logger.debug("Creating traffic visualization")
     
     if not connections:
@@ -137,18 +151,15 @@ def create_traffic_graph(connections: List[WireGuardConnection]):
         df = pd.DataFrame(transfer_data)
         
         fig = go.Figure()
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'],
-            y=df['bytes_sent'],
-            name='Bytes Sent',
-            mode='lines'
-        ))
-        fig.add_trace(go.Scatter(
-            x=df['timestamp'],
-            y=df['bytes_received'],
-            name='Bytes Received',
-            mode='lines'
-        ))
+        for column, name in (('bytes_sent', 'Bytes Sent'), ('bytes_received', 'Bytes Received')):
+            timestamps, values = downsample_series(df['timestamp'], df[column], width, method)
+            fig.add_trace(go.Scatter(
+                x=timestamps,
+                y=values,
+                name=name,
+                mode='lines'
+            ))
+        logger.debug(f"Downsampled {len(df)} transfer records to {len(timestamps)} points per series")
         
         fig.update_layout(
             title='Network Traffic Over Time',